@@ -12,7 +12,7 @@ from .prompts import SYSTEM_PROMPT
 
 
 load_dotenv(".env")
-app = FastAPI()
+app = FastAPI(lifespan=agent.provider_clients.lifespan)
 
 origins = [
     "https://pro.openbb.co",
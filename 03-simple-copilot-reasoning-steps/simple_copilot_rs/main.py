@@ -18,7 +18,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv(".env")
-app = FastAPI()
+app = FastAPI(lifespan=agent.provider_clients.lifespan)
 
 origins = [
     "http://localhost",
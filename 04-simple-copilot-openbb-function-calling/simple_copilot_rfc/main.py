@@ -7,6 +7,7 @@ from sse_starlette.sse import EventSourceResponse
 
 from dotenv import load_dotenv
 from common import agent
+from common.functions import get_widget_param_options, search_widgets
 from openbb_ai.models import (
     QueryRequest,
 )
@@ -18,7 +19,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv(".env")
-app = FastAPI()
+app = FastAPI(lifespan=agent.provider_clients.lifespan)
 
 origins = [
     "http://localhost",
@@ -62,8 +63,11 @@ async def query(request: QueryRequest) -> EventSourceResponse:
     """Query the Copilot."""
     openbb_agent = agent.OpenBBAgent(
         query_request=request,
-        system_prompt=render_system_prompt(widget_collection=request.widgets),
-        functions=[get_widget_data],
+        system_prompt=render_system_prompt(
+            widget_collection=request.widgets,
+            query=agent.get_latest_question(request),
+        ),
+        functions=[get_widget_data, search_widgets, get_widget_param_options],
     )
 
     # Stream the SSEs back to the client.
@@ -0,0 +1,90 @@
+"""Benchmark PDF text extraction throughput and event-loop lag.
+
+Extracts text from a synthetic PDF inline on the event loop (the old
+behaviour) and in process pools of 1, 4 and 8 workers, while a ticker
+coroutine measures how late the event loop wakes it up.
+
+Usage (from this example's directory):
+    python -m benchmarks.bench_pdf_extraction --pages 300
+"""
+
+import argparse
+import asyncio
+import io
+import statistics
+import time
+
+import pdfplumber
+
+from simple_copilot_pdf_handling.functions import _extract_pdf_text
+from simple_copilot_pdf_handling.workers import WorkerPool
+
+from .synthetic_pdf import make_synthetic_pdf
+
+
+def _extract_inline(file_content: bytes) -> str:
+    with pdfplumber.open(io.BytesIO(file_content)) as pdf:
+        return "".join(f"{page.extract_text()}\n\n" for page in pdf.pages)
+
+
+async def _measure(extract, interval: float = 0.01) -> tuple[float, list[float]]:
+    lags: list[float] = []
+    done = asyncio.Event()
+
+    async def ticker() -> None:
+        while not done.is_set():
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            lags.append(max(0.0, time.perf_counter() - expected))
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(interval)
+    start = time.perf_counter()
+    await extract()
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ticker_task
+    return elapsed, lags
+
+
+def _report(name: str, pages: int, elapsed: float, lags: list[float]) -> None:
+    print(
+        f"{name:>10}: {pages / elapsed:8.1f} pages/s, "
+        f"event-loop lag max {max(lags) * 1000:8.1f}ms "
+        f"mean {statistics.mean(lags) * 1000:6.1f}ms"
+    )
+
+
+async def main(pages: int) -> None:
+    file_content = make_synthetic_pdf(pages=pages)
+
+    async def inline() -> None:
+        _extract_inline(file_content)
+
+    elapsed, lags = await _measure(inline)
+    _report("inline", pages, elapsed, lags)
+
+    for workers in (1, 4, 8):
+        pool = WorkerPool(max_workers=workers)
+        # Start the worker processes before measuring.
+        await asyncio.gather(*(pool.run(int, timeout=60) for _ in range(workers)))
+
+        async def pooled() -> None:
+            await _extract_pdf_text(
+                file_content,
+                pool=pool,
+                workers=workers,
+                timeout=3600,
+                max_pages=pages,
+            )
+
+        elapsed, lags = await _measure(pooled)
+        _report(f"{workers} workers", pages, elapsed, lags)
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    args = parser.parse_args()
+    asyncio.run(main(args.pages))
@@ -0,0 +1,129 @@
+"""Benchmark prompt size and latency of PDF retrieval against full-text mode.
+
+Answers a question about a synthetic document of 20, 100 and 300 pages, with
+the whole text in the prompt (`PDF_RETRIEVAL_TOP_K = None`) and with only the
+top-k BM25 sections.  Completions are served by a local mock OpenAI server
+that simulates prefill time proportional to the number of prompt tokens, so
+that the effect of prompt size on time-to-first-token can be seen offline.
+
+Usage (from this example's directory):
+    python -m benchmarks.bench_pdf_retrieval --prefill-tokens-per-second 5000
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from unittest import mock
+
+from common.agent import (
+    OpenBBAgent,
+    OpenRouterChat,
+    formatted_result_cache,
+    provider_clients,
+)
+from common.testing import MockOpenAIServer, text_chunks
+from openbb_ai.models import QueryRequest
+
+from simple_copilot_pdf_handling import functions
+
+from .synthetic_pdf import WORDS
+
+QUESTION = "Were there any goodwill impairment charges this year?"
+
+
+def _make_pages(pages: int, words_per_page: int = 500, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    document = [
+        " ".join(rng.choice(WORDS) for _ in range(words_per_page)) for _ in range(pages)
+    ]
+    # The answer to the question is on one page near the end.
+    document[-2] += " Goodwill impairment charges of $42 million were recorded."
+    return document
+
+
+def _request(pages: int) -> QueryRequest:
+    return QueryRequest(
+        messages=[
+            {"role": "human", "content": QUESTION},
+            {
+                "role": "tool",
+                "function": "get_widget_data",
+                "data": [
+                    {
+                        "items": [
+                            {
+                                "url": f"https://example.com/10k-{pages}.pdf",
+                                "data_format": {
+                                    "data_type": "pdf",
+                                    "filename": "10k.pdf",
+                                },
+                            }
+                        ]
+                    }
+                ],
+                "extra_state": {
+                    "copilot_function_call_arguments": {"widget_uuid": "1234"},
+                    "_locally_bound_function": "get_widget_data",
+                },
+            },
+        ]
+    )
+
+
+async def _answer(
+    server: MockOpenAIServer, pages: int, top_k: int | None
+) -> tuple[float, float]:
+    document = _make_pages(pages)
+
+    async def get_url_pdf_pages(data):
+        return f"hash-{pages}", document, len(document)
+
+    with (
+        mock.patch.object(functions, "_get_url_pdf_pages", get_url_pdf_pages),
+        mock.patch.object(functions, "PDF_RETRIEVAL_TOP_K", top_k),
+    ):
+        functions._pdf_indexes.clear()
+        formatted_result_cache.clear()
+        start = time.perf_counter()
+        openbb_agent = OpenBBAgent(
+            query_request=_request(pages),
+            system_prompt="You are a helpful financial assistant.",
+            functions=[functions.get_widget_data],
+            chat_class=OpenRouterChat,
+            model="mock-model",
+            api_key="test",
+            base_url=server.base_url,
+        )
+        first_token = None
+        async for event in openbb_agent.run():
+            if first_token is None and event.get("event") == "copilotMessageChunk":
+                first_token = time.perf_counter() - start
+        return first_token or 0.0, time.perf_counter() - start
+
+
+async def main(prefill_tokens_per_second: float) -> None:
+    def handler(body: dict) -> list[dict]:
+        prompt_chars = sum(len(str(m.get("content") or "")) for m in body["messages"])
+        prompt_tokens.append(prompt_chars // 4)
+        time.sleep(prompt_tokens[-1] / prefill_tokens_per_second)
+        return text_chunks("Yes, $42 million of goodwill impairment was recorded.")
+
+    prompt_tokens: list[int] = []
+    with MockOpenAIServer(handler=handler) as server:
+        for pages in (20, 100, 300):
+            for name, top_k in (("full text", None), ("top-5", 5)):
+                ttft, total = await _answer(server, pages, top_k)
+                print(
+                    f"{pages:>4} pages, {name:>9}: "
+                    f"~{prompt_tokens[-1]:>7} prompt tokens, "
+                    f"TTFT {ttft * 1000:8.1f}ms, total {total * 1000:8.1f}ms"
+                )
+    await provider_clients.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=5000)
+    args = parser.parse_args()
+    asyncio.run(main(args.prefill_tokens_per_second))
@@ -0,0 +1,55 @@
+"""Generate synthetic, text-only PDFs for benchmarking (no extra dependencies)."""
+
+import random
+
+WORDS = (
+    "revenue margin guidance quarter fiscal growth earnings dividend segment "
+    "liquidity operating capital expenditure outlook risk factors net income "
+    "cash flow shareholders consolidated statements balance sheet debt equity"
+).split()
+
+
+def make_synthetic_pdf(
+    pages: int = 300, lines_per_page: int = 45, seed: int = 0
+) -> bytes:
+    """Build a `pages`-page PDF of pseudo-random financial prose, like a 10-K."""
+    rng = random.Random(seed)
+    objects: list[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",  # The page tree, filled in once we know the page object numbers.
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_numbers = []
+    for page in range(pages):
+        lines = [f"Page {page + 1}"] + [
+            " ".join(rng.choice(WORDS) for _ in range(12))
+            for _ in range(lines_per_page)
+        ]
+        text = "".join(f"({line}) Tj T* " for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 780 Td {text}ET".encode()
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+        content_number = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /CropBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % content_number
+        )
+        page_numbers.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % number for number in page_numbers)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref_offset,
+    )
+    return bytes(pdf)
@@ -1,7 +1,26 @@
+import asyncio
+import base64
+import binascii
+import hashlib
 import io
-from typing import AsyncGenerator
-from common.agent import reasoning_step, get_remote_data, remote_function_call
+import math
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Any, AsyncGenerator, Iterator
+from common.agent import (
+    get_latest_question,
+    provider_clients,
+    reasoning_step,
+    get_remote_data,
+    remote_function_call,
+)
 from common.callbacks import cite_widget
+from common.widgets import get_widget_index
 from openbb_ai.models import (
     DataFileReferences,
     PdfDataFormat,
@@ -15,44 +34,461 @@ from openbb_ai.models import (
 import httpx
 import pdfplumber
 
+from .pdf_cache import CachedDocument, PdfTextCache
+from .retrieval import ChunkIndex, chunk_pages
+from .workers import WorkerPool
+
 import logging
 
 logger = logging.getLogger(__name__)
 
+# PDF text extraction is CPU-bound, so it runs in a pool of worker processes
+# (with pages split across workers) to avoid blocking the event loop.
+PDF_EXTRACTION_WORKERS = 4
+# Seconds, per job (ie. per share of a document's pages), from when a worker
+# starts running it. Workers that time out are replaced.
+PDF_EXTRACTION_TIMEOUT = 60.0
+PDF_MAX_PAGES = 500
+
+# Extracted text is cached on disk, keyed by content hash, so that PDFs that
+# are attached again are revalidated with a conditional GET instead of being
+# re-downloaded and re-parsed.
+PDF_CACHE_PATH = Path(
+    os.environ.get(
+        "PDF_CACHE_PATH",
+        Path.home() / ".cache" / "openbb-copilot" / "pdf_text.sqlite3",
+    )
+)
+PDF_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# PDFs are streamed to a temporary file using the shared, pooled HTTP client,
+# so that large files are never held in memory in full.
+PDF_DOWNLOAD_MAX_BYTES = 100 * 1024 * 1024
+PDF_DOWNLOAD_TIMEOUT = 60.0  # seconds, per file
+PDF_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# PDFs sent inline (base64-encoded) are decoded to a temporary file in chunks,
+# and the total decoded size of the inline PDFs in one tool result is capped.
+PDF_INLINE_MAX_BYTES = 100 * 1024 * 1024
+
+# Only the sections of a PDF most relevant to the latest question are sent to
+# the LLM, rather than the whole document. Set to `None` to send the full text.
+PDF_RETRIEVAL_TOP_K: int | None = 5
+PDF_CHUNK_MAX_WORDS = 400
+PDF_INDEX_CACHE_SIZE = 32
+
+# Either the PDF itself, or the path of a file containing it.
+PdfContent = bytes | Path
+
+_pdf_workers: WorkerPool | None = None
+_pdf_cache: PdfTextCache | None = None
+# BM25 indexes of recently-seen documents, keyed by content hash.
+_pdf_indexes: OrderedDict[str, ChunkIndex] = OrderedDict()
+
+
+def _get_pdf_workers() -> WorkerPool:
+    global _pdf_workers
+    if _pdf_workers is None:
+        _pdf_workers = WorkerPool(max_workers=PDF_EXTRACTION_WORKERS)
+    return _pdf_workers
+
+
+def _get_pdf_cache() -> PdfTextCache:
+    global _pdf_cache
+    if _pdf_cache is None:
+        _pdf_cache = PdfTextCache(PDF_CACHE_PATH, max_bytes=PDF_CACHE_MAX_BYTES)
+    return _pdf_cache
+
+
+@dataclass
+class DownloadedFile:
+    # `None` if the server answered a conditional GET with 304 Not Modified.
+    content: PdfContent | None
+    content_hash: str | None = None
+    etag: str | None = None
+    last_modified: str | None = None
+
+    def cleanup(self) -> None:
+        if isinstance(self.content, Path):
+            self.content.unlink(missing_ok=True)
+
+
+def _create_temporary_file() -> IO[bytes]:
+    """Create a temporary file for a PDF, which the caller must delete."""
+    return tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+
+
+def _write_chunk(file: IO[bytes], content_hash: Any, chunk: bytes) -> None:
+    content_hash.update(chunk)
+    file.write(chunk)
 
-async def _download_file(url: str) -> bytes:
+
+async def _stream_to_file(
+    url: str, headers: dict[str, str], max_bytes: int
+) -> DownloadedFile:
+    client = provider_clients.http_client()
+    async with client.stream("GET", url, headers=headers) as response:
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            return DownloadedFile(
+                content=None,
+                etag=headers.get("If-None-Match"),
+                last_modified=headers.get("If-Modified-Since"),
+            )
+        response.raise_for_status()
+
+        too_large = ValueError(f"File at {url} is larger than {max_bytes} bytes")
+        if int(response.headers.get("Content-Length", 0)) > max_bytes:
+            raise too_large
+
+        content_hash = hashlib.sha256()
+        size = 0
+        file = await asyncio.to_thread(_create_temporary_file)
+        path = Path(file.name)
+        try:
+            try:
+                async for chunk in response.aiter_bytes(PDF_DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise too_large
+                    # Hashing and writing a chunk would block the event loop
+                    # (for other requests) on slow disks, so it runs in a thread.
+                    await asyncio.to_thread(_write_chunk, file, content_hash, chunk)
+            finally:
+                await asyncio.to_thread(file.close)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+
+        return DownloadedFile(
+            content=path,
+            content_hash=content_hash.hexdigest(),
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
+
+async def _download_file(
+    url: str,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    max_bytes: int = PDF_DOWNLOAD_MAX_BYTES,
+    timeout: float = PDF_DOWNLOAD_TIMEOUT,
+) -> DownloadedFile:
+    """Download a file to a temporary file, which the caller must clean up."""
     logger.info(f"Downloading file from {url}")
-    async with httpx.AsyncClient() as client:
-        file_content = await client.get(url)
-        return file_content.content
-
-
-async def _get_url_pdf_text(data: SingleFileReference) -> str:
-    file_content = await _download_file(str(data.url))
-    with pdfplumber.open(io.BytesIO(file_content)) as pdf:
-        document_text = ""
-        for page in pdf.pages:
-            document_text += page.extract_text()
-            document_text += "\n\n"
-        return document_text
-
-
-async def handle_widget_data(data: list[DataContent | DataFileReferences]) -> str:
-    result_str = "--- Data ---\n"
-    for result in data:
-        for item in result.items:
-            if isinstance(item.data_format, PdfDataFormat):
-                result_str += f"===== {item.data_format.filename} =====\n"
-                if isinstance(item, SingleDataContent):
-                    raise NotImplementedError(
-                        "Only PDFs uploaded to OpenBB Workspace or served from custom backends that serve URLs are currently supported."  # noqa: E501
-                    )
-                elif isinstance(item, SingleFileReference):
-                    result_str += await _get_url_pdf_text(item)
-            else:
-                result_str += f"{item.content}\n"
-            result_str += "------\n"
-    return result_str
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        return await asyncio.wait_for(_stream_to_file(url, headers, max_bytes), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Downloading {url} timed out after {timeout} seconds")
+
+
+def _base64_payload(content: str) -> str:
+    # Strip the prefix of data URLs, eg. "data:application/pdf;base64,".
+    if content.startswith("data:"):
+        content = content.partition(",")[2]
+    if re.search(r"\s", content):
+        content = "".join(content.split())
+    return content
+
+
+def _decoded_size(content: str) -> int:
+    """The number of bytes `content` decodes to, without decoding it."""
+    payload = _base64_payload(content)
+    return len(payload) * 3 // 4 - payload[-2:].count("=")
+
+
+def _decode_inline_file(content: str) -> tuple[Path, str]:
+    """Decode a base64-encoded file to a temporary file, in chunks.
+
+    Returns the path of the file, which the caller must clean up, and the hash
+    of its content.
+    """
+    content = _base64_payload(content)
+    content_hash = hashlib.sha256()
+    # A multiple of 4 characters, so that every chunk decodes on its own.
+    chunk_size = PDF_DOWNLOAD_CHUNK_SIZE // 3 * 4
+    file = _create_temporary_file()
+    path = Path(file.name)
+    try:
+        with file:
+            for start in range(0, len(content), chunk_size):
+                chunk = base64.b64decode(
+                    content[start : start + chunk_size], validate=True
+                )
+                content_hash.update(chunk)
+                file.write(chunk)
+    except binascii.Error as error:
+        path.unlink(missing_ok=True)
+        raise ValueError(f"Inline file is not valid base64: {error}") from error
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return path, content_hash.hexdigest()
+
+
+async def _get_inline_pdf_pages(data: SingleDataContent) -> tuple[str, list[str], int]:
+    path, content_hash = await asyncio.to_thread(_decode_inline_file, data.content)
+    try:
+        return await _get_pdf_pages(path, content_hash=content_hash)
+    finally:
+        path.unlink(missing_ok=True)
+
+
+@contextmanager
+def _open_pdf(file_content: PdfContent) -> Iterator[pdfplumber.PDF]:
+    # Files are opened by path, so that each worker process reads the pages it
+    # needs (from the page cache) instead of being sent a copy of the PDF.
+    if isinstance(file_content, Path):
+        with pdfplumber.open(file_content) as pdf:
+            yield pdf
+    else:
+        with pdfplumber.open(io.BytesIO(file_content)) as pdf:
+            yield pdf
+
+
+def _count_pdf_pages(file_content: PdfContent) -> int:
+    with _open_pdf(file_content) as pdf:
+        return len(pdf.pages)
+
+
+def _extract_pdf_pages(file_content: PdfContent, start: int, stop: int) -> list[str]:
+    with _open_pdf(file_content) as pdf:
+        return [page.extract_text() for page in pdf.pages[start:stop]]
+
+
+async def _extract_pdf_page_texts(
+    file_content: PdfContent,
+    pool: WorkerPool | None = None,
+    workers: int = PDF_EXTRACTION_WORKERS,
+    timeout: float = PDF_EXTRACTION_TIMEOUT,
+    max_pages: int = PDF_MAX_PAGES,
+) -> tuple[list[str], int]:
+    pool = pool or _get_pdf_workers()
+
+    async def extract_pages() -> tuple[list[str], int]:
+        page_count = await pool.run(_count_pdf_pages, file_content, timeout=timeout)
+        # Split the (capped) pages evenly across the workers.
+        stop = min(page_count, max_pages)
+        pages_per_worker = max(1, math.ceil(stop / workers))
+        tasks = [
+            asyncio.ensure_future(
+                pool.run(
+                    _extract_pdf_pages,
+                    file_content,
+                    start,
+                    min(start + pages_per_worker, stop),
+                    timeout=timeout,
+                )
+            )
+            for start in range(0, stop, pages_per_worker)
+        ]
+        try:
+            page_chunks = await asyncio.gather(*tasks)
+        except BaseException:
+            # Don't leave the rest of the document running (or queued).
+            for task in tasks:
+                task.cancel()
+            raise
+        return [page for page_chunk in page_chunks for page in page_chunk], page_count
+
+    try:
+        return await extract_pages()
+    except TimeoutError:
+        raise TimeoutError(f"PDF text extraction timed out after {timeout} seconds")
+
+
+def _format_pdf_text(
+    pages: list[str], page_count: int, max_pages: int = PDF_MAX_PAGES
+) -> str:
+    pages = pages[:max_pages]
+    document_text = "".join(f"{page}\n\n" for page in pages)
+    if page_count > len(pages):
+        document_text += (
+            f"[Only the first {len(pages)} of {page_count} pages are included.]\n\n"
+        )
+    return document_text
+
+
+async def _extract_pdf_text(
+    file_content: PdfContent,
+    pool: WorkerPool | None = None,
+    workers: int = PDF_EXTRACTION_WORKERS,
+    timeout: float = PDF_EXTRACTION_TIMEOUT,
+    max_pages: int = PDF_MAX_PAGES,
+) -> str:
+    pages, page_count = await _extract_pdf_page_texts(
+        file_content,
+        pool=pool,
+        workers=workers,
+        timeout=timeout,
+        max_pages=max_pages,
+    )
+    return _format_pdf_text(pages, page_count, max_pages=max_pages)
+
+
+def _is_complete(document: CachedDocument, max_pages: int = PDF_MAX_PAGES) -> bool:
+    # Documents cached with a lower page cap have to be extracted again.
+    return len(document.pages) >= min(document.page_count, max_pages)
+
+
+async def _get_pdf_pages(
+    file_content: PdfContent, content_hash: str | None = None
+) -> tuple[str, list[str], int]:
+    """Extract the pages of a PDF, re-using the cached text if we've seen it."""
+    cache = _get_pdf_cache()
+    if content_hash is None:
+        if isinstance(file_content, Path):
+            file_content = await asyncio.to_thread(file_content.read_bytes)
+        content_hash = hashlib.sha256(file_content).hexdigest()
+    document = await asyncio.to_thread(cache.get_document, content_hash)
+    if document is not None and _is_complete(document):
+        logger.info(f"Using cached text for PDF {content_hash}")
+        return content_hash, document.pages, document.page_count
+
+    pages, page_count = await _extract_pdf_page_texts(file_content)
+    await asyncio.to_thread(cache.put_document, content_hash, pages, page_count)
+    return content_hash, pages, page_count
+
+
+async def _get_url_pdf_pages(data: SingleFileReference) -> tuple[str, list[str], int]:
+    url = str(data.url)
+    cache = _get_pdf_cache()
+
+    # If we've seen this URL before, revalidate it with a conditional GET and
+    # skip the download and extraction altogether if it has not changed.
+    cached_url = await asyncio.to_thread(cache.get_url, url)
+    if cached_url is not None and (cached_url.etag or cached_url.last_modified):
+        downloaded_file = await _download_file(
+            url, etag=cached_url.etag, last_modified=cached_url.last_modified
+        )
+        if downloaded_file.content is None:
+            document = await asyncio.to_thread(
+                cache.get_document, cached_url.content_hash
+            )
+            if document is not None and _is_complete(document):
+                logger.info(f"PDF not modified, using cached text for {url}")
+                return cached_url.content_hash, document.pages, document.page_count
+            # The text was evicted (or is incomplete), so download it again.
+            downloaded_file = await _download_file(url)
+    else:
+        downloaded_file = await _download_file(url)
+    if downloaded_file.content is None:
+        raise ValueError(f"{url} answered an unconditional GET with 304 Not Modified")
+
+    try:
+        content_hash, pages, page_count = await _get_pdf_pages(
+            downloaded_file.content, content_hash=downloaded_file.content_hash
+        )
+    finally:
+        downloaded_file.cleanup()
+    await asyncio.to_thread(
+        cache.put_url,
+        url,
+        content_hash,
+        downloaded_file.etag,
+        downloaded_file.last_modified,
+    )
+    return content_hash, pages, page_count
+
+
+def _get_pdf_index(content_hash: str, pages: list[str]) -> ChunkIndex:
+    index = _pdf_indexes.get(content_hash)
+    if index is None:
+        index = ChunkIndex(chunk_pages(pages, max_words=PDF_CHUNK_MAX_WORDS))
+        _pdf_indexes[content_hash] = index
+        if len(_pdf_indexes) > PDF_INDEX_CACHE_SIZE:
+            _pdf_indexes.popitem(last=False)
+    else:
+        _pdf_indexes.move_to_end(content_hash)
+    return index
+
+
+def _retrieve_pdf_text(
+    content_hash: str,
+    pages: list[str],
+    page_count: int,
+    question: str | None,
+    top_k: int | None,
+) -> str:
+    """Get the sections of a PDF most relevant to `question`, with page numbers."""
+    if top_k is None or question is None:
+        return _format_pdf_text(pages, page_count)
+    index = _get_pdf_index(content_hash, pages[:PDF_MAX_PAGES])
+    if len(index.chunks) <= top_k:
+        return _format_pdf_text(pages, page_count)
+
+    chunks = index.search(question, top_k)
+    document_text = (
+        f"[Showing the {len(chunks)} of {len(index.chunks)} sections of this "
+        "document most relevant to the latest question.]\n\n"
+    )
+    document_text += "".join(
+        f"--- Page {chunk.page} of {page_count} ---\n{chunk.text}\n\n"
+        for chunk in chunks
+    )
+    return document_text
+
+
+async def _get_item_text(
+    item: SingleDataContent | SingleFileReference,
+    question: str | None = None,
+    skip_inline_pdf: bool = False,
+) -> str:
+    if isinstance(item.data_format, PdfDataFormat):
+        item_str = f"===== {item.data_format.filename} =====\n"
+        if skip_inline_pdf:
+            item_str += (
+                "[This PDF was not read, because the inline PDFs of this result "
+                f"are larger than {PDF_INLINE_MAX_BYTES} bytes in total.]\n"
+            )
+            return item_str + "------\n"
+        if isinstance(item, SingleDataContent):
+            content_hash, pages, page_count = await _get_inline_pdf_pages(item)
+        else:
+            content_hash, pages, page_count = await _get_url_pdf_pages(item)
+        item_str += _retrieve_pdf_text(
+            content_hash, pages, page_count, question, top_k=PDF_RETRIEVAL_TOP_K
+        )
+    else:
+        item_str = f"{item.content}\n"
+    return item_str + "------\n"
+
+
+async def handle_widget_data(
+    data: list[DataContent | DataFileReferences], request: QueryRequest | None = None
+) -> str:
+    question = get_latest_question(request) if request else None
+    items = [item for result in data for item in result.items]
+
+    # Inline PDFs are read in order until they reach the limit, and the rest are
+    # replaced by a note. The limit applies to each tool result on its own, so
+    # the earlier results that are re-sent with every turn never add up.
+    inline_pdf_bytes = 0
+    skip_inline_pdf = []
+    for item in items:
+        skip = False
+        if isinstance(item, SingleDataContent) and isinstance(
+            item.data_format, PdfDataFormat
+        ):
+            size = _decoded_size(item.content)
+            skip = inline_pdf_bytes + size > PDF_INLINE_MAX_BYTES
+            if not skip:
+                inline_pdf_bytes += size
+        skip_inline_pdf.append(skip)
+
+    # Files are downloaded and extracted concurrently, but kept in order.
+    item_strs = await asyncio.gather(
+        *(
+            _get_item_text(item, question, skip_inline_pdf=skip)
+            for item, skip in zip(items, skip_inline_pdf)
+        )
+    )
+    return "--- Data ---\n" + "".join(item_strs)
 
 
 # We will use a built-in callback which will automatically yield citations for
@@ -69,15 +505,8 @@ async def get_widget_data(
 ) -> AsyncGenerator[FunctionCallSSE | StatusUpdateSSE, None]:
     """Retrieve data for a widget by specifying the widget UUID."""
 
-    widgets = (
-        request.widgets.primary + request.widgets.secondary if request.widgets else []
-    )
-
-    # Get the first widget that matches the UUID (there should be only one).
-    matching_widgets = list(
-        filter(lambda widget: str(widget.uuid) == widget_uuid, widgets)
-    )
-    widget = matching_widgets[0] if matching_widgets else None
+    # Look up the widget by its UUID (the index is shared by the whole request).
+    widget = get_widget_index(request).get(widget_uuid)
 
     # If we're unable to find the widget, let's the the user know.
     if not widget:
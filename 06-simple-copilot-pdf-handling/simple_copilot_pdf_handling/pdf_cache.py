@@ -0,0 +1,153 @@
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedUrl:
+    """The validators and content hash last seen for a URL."""
+
+    content_hash: str
+    etag: str | None
+    last_modified: str | None
+
+
+@dataclass
+class CachedDocument:
+    """The extracted text of a PDF, one entry per page."""
+
+    pages: list[str]
+    page_count: int
+
+
+class PdfTextCache:
+    """A disk-backed cache of extracted PDF text.
+
+    Two tables are kept in a single SQLite file:
+
+    - `urls` maps a URL to the ETag / Last-Modified validators it was last
+      served with and the sha256 hash of its content, so that the URL can be
+      revalidated with a conditional GET instead of being re-downloaded.
+    - `documents` maps a content hash to the extracted per-page text, so that
+      the same PDF served from different URLs (eg. pre-signed URLs) is only
+      parsed once.
+
+    Documents are evicted least-recently-used first once the total size of
+    their text exceeds `max_bytes`. URLs that point at an evicted document are
+    dropped with it.
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int = 256 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                content_hash TEXT PRIMARY KEY,
+                pages TEXT NOT NULL,
+                page_count INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS documents_last_access
+                ON documents (last_access);
+            """
+        )
+
+    def get_url(self, url: str) -> CachedUrl | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content_hash, etag, last_modified FROM urls WHERE url = ?",
+                (url,),
+            ).fetchone()
+        return CachedUrl(*row) if row else None
+
+    def put_url(
+        self,
+        url: str,
+        content_hash: str,
+        etag: str | None,
+        last_modified: str | None,
+    ) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)",
+                (url, content_hash, etag, last_modified),
+            )
+
+    def get_document(self, content_hash: str) -> CachedDocument | None:
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT pages, page_count FROM documents WHERE content_hash = ?",
+                (content_hash,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE documents SET last_access = ? WHERE content_hash = ?",
+                (time.time(), content_hash),
+            )
+        pages, page_count = row
+        return CachedDocument(pages=json.loads(pages), page_count=page_count)
+
+    def put_document(
+        self, content_hash: str, pages: list[str], page_count: int
+    ) -> None:
+        serialized_pages = json.dumps(pages)
+        size = len(serialized_pages)
+        if size > self.max_bytes:
+            logger.info(f"Not caching PDF {content_hash} ({size} bytes of text)")
+            return
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                (content_hash, serialized_pages, page_count, size, time.time()),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        (total_size,) = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM documents"
+        ).fetchone()
+        if total_size <= self.max_bytes:
+            return
+        for content_hash, size in self._connection.execute(
+            "SELECT content_hash, size FROM documents ORDER BY last_access"
+        ).fetchall():
+            self._connection.execute(
+                "DELETE FROM documents WHERE content_hash = ?", (content_hash,)
+            )
+            self._connection.execute(
+                "DELETE FROM urls WHERE content_hash = ?", (content_hash,)
+            )
+            total_size -= size
+            if total_size <= self.max_bytes:
+                break
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            (total_size,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM documents"
+            ).fetchone()
+        return total_size
+
+    def close(self) -> None:
+        self._connection.close()
@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+
+from common.retrieval import Bm25Index
+
+
+@dataclass
+class Chunk:
+    """A section of a document, and the (1-indexed) page it comes from."""
+
+    page: int
+    text: str
+
+
+def chunk_pages(pages: list[str], max_words: int = 400) -> list[Chunk]:
+    """Split a document into one chunk per page, splitting up long pages."""
+    chunks = []
+    for page_number, page in enumerate(pages, start=1):
+        words = (page or "").split()
+        if len(words) <= max_words:
+            if words:
+                chunks.append(Chunk(page=page_number, text=page))
+            continue
+        for start in range(0, len(words), max_words):
+            chunks.append(
+                Chunk(page=page_number, text=" ".join(words[start : start + max_words]))
+            )
+    return chunks
+
+
+class ChunkIndex:
+    """A BM25 index over the chunks of a document."""
+
+    def __init__(self, chunks: list[Chunk]):
+        self.chunks = chunks
+        self._index = Bm25Index(chunk.text for chunk in chunks)
+
+    def search(self, query: str, top_k: int) -> list[Chunk]:
+        """Get the `top_k` chunks most relevant to `query`, in document order.
+
+        If nothing in the document matches the query (eg. "summarize this"),
+        the first `top_k` chunks are returned instead.
+        """
+        selected = self._index.rank(query, limit=top_k) or range(
+            min(top_k, len(self.chunks))
+        )
+        return [self.chunks[i] for i in sorted(selected)]
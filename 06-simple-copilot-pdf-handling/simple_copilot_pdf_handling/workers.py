@@ -0,0 +1,110 @@
+import asyncio
+import multiprocessing
+import weakref
+from multiprocessing.connection import Connection
+from typing import Any, Callable
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _serve(connection: Connection) -> None:
+    """Run the jobs sent over `connection`, until it is closed."""
+    while True:
+        try:
+            function, args = connection.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = (True, function(*args))
+        except Exception as error:
+            result = (False, error)
+        try:
+            connection.send(result)
+        except Exception as error:
+            # Eg. an exception that can't be pickled.
+            connection.send((False, RuntimeError(repr(error))))
+
+
+class _Worker:
+    def __init__(self, context: Any):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child_connection,), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+
+    def call(self, function: Callable, args: tuple) -> Any:
+        self.connection.send((function, args))
+        ok, result = self.connection.recv()
+        if not ok:
+            raise result
+        return result
+
+    def stop(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class WorkerPool:
+    """A pool of worker processes for CPU-bound jobs, with a timeout per job.
+
+    Jobs wait (without a timeout) for a free worker, and are only timed from
+    when a worker starts running them, so that a busy pool doesn't time out
+    small jobs.  A worker whose job times out (or is cancelled) is killed and
+    replaced, rather than carrying on with the job and holding its slot.
+    """
+
+    def __init__(self, max_workers: int, mp_context: Any = None):
+        self.max_workers = max_workers
+        self._context = mp_context or multiprocessing.get_context()
+        self._idle: list[_Worker] = []
+        # The free slots, per event loop (asyncio primitives are bound to the
+        # loop they are first used on).
+        self._slots: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._slots:
+            self._slots[loop] = asyncio.Semaphore(self.max_workers)
+        return self._slots[loop]
+
+    async def run(self, function: Callable, *args: Any, timeout: float) -> Any:
+        """Run `function(*args)` in a worker process, and return its result.
+
+        Raises `TimeoutError` if it runs for longer than `timeout` seconds.
+        """
+        async with self._get_slots():
+            worker = self._idle.pop() if self._idle else _Worker(self._context)
+            try:
+                result = await asyncio.wait_for(
+                    asyncio.to_thread(worker.call, function, args), timeout
+                )
+            except asyncio.TimeoutError:
+                worker.stop()
+                raise TimeoutError(
+                    f"{function.__name__} timed out after {timeout} seconds"
+                )
+            except asyncio.CancelledError:
+                worker.stop()
+                raise
+            except Exception:
+                # The job failed, but unless the worker died with it, it can
+                # carry on with the next one.
+                if worker.process.is_alive():
+                    self._idle.append(worker)
+                else:
+                    worker.stop()
+                raise
+            self._idle.append(worker)
+            return result
+
+    def shutdown(self) -> None:
+        """Stop the idle workers."""
+        while self._idle:
+            self._idle.pop().stop()
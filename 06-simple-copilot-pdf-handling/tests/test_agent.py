@@ -1,7 +1,15 @@
+import asyncio
+import hashlib
 import json
+import time
 from unittest import mock
 from fastapi.testclient import TestClient
+from simple_copilot_pdf_handling import functions
+from simple_copilot_pdf_handling.functions import DownloadedFile
 from simple_copilot_pdf_handling.main import app
+from simple_copilot_pdf_handling.pdf_cache import PdfTextCache
+from simple_copilot_pdf_handling.workers import WorkerPool
+from openbb_ai.models import QueryRequest, SingleFileReference
 import pytest
 from pathlib import Path
 from common.testing import CopilotResponse, capture_stream_response
@@ -21,6 +29,15 @@ def reset_sse_starlette_appstatus_event():
     AppStatus.should_exit_event = None
 
 
+@pytest.fixture(autouse=True)
+def pdf_cache(tmp_path, monkeypatch):
+    """Use an empty PDF text cache for each test."""
+    cache = PdfTextCache(tmp_path / "pdf_text.sqlite3")
+    monkeypatch.setattr(functions, "_pdf_cache", cache)
+    yield cache
+    cache.close()
+
+
 def test_query():
     test_payload_path = (
         Path(__file__).parent.parent.parent / "test_payloads" / "single_message.json"
@@ -156,7 +173,8 @@ def test_query_completes_remote_function_call_with_citation_pdf_url():
         pdf_content = pdf.read()
 
     with mock.patch(
-        "simple_copilot_pdf_handling.functions._download_file", return_value=pdf_content
+        "simple_copilot_pdf_handling.functions._download_file",
+        return_value=DownloadedFile(content=pdf_content),
     ):
         response = test_client.post("/v1/query", json=test_payload)
 
@@ -191,3 +209,259 @@ def test_query_completes_remote_function_call_with_citation_pdf_url():
             }
         )
     )
+
+
+@pytest.mark.asyncio
+async def test_extract_pdf_text_splits_pages_across_workers():
+    from simple_copilot_pdf_handling.functions import _extract_pdf_text
+
+    with open(Path(__file__).parent / "openbb_story.pdf", "rb") as pdf:
+        pdf_content = pdf.read()
+
+    document_text = await _extract_pdf_text(pdf_content, workers=2)
+    assert document_text.startswith("GME DIDN’T TAKE ME TO THE")
+    assert document_text.count("\n\n") >= 5
+
+    truncated_text = await _extract_pdf_text(pdf_content, workers=2, max_pages=1)
+    assert truncated_text.endswith("[Only the first 1 of 5 pages are included.]\n\n")
+    assert len(truncated_text) < len(document_text)
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_only_times_jobs_once_they_start():
+    pool = WorkerPool(max_workers=1)
+    try:
+        # Both jobs fit in the timeout, even though the second one has to wait
+        # for the first one to finish.
+        await asyncio.gather(
+            pool.run(time.sleep, 0.3, timeout=1.0),
+            pool.run(time.sleep, 0.3, timeout=1.0),
+        )
+        worker = pool._idle[0]
+
+        with pytest.raises(TimeoutError):
+            await pool.run(time.sleep, 10, timeout=0.2)
+        # The worker that timed out was stopped, and replaced.
+        assert not worker.process.is_alive()
+        assert await pool.run(abs, -1, timeout=1.0) == 1
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_get_url_pdf_pages_revalidates_cached_pdf(pdf_cache):
+    with open(Path(__file__).parent / "openbb_story.pdf", "rb") as pdf:
+        pdf_content = pdf.read()
+
+    file_reference = SingleFileReference(
+        url="https://example.com/openbb_story.pdf",
+        data_format={"data_type": "pdf", "filename": "openbb_story.pdf"},
+    )
+    download_file = mock.AsyncMock(
+        side_effect=[
+            DownloadedFile(content=pdf_content, etag='"v1"'),
+            DownloadedFile(content=None, etag='"v1"'),
+        ]
+    )
+    with mock.patch.object(functions, "_download_file", download_file):
+        document = await functions._get_url_pdf_pages(file_reference)
+        with mock.patch.object(functions, "_extract_pdf_page_texts") as extract:
+            cached_document = await functions._get_url_pdf_pages(file_reference)
+
+    # The second request is a conditional GET, and the text comes from the
+    # cache instead of being extracted again.
+    assert download_file.await_args_list[1].kwargs == {
+        "etag": '"v1"',
+        "last_modified": None,
+    }
+    extract.assert_not_called()
+    assert cached_document == document
+    _, pages, page_count = document
+    assert page_count == 5
+    assert pages[0].startswith("GME DIDN’T TAKE ME TO THE")
+
+
+def test_pdf_text_cache_evicts_least_recently_used(tmp_path):
+    cache = PdfTextCache(tmp_path / "pdf_text.sqlite3", max_bytes=100)
+    cache.put_document("a", ["a" * 30], page_count=1)
+    cache.put_url("https://example.com/a.pdf", "a", etag='"a"', last_modified=None)
+    cache.put_document("b", ["b" * 30], page_count=1)
+    cache.get_document("a")
+    cache.put_document("c", ["c" * 30], page_count=1)
+
+    assert cache.get_document("b") is None
+    assert cache.get_document("a").pages == ["a" * 30]
+    assert cache.get_url("https://example.com/a.pdf").content_hash == "a"
+    assert cache.size <= 100
+    cache.close()
+
+
+@pytest.fixture
+def pdf_server():
+    """Serve `openbb_story.pdf` locally, recording the peak concurrent requests."""
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    pdf_content = (Path(__file__).parent / "openbb_story.pdf").read_bytes()
+    state = {"in_flight": 0, "max_in_flight": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                state["in_flight"] += 1
+                state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            time.sleep(0.2)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(pdf_content)))
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            self.wfile.write(pdf_content)
+            with lock:
+                state["in_flight"] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", state
+    server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_handle_widget_data_downloads_files_concurrently(pdf_server):
+    from common.agent import provider_clients
+    from openbb_ai.models import DataFileReferences
+
+    base_url, state = pdf_server
+    data = DataFileReferences(
+        items=[
+            SingleFileReference(
+                url=f"{base_url}/{name}.pdf",
+                data_format={"data_type": "pdf", "filename": f"{name}.pdf"},
+            )
+            for name in ("first", "second")
+        ]
+    )
+    try:
+        result = await functions.handle_widget_data([data])
+    finally:
+        await provider_clients.aclose()
+
+    assert state["max_in_flight"] == 2
+    assert result.index("===== first.pdf") < result.index("===== second.pdf")
+    assert result.count("GME DIDN’T TAKE ME TO THE") == 2
+
+
+@pytest.mark.asyncio
+async def test_download_file_enforces_max_size(pdf_server, tmp_path, monkeypatch):
+    from common.agent import provider_clients
+
+    base_url, _ = pdf_server
+    download_dir = tmp_path / "downloads"
+    download_dir.mkdir()
+    monkeypatch.setattr(functions.tempfile, "tempdir", str(download_dir))
+    try:
+        downloaded_file = await functions._download_file(f"{base_url}/story.pdf")
+        with pytest.raises(ValueError, match="larger than 1000 bytes"):
+            await functions._download_file(f"{base_url}/story.pdf", max_bytes=1000)
+    finally:
+        await provider_clients.aclose()
+
+    assert downloaded_file.etag == '"v1"'
+    assert (
+        downloaded_file.content.read_bytes()
+        == (Path(__file__).parent / "openbb_story.pdf").read_bytes()
+    )
+    downloaded_file.cleanup()
+    assert list(download_dir.iterdir()) == []
+
+
+def test_retrieve_pdf_text_returns_relevant_pages():
+    pages = [f"Filler text about the weather on page {page}." for page in range(20)]
+    pages[12] = "Goodwill impairment charges increased in the fourth quarter."
+    pages[15] = "No impairment was recorded for intangible assets."
+
+    document_text = functions._retrieve_pdf_text(
+        "hash", pages, 20, "Were there any goodwill impairment charges?", top_k=2
+    )
+    assert document_text.startswith("[Showing the 2 of 20 sections")
+    assert document_text.index("--- Page 13 of 20 ---\nGoodwill") < (
+        document_text.index("--- Page 16 of 20 ---\nNo impairment")
+    )
+    assert "weather" not in document_text
+
+    # Without a question, or for short documents, the full text is used.
+    full_text = functions._retrieve_pdf_text("hash", pages, 20, None, top_k=2)
+    assert full_text == functions._format_pdf_text(pages, 20)
+    assert functions._retrieve_pdf_text("hash", pages, 20, "weather", top_k=20) == (
+        full_text
+    )
+
+
+@pytest.mark.asyncio
+async def test_handle_widget_data_decodes_inline_pdfs(pdf_cache, tmp_path, monkeypatch):
+    import base64
+
+    from openbb_ai.models import DataContent
+
+    download_dir = tmp_path / "downloads"
+    download_dir.mkdir()
+    monkeypatch.setattr(functions.tempfile, "tempdir", str(download_dir))
+    # Decode in small chunks, to check that they are stitched back together.
+    monkeypatch.setattr(functions, "PDF_DOWNLOAD_CHUNK_SIZE", 1024)
+
+    pdf_content = (Path(__file__).parent / "openbb_story.pdf").read_bytes()
+    encoded_content = base64.encodebytes(pdf_content).decode()  # With newlines.
+    data = DataContent(
+        items=[
+            {
+                "content": encoded_content,
+                "data_format": {"data_type": "pdf", "filename": "openbb_story.pdf"},
+            }
+        ]
+    )
+
+    result = await functions.handle_widget_data([data])
+    assert "===== openbb_story.pdf =====\nGME DIDN’T TAKE ME TO THE" in result
+    assert list(download_dir.iterdir()) == []
+
+    # The text is cached by content hash, like downloaded PDFs.
+    content_hash = hashlib.sha256(pdf_content).hexdigest()
+    assert pdf_cache.get_document(content_hash).page_count == 5
+
+    # Over the limit, the PDF is replaced by a note instead of failing the turn.
+    monkeypatch.setattr(functions, "PDF_INLINE_MAX_BYTES", len(pdf_content) - 1)
+    result = await functions.handle_widget_data([data])
+    assert "===== openbb_story.pdf =====\n[This PDF was not read" in result
+    assert "GME" not in result
+
+    # The limit applies to each tool result on its own, so the results that are
+    # re-sent with every turn of a conversation don't add up.
+    monkeypatch.setattr(functions, "PDF_INLINE_MAX_BYTES", len(pdf_content) * 3 // 2)
+    request = QueryRequest(messages=[{"role": "human", "content": "Summarize."}])
+    for _ in range(3):
+        result = await functions.handle_widget_data([data], request=request)
+        assert "GME DIDN’T TAKE ME TO THE" in result
+
+    # Within one result, the PDFs after the limit are skipped.
+    twice = DataContent(items=data.items * 2)
+    result = await functions.handle_widget_data([twice], request=request)
+    assert result.count("GME DIDN’T TAKE ME TO THE") == 1
+    assert result.count("[This PDF was not read") == 1
+
+
+def test_decoded_size_of_inline_files():
+    import base64
+
+    for size in range(1, 10):
+        encoded = base64.b64encode(b"x" * size * 100).decode()
+        assert functions._decoded_size(encoded) == size * 100
+        data_url = (
+            "data:application/pdf;base64,"
+            + base64.encodebytes(b"x" * size * 100).decode()
+        )
+        assert functions._decoded_size(data_url) == size * 100
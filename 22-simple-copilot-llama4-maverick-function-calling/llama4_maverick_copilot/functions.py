@@ -2,6 +2,7 @@ import random
 from typing import AsyncGenerator
 from common.agent import reasoning_step, get_remote_data, remote_function_call
 from common.callbacks import cite_widget
+from common.widgets import get_widget_index
 from openbb_ai.models import (
     QueryRequest,
     DataContent,
@@ -104,15 +105,8 @@ async def get_widget_data(
 ) -> AsyncGenerator[FunctionCallSSE | StatusUpdateSSE, None]:
     """Retrieve data for a widget by specifying the widget UUID."""
 
-    widgets = (
-        request.widgets.primary + request.widgets.secondary if request.widgets else []
-    )
-
-    # Get the first widget that matches the UUID (there should be only one).
-    matching_widgets = list(
-        filter(lambda widget: str(widget.uuid) == widget_uuid, widgets)
-    )
-    widget = matching_widgets[0] if matching_widgets else None
+    # Look up the widget by its UUID (the index is shared by the whole request).
+    widget = get_widget_index(request).get(widget_uuid)
 
     # If we're unable to find the widget, let's the the user know.
     if not widget:
@@ -9,6 +9,7 @@ from .prompts import render_system_prompt
 
 from dotenv import load_dotenv
 from common import agent
+from common.functions import get_widget_param_options, search_widgets
 from openbb_ai.models import (
     QueryRequest,
 )
@@ -18,7 +19,14 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv(".env")
-app = FastAPI()
+FUNCTIONS = [
+    get_widget_data,
+    search_widgets,
+    get_widget_param_options,
+    get_random_stout_beers,
+]
+# OpenRouterChat sends the OpenAI-style tool schemas, so warm those up front.
+app = FastAPI(lifespan=agent.lifespan(FUNCTIONS, providers=["openai"]))
 
 origins = [
     "http://localhost",
@@ -63,10 +71,13 @@ async def query(request: QueryRequest) -> EventSourceResponse:
 
     openbb_agent = agent.OpenBBAgent(
         query_request=request,
-        system_prompt=render_system_prompt(request.widgets),
+        system_prompt=render_system_prompt(
+            widget_collection=request.widgets,
+            query=agent.get_latest_question(request),
+        ),
         chat_class=agent.OpenRouterChat,
         model="meta-llama/llama-4-maverick",
-        functions=[get_widget_data, get_random_stout_beers],
+        functions=FUNCTIONS,
     )
 
     # Stream the SSEs back to the client.
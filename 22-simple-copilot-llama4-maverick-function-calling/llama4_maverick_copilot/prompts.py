@@ -1,6 +1,9 @@
-from openbb_ai.models import Widget, WidgetCollection
+from common.widgets import WidgetPromptRenderer, render_widget_with_param_options
+from openbb_ai.models import WidgetCollection
 
 
+MAX_SECONDARY_WIDGETS = 20
+
 SYSTEM_PROMPT_TEMPLATE = """\n
 You are a helpful financial assistant working for Example Co.
 Your name is "Simple Copilot", and you were trained by Example Co.
@@ -17,6 +20,8 @@ Use the following guidelines:
 
 You can use the following functions to help you answer the user's query:
 - get_widget_data(widget_uuid: str) -> str: Get the data for a widget. You can use this function multiple times to get the data for multiple widgets.
+- search_widgets(query: str) -> str: Search the widgets on the dashboard by keywords, including the ones not listed below.
+- get_widget_param_options(widget_uuid: str, param_name: str) -> str: List every option of a widget parameter.
 - get_random_stout_beers(n: int = 1) -> str: Get a random stout beer from the Beer API.
   - When doing so, it is recommended to display the image in the UI to display the beer to the user.
   - Also always offer a description of the beer to the user, based on the information in the beer.
@@ -27,32 +32,17 @@ Only call functions if required to answer the user's query.
 """
 
 
-def _render_widget(widget: Widget) -> str:
-    widget_str = ""
-    widget_str += (
-        f"uuid: {widget.uuid} <-- use this to retrieve the data for the widget\n"
-    )
-    widget_str += f"name: {widget.name}\n"
-    widget_str += f"description: {widget.description}\n"
-    widget_str += "parameters:\n"
-    for param in widget.params:
-        widget_str += f"  {param.name}={param.current_value}\n"
-    widget_str += "-------\n"
-    return widget_str
-
-
-def render_system_prompt(widget_collection: WidgetCollection | None = None) -> str:
-    widgets_prompt = "# Available Widgets\n\n"
-    # `primary` widgets are widgets that the user has manually selected
-    # and added to the custom agent on OpenBB Workspace.
-    widgets_prompt += "## Primary Widgets (prioritize using these widgets when answering the user's query):\n\n"
-    for widget in widget_collection.primary if widget_collection else []:
-        widgets_prompt += _render_widget(widget)
-
-    # `secondary` widgets are widgets that are on the currently-active dashboard, but
-    # have not been added to the custom agent explicitly by the user.
-    widgets_prompt += "\n## Secondary Widgets (use these widgets if the user's query is not answered by the primary widgets):\n\n"
-    for widget in widget_collection.secondary if widget_collection else []:
-        widgets_prompt += _render_widget(widget)
-
-    return SYSTEM_PROMPT_TEMPLATE.format(widgets_prompt=widgets_prompt)
+# Only the first few secondary widgets are listed, plus the ones most relevant
+# to the user's query (the others can be found with `search_widgets`), and only
+# the first few options of their parameters, so that the prompt stays small on
+# big dashboards.
+_renderer = WidgetPromptRenderer(
+    render_widget=render_widget_with_param_options,
+    max_secondary_widgets=MAX_SECONDARY_WIDGETS,
+)
+
+
+def render_system_prompt(
+    widget_collection: WidgetCollection | None = None, query: str | None = None
+) -> str:
+    return _renderer.render(widget_collection, SYSTEM_PROMPT_TEMPLATE, query=query)
@@ -0,0 +1,170 @@
+"""Compare the latency of `direct_response` against the previous request flow.
+
+The previous flow made a non-streaming completion to detect tool calls
+(sometimes a second one, to recover the tool calls), and then a third,
+streaming completion for the final answer.  `direct_response` now makes one
+streaming completion per step.  Both are run against a local mock
+OpenAI-compatible server that simulates time-to-first-byte and per-chunk
+generation time.
+
+Usage (from this example's directory):
+    python -m benchmarks.bench_direct_response --latency 0.3 --chunk-latency 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from unittest import mock
+
+import httpx
+from common.agent import provider_clients
+from common.testing import MockOpenAIServer, completion_chunk, text_chunks
+from openbb_ai.models import QueryRequest
+
+from portfolio_commentary import main
+
+ANSWER = (
+    "The portfolio outperformed its benchmark this quarter, driven by "
+    "semiconductor exposure, while energy holdings detracted as oil prices "
+    "fell on weaker demand expectations. " * 4
+)
+SEARCH_RESULT = "Oil prices fell 8% over the quarter on weaker demand."
+
+
+def _handler(body: dict) -> list[dict]:
+    if body["model"] == "perplexity/sonar":
+        return text_chunks(SEARCH_RESULT)
+    searched = any(message["role"] == "tool" for message in body["messages"])
+    wants_search = "news" in body["messages"][-1]["content"]
+    if body.get("tools") and wants_search and not searched:
+        arguments = json.dumps({"query": "oil prices this quarter"})
+        return [
+            completion_chunk(
+                {
+                    "role": "assistant",
+                    "tool_calls": [
+                        {
+                            "index": 0,
+                            "id": "call_1",
+                            "type": "function",
+                            "function": {"name": "perplexity_web_search"},
+                        }
+                    ],
+                }
+            ),
+            *(
+                completion_chunk(
+                    {"tool_calls": [{"index": 0, "function": {"arguments": part}}]}
+                )
+                for part in (arguments[:10], arguments[10:])
+            ),
+            completion_chunk({}, finish_reason="tool_calls"),
+        ]
+    return text_chunks(ANSWER)
+
+
+async def _previous_flow(
+    client: httpx.AsyncClient, messages: list[dict], recover_tool_calls: bool
+) -> tuple[float, float]:
+    """Replay the requests of the previous flow, timing the first token and total."""
+    start = time.perf_counter()
+    url = main.OPENROUTER_CHAT_COMPLETIONS_URL
+    tools = [{"type": "function", "function": {"name": "perplexity_web_search"}}]
+    data = {"model": main.COMMENTARY_MODEL, "messages": messages, "tools": tools}
+    result = (await client.post(url, json={**data, "stream": False})).json()
+    message = result["choices"][0]["message"]
+    if "tool_calls" in message:
+        if recover_tool_calls:
+            result = (await client.post(url, json={**data, "stream": False})).json()
+            message = result["choices"][0]["message"]
+        tool_call = message["tool_calls"][0]
+        query = json.loads(tool_call["function"]["arguments"])["query"]
+        search_result = await main.perplexity_web_search(query)
+        messages = [
+            *messages,
+            {"role": "assistant", "content": None, "tool_calls": [tool_call]},
+            {"role": "tool", "tool_call_id": "call_1", "content": search_result},
+        ]
+        final_data = {"model": main.COMMENTARY_MODEL, "messages": messages}
+        first_token = None
+        async with client.stream(
+            "POST", url, json={**final_data, "stream": True}
+        ) as response:
+            async for line in response.aiter_lines():
+                if first_token is None and '"content"' in line:
+                    first_token = time.perf_counter() - start
+        return first_token or 0.0, time.perf_counter() - start
+    # The content is only "streamed" once the whole completion is done.
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+
+async def _direct_response(question: str) -> tuple[float, float]:
+    start = time.perf_counter()
+    request = QueryRequest(messages=[{"role": "human", "content": question}])
+    response = await main.query(request)
+    first_token = None
+    async for event in response.body_iterator:
+        if (
+            first_token is None
+            and event.get("event") == "copilotMessageChunk"
+            and json.loads(event["data"])["delta"]
+        ):
+            first_token = time.perf_counter() - start
+    return first_token or 0.0, time.perf_counter() - start
+
+
+async def main_(latency: float, chunk_latency: float, runs: int) -> None:
+    os.environ.setdefault("OPENROUTER_API_KEY", "test")
+    server = MockOpenAIServer(
+        handler=_handler, latency=latency, chunk_latency=chunk_latency
+    )
+    with (
+        server,
+        mock.patch.object(
+            main,
+            "OPENROUTER_CHAT_COMPLETIONS_URL",
+            f"{server.base_url}/chat/completions",
+        ),
+    ):
+        scenarios = [
+            ("direct answer", "How did the portfolio do?", False),
+            ("web search", "Any news on oil?", False),
+            ("web search, tool calls recovered", "Any news on oil?", True),
+        ]
+        async with httpx.AsyncClient() as client:
+            for name, question, recover_tool_calls in scenarios:
+                messages = [{"role": "user", "content": question}]
+                previous, current = [], []
+                for _ in range(runs):
+                    previous_requests = len(server.requests)
+                    previous.append(
+                        await _previous_flow(client, messages, recover_tool_calls)
+                    )
+                    previous_completions = len(server.requests) - previous_requests
+                    current_requests = len(server.requests)
+                    current.append(await _direct_response(question))
+                    current_completions = len(server.requests) - current_requests
+                for flow, timings, requests in (
+                    ("previous", previous, previous_completions),
+                    ("current", current, current_completions),
+                ):
+                    ttft = statistics.median(timing[0] for timing in timings)
+                    total = statistics.median(timing[1] for timing in timings)
+                    print(
+                        f"{name:>33}, {flow:>8}: {requests} upstream requests, "
+                        f"TTFT {ttft * 1000:6.0f}ms, total {total * 1000:6.0f}ms"
+                    )
+    await provider_clients.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--chunk-latency", type=float, default=0.02)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main_(args.latency, args.chunk_latency, args.runs))
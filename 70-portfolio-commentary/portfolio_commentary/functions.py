@@ -1,5 +1,6 @@
 from typing import AsyncGenerator, Callable
 from common.agent import reasoning_step, get_remote_data, remote_function_call
+from common.widgets import get_widget_index
 from openbb_ai.models import (
     DataContent,
     FunctionCallSSE,
@@ -21,11 +22,7 @@ def get_widget_data(widget_collection: WidgetCollection) -> Callable:
     # argument when the function is defined, and not when it is called by the
     # LLM (since we only want the LLM to specify the widget UUID of the widget
     # that it wants data for).
-    widgets = (
-        widget_collection.primary + widget_collection.secondary
-        if widget_collection
-        else []
-    )
+    widget_index = get_widget_index(widget_collection)
 
     @remote_function_call(
         function="get_widget_data", output_formatter=handle_widget_data
@@ -35,11 +32,8 @@ def get_widget_data(widget_collection: WidgetCollection) -> Callable:
     ) -> AsyncGenerator[FunctionCallSSE | StatusUpdateSSE, None]:
         """Retrieve data for a widget by specifying the widget UUID."""
 
-        # Get the first widget that matches the UUID (there should be only one).
-        matching_widgets = list(
-            filter(lambda widget: str(widget.uuid) == widget_uuid, widgets)
-        )
-        widget = matching_widgets[0] if matching_widgets else None
+        # Look up the widget by its UUID.
+        widget = widget_index.get(widget_uuid)
 
         # If we're unable to find the widget, let's the the user know.
         if not widget:
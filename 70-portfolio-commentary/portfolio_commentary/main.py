@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -19,9 +20,17 @@ from magentic import (
 from sse_starlette.sse import EventSourceResponse
 
 from .prompts import SYSTEM_PROMPT
+from .search_cache import InMemorySearchCacheBackend, SearchCache
 
 from dotenv import load_dotenv
-from common.agent import reasoning_step, remote_function_call, get_remote_data
+from common.agent import (
+    OPENROUTER_BASE_URL,
+    provider_clients,
+    reasoning_step,
+    remote_function_call,
+    get_remote_data,
+)
+from common.widgets import WidgetPromptRenderer, get_widget_index
 from openbb_ai.models import (
     QueryRequest,
     StatusUpdateSSE,
@@ -29,7 +38,6 @@ from openbb_ai.models import (
     FunctionCallSSE,
     FunctionCallSSEData,
     WidgetCollection,
-    Widget,
 )
 import uuid
 
@@ -37,7 +45,22 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv(".env")
-app = FastAPI()
+app = FastAPI(lifespan=provider_clients.lifespan)
+
+OPENROUTER_CHAT_COMPLETIONS_URL = f"{OPENROUTER_BASE_URL}/chat/completions"
+COMMENTARY_MODEL = "deepseek/deepseek-chat-v3-0324"
+# The maximum number of completions (ie. tool-calling steps) per query.
+MAX_COMPLETIONS = 5
+# The maximum number of web searches that run at the same time, per query.
+MAX_CONCURRENT_SEARCHES = 4
+# How long web search results are cached for, in seconds.
+WEB_SEARCH_CACHE_TTL = 300.0
+WEB_SEARCH_CACHE_MAX_ENTRIES = 1024
+
+search_cache = SearchCache(
+    backend=InMemorySearchCacheBackend(max_entries=WEB_SEARCH_CACHE_MAX_ENTRIES),
+    ttl=WEB_SEARCH_CACHE_TTL,
+)
 
 origins = [
     "http://localhost",
@@ -64,17 +87,13 @@ async def root():
         "version": "1.0.0",
         "endpoints": ["/v1/query", "/agents.json"],
         "status": "operational",
+        "web_search_cache": search_cache.stats,
     }
 
 
-# Direct web search function that returns a string
-async def perplexity_web_search(query: str) -> str:
-    """Search the web using Perplexity's API through OpenRouter."""
-    api_key = os.environ.get("OPENROUTER_API_KEY")
-    if not api_key:
-        return "Error: OPENROUTER_API_KEY environment variable is not set"
-
-    url = "https://openrouter.ai/api/v1/chat/completions"
+async def _perplexity_search(query: str) -> str:
+    api_key = os.environ["OPENROUTER_API_KEY"]
+    url = OPENROUTER_CHAT_COMPLETIONS_URL
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
@@ -93,18 +112,85 @@ async def perplexity_web_search(query: str) -> str:
         "stream": False,  # Not using streaming here - will get complete response
     }
 
+    client = provider_clients.http_client()
+    response = await client.post(url, headers=headers, json=data)
+    response.raise_for_status()
+    response_json = response.json()
+    return response_json["choices"][0]["message"]["content"]
+
+
+# Direct web search function that returns a string
+async def perplexity_web_search(query: str) -> str:
+    """Search the web using Perplexity's API through OpenRouter."""
+    if not os.environ.get("OPENROUTER_API_KEY"):
+        return "Error: OPENROUTER_API_KEY environment variable is not set"
+
+    # Identical searches (eg. during market events) share one upstream call.
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=data)
-            response.raise_for_status()
-            response_json = response.json()
-            return response_json["choices"][0]["message"]["content"]
+        return await search_cache.get_or_fetch(query, _perplexity_search)
     except Exception as e:
         error_message = f"Error searching the web: {str(e)}"
         logger.error(error_message)
         return error_message
 
 
+async def stream_chat_completion(
+    client: httpx.AsyncClient, headers: dict, data: dict
+) -> AsyncGenerator[str | list[dict] | dict, None]:
+    """Stream a chat completion, yielding content deltas as they arrive.
+
+    Tool call deltas are accumulated per index, and the complete tool calls
+    (if any) are yielded as a list once the stream has finished.  Any other
+    events (eg. warnings) are yielded as dicts.
+    """
+    tool_calls: dict[int, dict] = {}
+    async with client.stream(
+        "POST",
+        OPENROUTER_CHAT_COMPLETIONS_URL,
+        headers=headers,
+        json={**data, "stream": True},
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line or not line.startswith("data: "):
+                continue
+
+            line = line[6:].strip()
+            if line == "[DONE]":
+                break
+
+            try:
+                chunk = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"JSON decode error: {e} for line: {line}")
+                yield reasoning_step(
+                    event_type="WARNING",
+                    message="Encountered an issue processing part of the response.",
+                    details={"error_type": "JSON decode error"},
+                ).model_dump()
+                continue
+
+            delta = (chunk.get("choices") or [{}])[0].get("delta") or {}
+            if content := delta.get("content"):
+                yield content
+            for tool_call in delta.get("tool_calls") or []:
+                accumulated = tool_calls.setdefault(
+                    tool_call.get("index", 0),
+                    {
+                        "id": "",
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""},
+                    },
+                )
+                accumulated["id"] = tool_call.get("id") or accumulated["id"]
+                function = tool_call.get("function") or {}
+                accumulated["function"]["name"] += function.get("name") or ""
+                accumulated["function"]["arguments"] += function.get("arguments") or ""
+
+    if tool_calls:
+        yield [tool_calls[index] for index in sorted(tool_calls)]
+
+
 # Custom patched version of run_agent that properly handles our perplexity_web_search function
 async def custom_run_agent(
     chat: Chat, max_completions: int = 10
@@ -251,12 +337,8 @@ async def handle_widget_data(data: list[DataContent]) -> str:
 
 # Function to create the widget data retrieval function
 def get_widget_data(widget_collection: WidgetCollection) -> Callable:
-    # Combine primary and secondary widgets
-    widgets = (
-        widget_collection.primary + widget_collection.secondary
-        if widget_collection
-        else []
-    )
+    # Index primary and secondary widgets by UUID
+    widget_index = get_widget_index(widget_collection)
 
     @remote_function_call(
         function="get_widget_data", output_formatter=handle_widget_data
@@ -267,10 +349,7 @@ def get_widget_data(widget_collection: WidgetCollection) -> Callable:
         """Retrieve data for a widget by specifying the widget UUID."""
 
         # Find the widget that matches the UUID
-        matching_widgets = list(
-            filter(lambda widget: str(widget.uuid) == widget_uuid, widgets)
-        )
-        widget = matching_widgets[0] if matching_widgets else None
+        widget = widget_index.get(widget_uuid)
 
         # If we can't find the widget, report an error
         if not widget:
@@ -301,43 +380,21 @@ def get_widget_data(widget_collection: WidgetCollection) -> Callable:
     return _get_widget_data
 
 
-# Generate a system prompt that includes widget information
-def render_system_prompt(widget_collection: WidgetCollection | None = None) -> str:
-    from .prompts import SYSTEM_PROMPT  # Import the base system prompt
-
-    widgets_prompt = "# Available Widgets\n\n"
-
-    # Primary widgets section
-    widgets_prompt += "## Primary Widgets (prioritize using these):\n\n"
-    for widget in widget_collection.primary if widget_collection else []:
-        widgets_prompt += _render_widget(widget)
-
-    # Secondary widgets section
-    widgets_prompt += "\n## Secondary Widgets:\n\n"
-    for widget in widget_collection.secondary if widget_collection else []:
-        widgets_prompt += _render_widget(widget)
-
-    # Append widget information to system prompt
-    complete_prompt = f"{SYSTEM_PROMPT}\n\nYou can use the following functions to help you answer the user's query:\n"
-    complete_prompt += "- get_widget_data(widget_uuid: str) -> str: Get the data for a widget by specifying its UUID.\n\n"
-    complete_prompt += widgets_prompt
-
-    return complete_prompt
+# Renders the widgets into the system prompt.
+_widget_prompt_renderer = WidgetPromptRenderer(
+    primary_heading="## Primary Widgets (prioritize using these):\n\n",
+    secondary_heading="\n## Secondary Widgets:\n\n",
+)
+SYSTEM_PROMPT_TEMPLATE = (
+    f"{SYSTEM_PROMPT}\n\nYou can use the following functions to help you answer the user's query:\n"
+    "- get_widget_data(widget_uuid: str) -> str: Get the data for a widget by specifying its UUID.\n\n"
+    "{widgets_prompt}"
+)
 
 
-# Helper function to format widget information
-def _render_widget(widget: Widget) -> str:
-    widget_str = ""
-    widget_str += (
-        f"uuid: {widget.uuid} <-- use this to retrieve the data for the widget\n"
-    )
-    widget_str += f"name: {widget.name}\n"
-    widget_str += f"description: {widget.description}\n"
-    widget_str += "parameters:\n"
-    for param in widget.params:
-        widget_str += f"  {param.name}={param.current_value}\n"
-    widget_str += "-------\n"
-    return widget_str
+# Generate a system prompt that includes widget information
+def render_system_prompt(widget_collection: WidgetCollection | None = None) -> str:
+    return _widget_prompt_renderer.render(widget_collection, SYSTEM_PROMPT_TEMPLATE)
 
 
 @app.post("/v1/query")
@@ -359,6 +416,20 @@ async def query(request: QueryRequest) -> EventSourceResponse:
                         # Just skip function call messages, as they'll be handled by the result
                         pass
                 elif message.role == "tool" and message.function == "get_widget_data":
+                    # Web searches that ran in the same batch as the widget
+                    # data request come back with the widget data.
+                    search_results = message.extra_state.get("web_search_results")
+                    if search_results:
+                        search_str = "".join(
+                            f"--- {result['query']} ---\n{result['content']}\n"
+                            for result in search_results
+                        )
+                        chat_messages.append(
+                            UserMessage(
+                                content=f"Web search results retrieved: \n{search_str}"
+                            )
+                        )
+
                     # For get_widget_data results, we'll format them directly
                     result_str = "--- Widget Data ---\n"
                     for content in message.data:
@@ -557,7 +628,6 @@ async def query(request: QueryRequest) -> EventSourceResponse:
                 }
                 return
 
-            url = "https://openrouter.ai/api/v1/chat/completions"
             headers = {
                 "Authorization": f"Bearer {api_key}",
                 "Content-Type": "application/json",
@@ -571,389 +641,296 @@ async def query(request: QueryRequest) -> EventSourceResponse:
                 message="Analyzing your query and determining the best approach...",
             ).model_dump()
 
-            # Start with non-streaming call to detect tool calls
-            data = {
-                "model": "deepseek/deepseek-chat-v3-0324",
-                "messages": formatted_messages,
-                "stream": False,  # Start with non-streaming
-                "tools": tools,
-                "tool_choice": "auto",
-            }
+            client = provider_clients.http_client()
+            # The web searches of every step, which are sent along with a widget
+            # data request so that the next request still has them.
+            search_results: list[dict] = []
+            # One streaming completion per step: text is streamed straight
+            # through, and tool calls are picked up as the stream goes.
+            for completion in range(MAX_COMPLETIONS):
+                data = {"model": COMMENTARY_MODEL, "messages": formatted_messages}
+                # Don't offer any tools on the last step, so that we get an answer.
+                if completion < MAX_COMPLETIONS - 1:
+                    data |= {"tools": tools, "tool_choice": "auto"}
+
+                logger.info(
+                    f"Making streaming request with messages: {formatted_messages}"
+                )
+                tool_calls: list[dict] = []
+                streamed_content = False
+                async for delta in stream_chat_completion(client, headers, data):
+                    if isinstance(delta, str):
+                        streamed_content = True
+                        yield {
+                            "event": "copilotMessageChunk",
+                            "data": json.dumps({"delta": delta}),
+                        }
+                    elif isinstance(delta, list):
+                        tool_calls = delta
+                    else:
+                        yield delta
+
+                if not tool_calls:
+                    if not streamed_content:
+                        logger.warning("No content to stream in the response")
+                        yield reasoning_step(
+                            event_type="WARNING",
+                            message="The model didn't generate any content for your query.",
+                        ).model_dump()
+                        yield {
+                            "event": "error",
+                            "data": json.dumps(
+                                {"message": "No content received from model"}
+                            ),
+                        }
+                        return
+
+                    # Signal end of response
+                    yield {
+                        "event": "copilotMessageChunk",
+                        "data": json.dumps({"delta": ""}),
+                    }
+                    return
+
+                logger.info(f"Tool calls detected: {tool_calls}")
+                yield reasoning_step(
+                    event_type="INFO",
+                    message="I need to search for information to answer your question properly.",
+                ).model_dump()
+
+                search_calls = [
+                    tool_call
+                    for tool_call in tool_calls
+                    if tool_call["function"]["name"] == "perplexity_web_search"
+                ]
+                widget_calls = [
+                    tool_call
+                    for tool_call in tool_calls
+                    if tool_call["function"]["name"] == "get_widget_data"
+                ]
+                if not search_calls and not widget_calls:
+                    logger.warning(f"No supported tool calls in: {tool_calls}")
+                    yield {
+                        "event": "error",
+                        "data": json.dumps(
+                            {"message": "Unsupported tool call from model"}
+                        ),
+                    }
+                    return
+
+                # Run every web search in the batch concurrently.
+                step_results: list[dict] = []
+                if search_calls:
+                    try:
+                        queries = [
+                            json.loads(tool_call["function"]["arguments"]).get(
+                                "query", ""
+                            )
+                            for tool_call in search_calls
+                        ]
+                        logger.info(f"Extracted queries: {queries}")
+
+                        # Inform user we're searching
+                        for query in queries:
+                            yield reasoning_step(
+                                event_type="INFO",
+                                message=f"Searching the web for: {query}",
+                                details={"search_query": query},
+                            ).model_dump()
+
+                        # Call perplexity
+                        yield reasoning_step(
+                            event_type="INFO",
+                            message="Connecting to search service and retrieving results...",
+                        ).model_dump()
+
+                        semaphore = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
+
+                        async def search(query: str) -> str:
+                            async with semaphore:
+                                return await perplexity_web_search(query)
+
+                        results = await asyncio.gather(
+                            *(search(query) for query in queries)
+                        )
+                        step_results = [
+                            {"query": query, "content": result}
+                            for query, result in zip(queries, results)
+                        ]
+                        search_results += step_results
+                        logger.info(f"Search results: {[r[:100] for r in results]}")
+
+                        yield reasoning_step(
+                            event_type="INFO",
+                            message="Search completed successfully, processing results.",
+                            details={
+                                "result_lengths": [len(result) for result in results]
+                            },
+                        ).model_dump()
+
+                    except Exception as e:
+                        logger.error(
+                            f"Error processing web search: {str(e)}",
+                            exc_info=True,
+                        )
+                        yield reasoning_step(
+                            event_type="ERROR",
+                            message="Error occurred while searching the web.",
+                            details={"error": str(e)},
+                        ).model_dump()
+                        yield {
+                            "event": "error",
+                            "data": json.dumps(
+                                {"message": f"Error with web search: {str(e)}"}
+                            ),
+                        }
+                        return
+
+                if not widget_calls:
+                    # Add the results to messages, one tool message per search.
+                    formatted_messages = [
+                        *formatted_messages,
+                        {
+                            "role": "assistant",
+                            "content": None,
+                            "tool_calls": [
+                                {
+                                    "id": tool_call["id"],
+                                    "type": "function",
+                                    "function": {
+                                        "name": "perplexity_web_search",
+                                        "arguments": json.dumps(
+                                            {"query": search_result["query"]}
+                                        ),
+                                    },
+                                }
+                                for tool_call, search_result in zip(
+                                    search_calls, step_results
+                                )
+                            ],
+                        },
+                        *(
+                            {
+                                "role": "tool",
+                                "tool_call_id": tool_call["id"],
+                                "content": search_result["content"],
+                            }
+                            for tool_call, search_result in zip(
+                                search_calls, step_results
+                            )
+                        ),
+                    ]
 
-            logger.info(
-                f"Making initial request to detect tool calls with messages: {formatted_messages}"
-            )
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=headers, json=data)
-                response.raise_for_status()
-                result = response.json()
-                logger.info(f"Initial response: {result}")
-
-                # Check for tool calls
-                choices = result.get("choices", [])
-                finish_reason = choices[0].get("finish_reason") if choices else None
-
-                # Check if there are tool calls indicated by finish_reason
-                if choices and (
-                    finish_reason == "tool_calls"
-                    or "tool_calls" in choices[0].get("message", {})
-                ):
-                    # If finish_reason is tool_calls but no tool_calls in message,
-                    # we need to make another request to get the tool call information
                     yield reasoning_step(
                         event_type="INFO",
-                        message="I need to search for information to answer your question properly.",
+                        message="Retrieved information from the web, now formulating a response.",
                     ).model_dump()
+                    # On to the next completion, with the search results.
+                    continue
 
-                    if finish_reason == "tool_calls" and "tool_calls" not in choices[
-                        0
-                    ].get("message", {}):
-                        # Request with stream=False and respond_to_tool_calls=true to get tool calls
-                        tool_data = {
-                            "model": "deepseek/deepseek-chat-v3-0324",
-                            "messages": formatted_messages,
-                            "stream": False,
-                            "tools": tools,
-                            "tool_choice": "auto",
-                        }
-                        logger.info("Making follow-up request to get tool call details")
-                        tool_response = await client.post(
-                            url, headers=headers, json=tool_data
+                # Handle widget data retrieval: every widget requested in the
+                # batch is fetched in a single function call to the front-end.
+                try:
+                    widget_uuids = [
+                        json.loads(tool_call["function"]["arguments"]).get(
+                            "widget_uuid", ""
                         )
-                        tool_response.raise_for_status()
-                        tool_result = tool_response.json()
-                        logger.info(f"Tool call response: {tool_result}")
+                        for tool_call in widget_calls
+                    ]
+                    logger.info(f"Retrieving data for widget UUIDs: {widget_uuids}")
+
+                    # Find the requested widgets
+                    if not request.widgets:
+                        yield reasoning_step(
+                            event_type="ERROR",
+                            message="No widgets available to retrieve data from.",
+                            details={"widget_uuids": widget_uuids},
+                        ).model_dump()
+                        yield {
+                            "event": "error",
+                            "data": json.dumps({"message": "No widgets available"}),
+                        }
+                        return
 
-                        if "tool_calls" in tool_result.get("choices", [{}])[0].get(
-                            "message", {}
-                        ):
-                            tool_calls = tool_result["choices"][0]["message"][
-                                "tool_calls"
-                            ]
-                            logger.info(f"Tool calls detected: {tool_calls}")
+                    widget_index = get_widget_index(request)
 
+                    data_sources = []
+                    for widget_uuid in dict.fromkeys(widget_uuids):
+                        widget = widget_index.get(widget_uuid)
+                        if not widget:
                             yield reasoning_step(
-                                event_type="INFO",
-                                message="Found relevant information sources to check.",
+                                event_type="ERROR",
+                                message=f"Widget with UUID {widget_uuid} not found",
+                                details={"widget_uuid": widget_uuid},
                             ).model_dump()
-                        else:
-                            logger.warning(
-                                "Couldn't retrieve tool calls even after follow-up request"
-                            )
-                            # Fall back to regular content streaming
                             yield {
-                                "event": "copilotMessageChunk",
+                                "event": "error",
                                 "data": json.dumps(
                                     {
-                                        "delta": "I couldn't retrieve the information you requested. Please try asking your question differently."
+                                        "message": f"Widget with UUID {widget_uuid} not found"
                                     }
                                 ),
                             }
-                            yield {
-                                "event": "copilotMessageChunk",
-                                "data": json.dumps({"delta": ""}),
-                            }
                             return
-                    else:
-                        tool_calls = choices[0]["message"]["tool_calls"]
-                        logger.info(f"Tool calls detected: {tool_calls}")
-
-                    # Process each tool call
-                    for tool_call in tool_calls:
-                        if tool_call["function"]["name"] == "perplexity_web_search":
-                            try:
-                                # Extract query
-                                args = json.loads(tool_call["function"]["arguments"])
-                                query = args.get("query", "")
-                                logger.info(f"Extracted query: {query}")
-
-                                # Inform user we're searching
-                                yield reasoning_step(
-                                    event_type="INFO",
-                                    message=f"Searching the web for: {query}",
-                                    details={"search_query": query},
-                                ).model_dump()
-
-                                # Call perplexity
-                                yield reasoning_step(
-                                    event_type="INFO",
-                                    message="Connecting to search service and retrieving results...",
-                                ).model_dump()
-
-                                search_result = await perplexity_web_search(query)
-                                logger.info(f"Search result: {search_result[:100]}...")
-
-                                yield reasoning_step(
-                                    event_type="INFO",
-                                    message="Search completed successfully, processing results.",
-                                    details={"result_length": len(search_result)},
-                                ).model_dump()
-
-                                # Add result to messages
-                                new_messages = formatted_messages.copy()
-                                new_messages.append(
-                                    {
-                                        "role": "assistant",
-                                        "content": None,
-                                        "tool_calls": [
-                                            {
-                                                "id": tool_call["id"],
-                                                "type": "function",
-                                                "function": {
-                                                    "name": "perplexity_web_search",
-                                                    "arguments": json.dumps(
-                                                        {"query": query}
-                                                    ),
-                                                },
-                                            }
-                                        ],
-                                    }
-                                )
-                                new_messages.append(
-                                    {
-                                        "role": "tool",
-                                        "tool_call_id": tool_call["id"],
-                                        "content": search_result,
-                                    }
-                                )
-
-                                # Get final response with streaming
-                                final_data = {
-                                    "model": "deepseek/deepseek-chat-v3-0324",
-                                    "messages": new_messages,
-                                    "stream": True,
-                                }
-
-                                yield reasoning_step(
-                                    event_type="INFO",
-                                    message="Retrieved information from the web, now formulating a response.",
-                                ).model_dump()
-
-                                logger.info(
-                                    f"Making final streaming request with messages: {new_messages}"
-                                )
-                                async with client.stream(
-                                    "POST", url, headers=headers, json=final_data
-                                ) as stream_response:
-                                    stream_response.raise_for_status()
-
-                                    async for line in stream_response.aiter_lines():
-                                        if not line or not line.startswith("data: "):
-                                            continue
-
-                                        line = line[6:].strip()
-                                        if line == "[DONE]":
-                                            break
-
-                                        try:
-                                            chunk = json.loads(line)
-                                            content = (
-                                                chunk.get("choices", [{}])[0]
-                                                .get("delta", {})
-                                                .get("content")
-                                            )
-
-                                            if content:  # Simplified check, empty strings are falsy
-                                                yield {
-                                                    "event": "copilotMessageChunk",
-                                                    "data": json.dumps(
-                                                        {"delta": content}
-                                                    ),
-                                                }
-                                        except json.JSONDecodeError as e:
-                                            logger.error(
-                                                f"JSON decode error: {e} for line: {line}"
-                                            )
-                                            yield reasoning_step(
-                                                event_type="WARNING",
-                                                message="Encountered an issue processing part of the response.",
-                                                details={
-                                                    "error_type": "JSON decode error"
-                                                },
-                                            ).model_dump()
-                                            continue
-
-                                # Signal end of response
-                                yield {
-                                    "event": "copilotMessageChunk",
-                                    "data": json.dumps({"delta": ""}),
-                                }
-                                return  # Important to return here to prevent falling through
-
-                            except Exception as e:
-                                logger.error(
-                                    f"Error processing web search: {str(e)}",
-                                    exc_info=True,
-                                )
-                                yield reasoning_step(
-                                    event_type="ERROR",
-                                    message="Error occurred while searching the web.",
-                                    details={"error": str(e)},
-                                ).model_dump()
-                                yield {
-                                    "event": "error",
-                                    "data": json.dumps(
-                                        {"message": f"Error with web search: {str(e)}"}
-                                    ),
-                                }
-                                return
-
-                        # Handle widget data retrieval if it's a get_widget_data tool call
-                        elif tool_call["function"]["name"] == "get_widget_data":
-                            try:
-                                # Extract widget UUID
-                                args = json.loads(tool_call["function"]["arguments"])
-                                widget_uuid = args.get("widget_uuid", "")
-                                logger.info(
-                                    f"Retrieving data for widget UUID: {widget_uuid}"
-                                )
-
-                                # Find the requested widget
-                                if not request.widgets:
-                                    yield reasoning_step(
-                                        event_type="ERROR",
-                                        message="No widgets available to retrieve data from.",
-                                        details={"widget_uuid": widget_uuid},
-                                    ).model_dump()
-                                    yield {
-                                        "event": "error",
-                                        "data": json.dumps(
-                                            {"message": "No widgets available"}
-                                        ),
-                                    }
-                                    return
-
-                                all_widgets = []
-                                if request.widgets.primary:
-                                    all_widgets.extend(request.widgets.primary)
-                                if request.widgets.secondary:
-                                    all_widgets.extend(request.widgets.secondary)
-
-                                matching_widgets = list(
-                                    filter(
-                                        lambda widget: str(widget.uuid) == widget_uuid,
-                                        all_widgets,
-                                    )
-                                )
-                                widget = (
-                                    matching_widgets[0] if matching_widgets else None
-                                )
 
-                                if not widget:
-                                    yield reasoning_step(
-                                        event_type="ERROR",
-                                        message=f"Widget with UUID {widget_uuid} not found",
-                                        details={"widget_uuid": widget_uuid},
-                                    ).model_dump()
-                                    yield {
-                                        "event": "error",
-                                        "data": json.dumps(
-                                            {
-                                                "message": f"Widget with UUID {widget_uuid} not found"
-                                            }
-                                        ),
-                                    }
-                                    return
-
-                                # Inform user we're retrieving widget data
-                                yield reasoning_step(
-                                    event_type="INFO",
-                                    message=f"Retrieving data for widget: {widget.name}",
-                                    details={
-                                        "widget_uuid": widget_uuid,
-                                        "widget_name": widget.name,
-                                    },
-                                ).model_dump()
-
-                                # Create a FunctionCallSSE object to request the data from the frontend
-                                widget_data_request = FunctionCallSSE(
-                                    event="copilotFunctionCall",
-                                    data=FunctionCallSSEData(
-                                        function="get_widget_data",
-                                        input_arguments={
-                                            "data_sources": [
-                                                {
-                                                    "origin": widget.origin,
-                                                    "id": widget.widget_id,
-                                                    "input_args": {
-                                                        param.name: param.current_value
-                                                        for param in widget.params
-                                                    },
-                                                }
-                                            ]
-                                        },
-                                        extra_state={
-                                            "copilot_function_call_arguments": {
-                                                "widget_uuid": widget_uuid
-                                            }
-                                        },
-                                    ),
-                                )
-
-                                yield widget_data_request.model_dump()
-                                return  # Must return here to allow the frontend to handle the request
+                        # Inform user we're retrieving widget data
+                        yield reasoning_step(
+                            event_type="INFO",
+                            message=f"Retrieving data for widget: {widget.name}",
+                            details={
+                                "widget_uuid": widget_uuid,
+                                "widget_name": widget.name,
+                            },
+                        ).model_dump()
+                        data_sources.append(
+                            {
+                                "origin": widget.origin,
+                                "id": widget.widget_id,
+                                "input_args": {
+                                    param.name: param.current_value
+                                    for param in widget.params
+                                },
+                            }
+                        )
 
-                            except Exception as e:
-                                logger.error(
-                                    f"Error processing widget data request: {str(e)}",
-                                    exc_info=True,
-                                )
-                                yield reasoning_step(
-                                    event_type="ERROR",
-                                    message="Error occurred while retrieving widget data.",
-                                    details={"error": str(e)},
-                                ).model_dump()
-                                yield {
-                                    "event": "error",
-                                    "data": json.dumps(
-                                        {"message": f"Error with widget data: {str(e)}"}
-                                    ),
-                                }
-                                return
-
-                # No tool calls detected, just stream the normal response
-                content = ""
-                if choices:
-                    content = choices[0].get("message", {}).get("content", "")
-                    logger.info(
-                        f"No tool calls, streaming regular content: {content[:100]}..."
+                    # Create a FunctionCallSSE object to request the data from
+                    # the frontend.  The web search results of this request so
+                    # far are passed along, so that they aren't lost.
+                    widget_data_request = FunctionCallSSE(
+                        event="copilotFunctionCall",
+                        data=FunctionCallSSEData(
+                            function="get_widget_data",
+                            input_arguments={"data_sources": data_sources},
+                            extra_state={
+                                "copilot_function_call_arguments": {
+                                    "widget_uuids": list(dict.fromkeys(widget_uuids))
+                                },
+                                "web_search_results": search_results,
+                            },
+                        ),
                     )
 
-                    yield reasoning_step(
-                        event_type="INFO",
-                        message="Found the answer directly without needing to search external sources.",
-                    ).model_dump()
+                    yield widget_data_request.model_dump()
+                    return  # Must return here to allow the frontend to handle the request
 
-                # Stream the content in small chunks to simulate streaming
-                if not content:
-                    logger.warning("No content to stream in the response")
+                except Exception as e:
+                    logger.error(
+                        f"Error processing widget data request: {str(e)}",
+                        exc_info=True,
+                    )
                     yield reasoning_step(
-                        event_type="WARNING",
-                        message="The model didn't generate any content for your query.",
+                        event_type="ERROR",
+                        message="Error occurred while retrieving widget data.",
+                        details={"error": str(e)},
                     ).model_dump()
                     yield {
                         "event": "error",
                         "data": json.dumps(
-                            {"message": "No content received from model"}
+                            {"message": f"Error with widget data: {str(e)}"}
                         ),
                     }
                     return
 
-                # Stream in larger chunks for better performance
-                chunk_size = 500  # Larger chunks for faster streaming
-                for i in range(0, len(content), chunk_size):
-                    chunk = content[i : i + chunk_size]
-                    yield {
-                        "event": "copilotMessageChunk",
-                        "data": json.dumps({"delta": chunk}),
-                    }
-
-                # Signal end of response
-                yield {
-                    "event": "copilotMessageChunk",
-                    "data": json.dumps({"delta": ""}),
-                }
-
         except Exception as e:
             logger.error(f"Error in direct_response: {str(e)}", exc_info=True)
             yield reasoning_step(
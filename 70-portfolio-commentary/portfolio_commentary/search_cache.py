@@ -0,0 +1,105 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Protocol
+
+
+class SearchCacheBackend(Protocol):
+    """Where cached search results are stored (eg. in memory, or in Redis)."""
+
+    async def get(self, key: str) -> str | None: ...
+
+    async def set(self, key: str, value: str, ttl: float) -> None: ...
+
+    async def clear(self) -> None: ...
+
+
+class InMemorySearchCacheBackend:
+    """A bounded, in-process LRU cache with per-entry expiry."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    async def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SearchCache:
+    """A TTL cache of search results, keyed by normalized query.
+
+    Concurrent searches for the same (normalized) query are coalesced, so that
+    only one of them calls upstream and the others wait for its result.
+    Failed searches are not cached.
+    """
+
+    def __init__(self, backend: SearchCacheBackend | None = None, ttl: float = 300.0):
+        self.backend = backend or InMemorySearchCacheBackend()
+        self.ttl = ttl
+        self._in_flight: dict[str, asyncio.Future[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Lowercase, collapse whitespace and drop trailing punctuation."""
+        return re.sub(r"\s+", " ", query).strip().lower().rstrip("?!. ")
+
+    async def get_or_fetch(
+        self, query: str, fetch: Callable[[str], Awaitable[str]]
+    ) -> str:
+        key = self.normalize_query(query)
+        if (result := await self.backend.get(key)) is not None:
+            self.hits += 1
+            return result
+
+        if (in_flight := self._in_flight.get(key)) is not None:
+            self.coalesced += 1
+            # Shielded, so that a caller going away doesn't cancel the search
+            # for everyone else that is waiting on it.
+            return await asyncio.shield(in_flight)
+
+        self.misses += 1
+        task = asyncio.ensure_future(self._fetch_and_store(key, query, fetch))
+        self._in_flight[key] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_and_store(
+        self, key: str, query: str, fetch: Callable[[str], Awaitable[str]]
+    ) -> str:
+        result = await fetch(query)
+        await self.backend.set(key, result, self.ttl)
+        return result
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
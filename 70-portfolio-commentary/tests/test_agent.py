@@ -0,0 +1,303 @@
+import json
+
+import pytest
+from common.agent import provider_clients
+from common.testing import MockOpenAIServer, completion_chunk, text_chunks
+from openbb_ai.models import QueryRequest, Widget
+
+from portfolio_commentary import main
+from portfolio_commentary.search_cache import SearchCache
+
+ANSWER = "The portfolio outperformed its benchmark this quarter."
+
+
+@pytest.fixture(autouse=True)
+def reset_sse_starlette_appstatus_event():
+    """
+    Fixture that resets the appstatus event in the sse_starlette app.
+    Should be used on any test that uses sse_starlette to stream events.
+    """
+    # See https://github.com/sysid/sse-starlette/issues/59
+    from sse_starlette.sse import AppStatus
+
+    AppStatus.should_exit_event = None
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    """A mock OpenRouter, whose responses can be set with `llm.handler`."""
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test")
+    monkeypatch.setattr(main, "search_cache", SearchCache())
+    with MockOpenAIServer() as server:
+        monkeypatch.setattr(
+            main,
+            "OPENROUTER_CHAT_COMPLETIONS_URL",
+            f"{server.base_url}/chat/completions",
+        )
+        yield server
+
+
+def tool_call_chunks(*tool_calls: tuple[str, dict]) -> list[dict]:
+    """Stream tool calls, with their arguments split across several chunks."""
+    chunks = [
+        completion_chunk(
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        "index": index,
+                        "id": f"call_{index}",
+                        "type": "function",
+                        "function": {"name": name, "arguments": ""},
+                    }
+                    for index, (name, _) in enumerate(tool_calls)
+                ],
+            }
+        )
+    ]
+    arguments = [json.dumps(arguments) for _, arguments in tool_calls]
+    for start in range(0, max(map(len, arguments)), 7):
+        chunks.append(
+            completion_chunk(
+                {
+                    "tool_calls": [
+                        {"index": index, "function": {"arguments": part}}
+                        for index, argument in enumerate(arguments)
+                        if (part := argument[start : start + 7])
+                    ]
+                }
+            )
+        )
+    chunks.append(completion_chunk({}, finish_reason="tool_calls"))
+    return chunks
+
+
+async def run_query(messages: list[dict], widgets: dict | None = None) -> list[dict]:
+    request = QueryRequest(
+        messages=messages, **({"widgets": widgets} if widgets else {})
+    )
+    response = await main.query(request)
+    events = [event async for event in response.body_iterator]
+    await provider_clients.aclose()
+    return events
+
+
+def streamed_text(events: list[dict]) -> str:
+    return "".join(
+        json.loads(event["data"])["delta"]
+        for event in events
+        if event.get("event") == "copilotMessageChunk"
+    )
+
+
+def completions(llm: MockOpenAIServer) -> list[dict]:
+    return [body for body in llm.requests if body["model"] == main.COMMENTARY_MODEL]
+
+
+@pytest.mark.asyncio
+async def test_direct_answers_are_streamed_from_a_single_completion(llm):
+    llm.handler = lambda body: text_chunks(ANSWER)
+
+    events = await run_query([{"role": "human", "content": "How did we do?"}])
+
+    assert streamed_text(events) == ANSWER
+    # Streamed as it arrives, and then terminated with an empty delta.
+    deltas = [
+        json.loads(event["data"])["delta"]
+        for event in events
+        if event.get("event") == "copilotMessageChunk"
+    ]
+    assert len(deltas) > 2
+    assert deltas[-1] == ""
+    assert len(llm.requests) == 1
+    assert llm.requests[0]["stream"] is True
+    assert "perplexity_web_search" in [
+        tool["function"]["name"] for tool in llm.requests[0]["tools"]
+    ]
+
+
+@pytest.mark.asyncio
+async def test_web_search_results_are_sent_back_in_the_next_completion(llm):
+    def handler(body: dict) -> list[dict]:
+        if body["model"] == "perplexity/sonar":
+            return text_chunks("Oil fell 8% this quarter.")
+        if body["messages"][-1]["role"] == "tool":
+            return text_chunks(ANSWER)
+        return tool_call_chunks(("perplexity_web_search", {"query": "oil prices"}))
+
+    llm.handler = handler
+
+    events = await run_query([{"role": "human", "content": "Any news on oil?"}])
+
+    assert streamed_text(events) == ANSWER
+    first, second = completions(llm)
+    assert second["messages"][-2]["tool_calls"][0]["id"] == "call_0"
+    assert second["messages"][-1] == {
+        "role": "tool",
+        "tool_call_id": "call_0",
+        "content": "Oil fell 8% this quarter.",
+    }
+    # One streaming completion per step, and the search itself.
+    assert len(llm.requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_every_web_search_in_a_batch_is_run(llm):
+    def handler(body: dict) -> list[dict]:
+        if body["model"] == "perplexity/sonar":
+            return text_chunks(f"Results for {body['messages'][-1]['content']}.")
+        if body["messages"][-1]["role"] == "tool":
+            return text_chunks(ANSWER)
+        # Two tool calls, streamed at the same time.
+        return tool_call_chunks(
+            ("perplexity_web_search", {"query": "oil prices"}),
+            ("perplexity_web_search", {"query": "chip stocks"}),
+        )
+
+    llm.handler = handler
+
+    events = await run_query([{"role": "human", "content": "What moved markets?"}])
+
+    assert streamed_text(events) == ANSWER
+    _, second = completions(llm)
+    assert [
+        json.loads(tool_call["function"]["arguments"])
+        for tool_call in second["messages"][-3]["tool_calls"]
+    ] == [{"query": "oil prices"}, {"query": "chip stocks"}]
+    assert second["messages"][-2:] == [
+        {
+            "role": "tool",
+            "tool_call_id": "call_0",
+            "content": "Results for oil prices.",
+        },
+        {
+            "role": "tool",
+            "tool_call_id": "call_1",
+            "content": "Results for chip stocks.",
+        },
+    ]
+
+
+@pytest.mark.asyncio
+async def test_widget_calls_are_folded_into_one_function_call(llm):
+    widgets = [
+        Widget(
+            origin="openbb",
+            widget_id=f"holdings_{i}",
+            name=f"Holdings {i}",
+            description="Portfolio holdings.",
+            params=[],
+            metadata={},
+        )
+        for i in range(2)
+    ]
+
+    def handler(body: dict) -> list[dict]:
+        if body["model"] == "perplexity/sonar":
+            return text_chunks("Oil fell 8% this quarter.")
+        if "Widget data retrieved" in body["messages"][-1]["content"]:
+            return text_chunks(ANSWER)
+        return tool_call_chunks(
+            ("get_widget_data", {"widget_uuid": str(widgets[0].uuid)}),
+            ("perplexity_web_search", {"query": "oil prices"}),
+            ("get_widget_data", {"widget_uuid": str(widgets[1].uuid)}),
+            ("get_widget_data", {"widget_uuid": str(widgets[0].uuid)}),
+        )
+
+    llm.handler = handler
+    messages = [{"role": "human", "content": "Write the commentary."}]
+
+    events = await run_query(messages, widgets={"primary": widgets})
+
+    function_calls = [
+        event for event in events if event.get("event") == "copilotFunctionCall"
+    ]
+    assert len(function_calls) == 1
+    function_call = json.loads(function_calls[0]["data"])
+    assert [
+        data_source["id"]
+        for data_source in function_call["input_arguments"]["data_sources"]
+    ] == ["holdings_0", "holdings_1"]
+    # The web search from the same batch travels with the function call.
+    assert function_call["extra_state"]["web_search_results"] == [
+        {"query": "oil prices", "content": "Oil fell 8% this quarter."}
+    ]
+
+    # When the data comes back, so do the search results.
+    messages.append(
+        {
+            "role": "tool",
+            "function": "get_widget_data",
+            "input_arguments": function_call["input_arguments"],
+            "data": [{"items": [{"content": f"holdings {i}"}]} for i in range(2)],
+            "extra_state": function_call["extra_state"],
+        }
+    )
+    events = await run_query(messages, widgets={"primary": widgets})
+
+    assert streamed_text(events) == ANSWER
+    contents = [message["content"] for message in completions(llm)[-1]["messages"]]
+    assert "Oil fell 8% this quarter." in contents[-2]
+    assert "holdings 0" in contents[-1]
+    assert "holdings 1" in contents[-1]
+
+
+@pytest.mark.asyncio
+async def test_earlier_web_searches_travel_with_the_function_call(llm):
+    widget = Widget(
+        origin="openbb",
+        widget_id="holdings",
+        name="Holdings",
+        description="Portfolio holdings.",
+        params=[],
+        metadata={},
+    )
+
+    def handler(body: dict) -> list[dict]:
+        if body["model"] == "perplexity/sonar":
+            query = body["messages"][-1]["content"]
+            return text_chunks(f"News about {query}.")
+        if body["messages"][-1]["role"] == "tool":
+            return tool_call_chunks(
+                ("get_widget_data", {"widget_uuid": str(widget.uuid)}),
+                ("perplexity_web_search", {"query": "rates"}),
+            )
+        return tool_call_chunks(("perplexity_web_search", {"query": "oil"}))
+
+    llm.handler = handler
+
+    events = await run_query(
+        [{"role": "human", "content": "Write the commentary."}],
+        widgets={"primary": [widget]},
+    )
+
+    function_calls = [
+        event for event in events if event.get("event") == "copilotFunctionCall"
+    ]
+    assert len(function_calls) == 1
+    function_call = json.loads(function_calls[0]["data"])
+    # The searches of every step so far, not only the last one.
+    assert [
+        result["query"] for result in function_call["extra_state"]["web_search_results"]
+    ] == ["oil", "rates"]
+
+
+@pytest.mark.asyncio
+async def test_tool_calls_stop_after_max_completions(llm):
+    def handler(body: dict) -> list[dict]:
+        if body["model"] == "perplexity/sonar":
+            return text_chunks("More news.")
+        if "tools" not in body:
+            return text_chunks(ANSWER)
+        return tool_call_chunks(("perplexity_web_search", {"query": "more news"}))
+
+    llm.handler = handler
+
+    events = await run_query([{"role": "human", "content": "Keep searching."}])
+
+    assert streamed_text(events) == ANSWER
+    steps = completions(llm)
+    assert len(steps) == main.MAX_COMPLETIONS
+    # The last step isn't offered any tools, so that it answers.
+    assert all("tools" in body for body in steps[:-1])
+    assert "tools" not in steps[-1]
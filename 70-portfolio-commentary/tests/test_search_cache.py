@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from portfolio_commentary import search_cache
+from portfolio_commentary.search_cache import InMemorySearchCacheBackend, SearchCache
+
+
+class Upstream:
+    """A fake search service, which counts the searches it is sent."""
+
+    def __init__(self, delay: float = 0.0, fail: bool = False):
+        self.delay = delay
+        self.fail = fail
+        self.queries: list[str] = []
+
+    async def __call__(self, query: str) -> str:
+        self.queries.append(query)
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("Search failed")
+        return f"results for {query}"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Control the time seen by the cache."""
+    now = [1000.0]
+    monkeypatch.setattr(search_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.mark.asyncio
+async def test_normalized_queries_share_an_entry():
+    cache = SearchCache()
+    upstream = Upstream()
+
+    assert await cache.get_or_fetch("Oil prices?", upstream) == (
+        "results for Oil prices?"
+    )
+    assert await cache.get_or_fetch("  oil   PRICES ", upstream) == (
+        "results for Oil prices?"
+    )
+    assert upstream.queries == ["Oil prices?"]
+    assert cache.stats == {"hits": 1, "misses": 1, "coalesced": 0, "hit_rate": 0.5}
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_after_the_ttl(clock):
+    cache = SearchCache(ttl=60)
+    upstream = Upstream()
+
+    await cache.get_or_fetch("oil prices", upstream)
+    clock[0] += 59
+    await cache.get_or_fetch("oil prices", upstream)
+    assert len(upstream.queries) == 1
+
+    clock[0] += 1
+    await cache.get_or_fetch("oil prices", upstream)
+    assert len(upstream.queries) == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_searches_share_one_upstream_call():
+    cache = SearchCache()
+    upstream = Upstream(delay=0.05)
+
+    results = await asyncio.gather(
+        *(cache.get_or_fetch(query, upstream) for query in ["Oil?", "oil", "OIL!"])
+    )
+
+    assert results == ["results for Oil?"] * 3
+    assert upstream.queries == ["Oil?"]
+    assert cache.stats["coalesced"] == 2
+
+
+@pytest.mark.asyncio
+async def test_a_caller_going_away_does_not_cancel_the_search():
+    cache = SearchCache()
+    upstream = Upstream(delay=0.05)
+
+    first = asyncio.ensure_future(cache.get_or_fetch("oil", upstream))
+    second = asyncio.ensure_future(cache.get_or_fetch("oil", upstream))
+    await asyncio.sleep(0.01)
+    first.cancel()
+
+    assert await second == "results for oil"
+    assert upstream.queries == ["oil"]
+
+
+@pytest.mark.asyncio
+async def test_failed_searches_are_not_cached():
+    cache = SearchCache()
+    upstream = Upstream(delay=0.05, fail=True)
+
+    # Everyone waiting on the failed search gets the error.
+    results = await asyncio.gather(
+        cache.get_or_fetch("oil", upstream),
+        cache.get_or_fetch("oil", upstream),
+        return_exceptions=True,
+    )
+    assert [str(result) for result in results] == ["Search failed"] * 2
+    assert len(upstream.queries) == 1
+
+    upstream.fail = False
+    assert await cache.get_or_fetch("oil", upstream) == "results for oil"
+    assert len(upstream.queries) == 2
+
+
+@pytest.mark.asyncio
+async def test_the_in_memory_backend_evicts_least_recently_used():
+    backend = InMemorySearchCacheBackend(max_entries=2)
+    await backend.set("a", "1", ttl=60)
+    await backend.set("b", "2", ttl=60)
+    assert await backend.get("a") == "1"
+    await backend.set("c", "3", ttl=60)
+
+    assert await backend.get("b") is None
+    assert await backend.get("a") == "1"
+    assert await backend.get("c") == "3"
+    assert len(backend) == 2
@@ -10,6 +10,7 @@ from sse_starlette.sse import EventSourceResponse
 
 from dotenv import load_dotenv
 from common import agent
+from common.functions import get_widget_param_options, search_widgets
 from openbb_ai.models import (
     QueryRequest,
 )
@@ -20,7 +21,8 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv(".env")
-app = FastAPI()
+FUNCTIONS = [get_widget_data, search_widgets, get_widget_param_options]
+app = FastAPI(lifespan=agent.lifespan(FUNCTIONS, providers=["gemini"]))
 
 
 origins = [
@@ -71,7 +73,7 @@ async def query(request: QueryRequest) -> EventSourceResponse:
     openbb_agent = agent.OpenBBAgent(
         query_request=request,
         system_prompt=render_system_prompt(widget_collection=request.widgets),
-        functions=[get_widget_data],
+        functions=FUNCTIONS,
         chat_class=agent.GeminiChat,
         model="gemini-2.0-flash-001",
         # If using Google AI Studio instead of Vertex AI, comment out the lines
@@ -0,0 +1,152 @@
+"""Benchmark prefetching the data of the primary widgets.
+
+Answers a question about a dashboard with `--widgets` primary widgets, playing
+the part of the client: whenever the agent asks for widget data, the data is
+sent back (after `--round-trip` seconds) in a new request.  Completions are
+served by a local mock OpenAI server with `--latency` seconds to first byte,
+where the model fetches one widget per completion before answering.
+
+Without prefetching, the first turn costs a completion (and a round trip) per
+widget before the answer.  With `prefetch_widget_data="get_widget_data"` the
+data of every widget is requested up-front, in one round trip.
+
+Usage:
+    python common/benchmarks/bench_prefetch_widget_data.py --widgets 3
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import time
+
+from openbb_ai.models import QueryRequest, Widget
+
+from common.agent import (
+    OpenBBAgent,
+    OpenRouterChat,
+    get_remote_data,
+    provider_clients,
+    remote_function_call,
+)
+from common.testing import MockOpenAIServer, completion_chunk, text_chunks
+
+
+@remote_function_call(function="get_widget_data")
+async def get_widget_data(widget_uuid: str, request: QueryRequest):
+    """Retrieve data for a widget by specifying the widget UUID."""
+    widget = next(w for w in request.widgets.primary if str(w.uuid) == widget_uuid)
+    yield get_remote_data(widget=widget, input_arguments={})
+
+
+def handler(body: dict) -> list[dict]:
+    """Fetch the widgets listed in the system prompt one by one, then answer."""
+    widget_uuids = re.findall(r"widget: (\S+)", body["messages"][0]["content"])
+    fetched = sum(
+        len(message.get("tool_calls") or [])
+        for message in body["messages"]
+        if message["role"] == "assistant"
+    )
+    if fetched < len(widget_uuids):
+        arguments = json.dumps({"widget_uuid": widget_uuids[fetched]})
+        return [
+            completion_chunk(
+                {
+                    "role": "assistant",
+                    "tool_calls": [
+                        {
+                            "index": 0,
+                            "id": f"call_{fetched}",
+                            "type": "function",
+                            "function": {
+                                "name": "get_widget_data",
+                                "arguments": arguments,
+                            },
+                        }
+                    ],
+                }
+            ),
+            completion_chunk({}, finish_reason="tool_calls"),
+        ]
+    return text_chunks("The widgets show a strong quarter.")
+
+
+async def answer(
+    server: MockOpenAIServer, widgets: list[Widget], round_trip: float, prefetch: bool
+) -> tuple[float, int, int]:
+    """Answer a question, returning the time to the first token of the answer,
+    the number of completions, and the number of client round trips."""
+    messages: list[dict] = [{"role": "human", "content": "Compare the widgets."}]
+    completions = len(server.requests)
+    round_trips = 0
+    start = time.perf_counter()
+    while True:
+        openbb_agent = OpenBBAgent(
+            query_request=QueryRequest(messages=messages, widgets={"primary": widgets}),
+            system_prompt="\n".join(f"widget: {w.uuid}" for w in widgets),
+            functions=[get_widget_data],
+            chat_class=OpenRouterChat,
+            model="mock-model",
+            api_key="bench",
+            base_url=server.base_url,
+            prefetch_widget_data="get_widget_data" if prefetch else None,
+        )
+        function_call = None
+        async for event in openbb_agent.run():
+            if event["event"] == "copilotMessageChunk":
+                return (
+                    time.perf_counter() - start,
+                    len(server.requests) - completions,
+                    round_trips,
+                )
+            if event["event"] == "copilotFunctionCall":
+                function_call = json.loads(event["data"])
+        assert function_call is not None
+
+        # The client fetches the data, and sends the conversation back.
+        await asyncio.sleep(round_trip)
+        round_trips += 1
+        data_sources = function_call["input_arguments"]["data_sources"]
+        messages.append(
+            {
+                "role": "tool",
+                "function": "get_widget_data",
+                "input_arguments": function_call["input_arguments"],
+                "data": [{"items": [{"content": "1, 2, 3"}]} for _ in data_sources],
+                "extra_state": function_call["extra_state"],
+            }
+        )
+
+
+async def main(widget_count: int, latency: float, round_trip: float) -> None:
+    widgets = [
+        Widget(
+            origin="openbb",
+            widget_id=f"widget_{i}",
+            name=f"Widget {i}",
+            description="A widget.",
+            params=[],
+            metadata={},
+        )
+        for i in range(widget_count)
+    ]
+    with MockOpenAIServer(handler=handler, latency=latency) as server:
+        for prefetch in (False, True):
+            ttft, completions, round_trips = await answer(
+                server, widgets, round_trip, prefetch
+            )
+            name = "prefetch" if prefetch else "no prefetch"
+            print(
+                f"{name:>11}: {completions} completions, {round_trips} round trips, "
+                f"TTFT {ttft * 1000:6.0f}ms"
+            )
+    await provider_clients.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--widgets", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--round-trip", type=float, default=0.2)
+    args = parser.parse_args()
+    asyncio.run(main(args.widgets, args.latency, args.round_trip))
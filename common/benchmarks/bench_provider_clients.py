@@ -0,0 +1,71 @@
+"""Benchmark connection re-use of pooled provider clients.
+
+Simulates an `OpenBBAgent` run of `max_completions` completions against a local
+OpenAI-compatible server, once with a brand-new `AsyncOpenAI` client per
+completion (the old behaviour) and once with the shared `provider_clients`
+registry, and reports the number of TCP connections opened and the wall time.
+
+Usage:
+    python common/benchmarks/bench_provider_clients.py --max-completions 10
+"""
+
+import argparse
+import asyncio
+import time
+
+from openai import AsyncOpenAI
+
+from common.agent import ProviderClientRegistry
+from common.testing import MockOpenAIServer
+
+
+async def _complete(client: AsyncOpenAI) -> None:
+    stream = await client.chat.completions.create(
+        model="mock-model",
+        messages=[{"role": "user", "content": "Hi"}],
+        stream=True,
+    )
+    async for _ in stream:
+        pass
+
+
+async def run_unpooled(base_url: str, max_completions: int, conversations: int):
+    async def conversation() -> None:
+        for _ in range(max_completions):
+            client = AsyncOpenAI(base_url=base_url, api_key="bench")
+            await _complete(client)
+            await client.close()
+
+    await asyncio.gather(*(conversation() for _ in range(conversations)))
+
+
+async def run_pooled(base_url: str, max_completions: int, conversations: int):
+    registry = ProviderClientRegistry()
+
+    async def conversation() -> None:
+        for _ in range(max_completions):
+            await _complete(registry.openai_client(base_url=base_url, api_key="bench"))
+
+    await asyncio.gather(*(conversation() for _ in range(conversations)))
+    await registry.aclose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-completions", type=int, default=10)
+    parser.add_argument("--conversations", type=int, default=20)
+    args = parser.parse_args()
+
+    for name, run in [("unpooled", run_unpooled), ("pooled", run_pooled)]:
+        with MockOpenAIServer() as server:
+            start = time.perf_counter()
+            asyncio.run(run(server.base_url, args.max_completions, args.conversations))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:>9}: {len(server.requests)} completions, "
+                f"{server.connections} connections, {elapsed:.3f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Benchmark routing the chunks of a long streamed completion.
+
+Replays a recorded stream (reasoning, then a long answer) through the previous
+`tee`-based implementation of `OpenRouterChat`'s streamed response, which
+scanned every chunk once and re-read it to produce the text, and through
+`CompletionStreamDemultiplexer`, which reads every chunk once.  Reports the
+number of chunks routed per second, and the peak memory allocated while doing
+so (the text itself is kept by both, in the `AsyncStreamedStr`).
+
+Usage:
+    python common/benchmarks/bench_stream_demultiplexer.py --chunks 100000
+"""
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+from typing import Any, AsyncGenerator, Callable
+
+from asyncstdlib import tee
+from magentic import AsyncStreamedStr
+from openai.types.chat import ChatCompletionChunk
+
+from common.agent import CompletionStreamDemultiplexer, reasoning_step
+from common.testing import completion_chunk
+
+
+class RecordedStream:
+    """Replays a stream of completion chunks, parsing each one as it is read."""
+
+    def __init__(self, chunks: list[dict[str, Any]]):
+        self._chunks = chunks
+
+    async def __aiter__(self) -> AsyncGenerator[ChatCompletionChunk, None]:
+        for chunk in self._chunks:
+            yield ChatCompletionChunk.model_validate(chunk)
+
+    async def close(self) -> None:
+        pass
+
+
+def record(chunks: int, reasoning_chunks: int = 1000) -> list[dict[str, Any]]:
+    recorded = [
+        completion_chunk({"role": "assistant", "reasoning": "Hmm, let me think. "})
+        for _ in range(reasoning_chunks)
+    ]
+    recorded += [
+        completion_chunk({"content": f"word{i} "})
+        for i in range(chunks - reasoning_chunks - 1)
+    ]
+    recorded.append(completion_chunk({}, finish_reason="stop"))
+    return recorded
+
+
+async def previous_streamed_response(stream: RecordedStream) -> AsyncGenerator:
+    previous, current = tee(stream, n=2)
+    reasoning = ""
+    async for chunk in previous:
+        delta = chunk.choices[0].delta
+        if getattr(delta, "reasoning", None):
+            if not reasoning:
+                yield reasoning_step(event_type="INFO", message="Model is reasoning...")
+            reasoning += delta.reasoning
+        elif delta.content:
+            if reasoning:
+                yield reasoning_step(
+                    event_type="INFO",
+                    message="Reasoning complete",
+                    details={"Reasoning": reasoning},
+                )
+                reasoning = ""
+
+            async def async_streamed_str() -> AsyncGenerator[str, None]:
+                async for chunk in current:
+                    if delta := chunk.choices[0].delta:
+                        if delta.content:
+                            yield delta.content
+
+            yield AsyncStreamedStr(async_streamed_str())
+
+
+def current_streamed_response(stream: RecordedStream) -> CompletionStreamDemultiplexer:
+    return CompletionStreamDemultiplexer(
+        stream,  # type: ignore[arg-type]
+        get_function=lambda name: print,
+    )
+
+
+async def consume(response: Any) -> int:
+    """Consume the response like `OpenBBAgent` does, returning the text length."""
+    async for item in response:
+        if isinstance(item, AsyncStreamedStr):
+            return len(await item.to_string())
+    return 0
+
+
+def run(
+    name: str, make_response: Callable[[RecordedStream], Any], recorded: list
+) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    length = asyncio.run(consume(make_response(RecordedStream(recorded))))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:>8}: {len(recorded) / elapsed:9.0f} chunks/s, "
+        f"peak {peak / 1024 / 1024:6.1f}MiB ({length} characters of text)"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=100_000)
+    args = parser.parse_args()
+
+    recorded = record(args.chunks)
+    for name, make_response in [
+        ("previous", previous_streamed_response),
+        ("current", current_streamed_response),
+    ]:
+        run(name, make_response, recorded)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Benchmark the size of the system prompt, and the time to first token,
+against the size of the dashboard.
+
+Renders the widgets of dashboards with 5 primary widgets and up to `--widgets`
+widgets in total, listing every widget, and listing only the first
+`--max-secondary-widgets` secondary widgets (plus the few most relevant to the
+question).
+Completions are served by a local mock OpenAI server, which waits
+`--latency` seconds plus the time it would take to prefill the prompt at
+`--prefill-rate` tokens per second before the first token.
+
+Tokens are estimated at 4 characters per token.
+
+Usage:
+    python common/benchmarks/bench_widget_selection.py --widgets 400
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from openbb_ai.models import QueryRequest, Widget, WidgetCollection, WidgetParam
+
+from common.agent import OpenBBAgent, OpenRouterChat, provider_clients
+from common.functions import search_widgets
+from common.testing import MockOpenAIServer, text_chunks
+from common.widgets import WidgetPromptRenderer
+
+QUESTION = "How has the dividend yield of AAPL changed?"
+TOPICS = [
+    "revenue",
+    "earnings per share",
+    "dividend yield",
+    "share price",
+    "company news",
+    "analyst ratings",
+    "insider trading",
+    "balance sheet",
+    "cash flow",
+    "options chain",
+]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def dashboard(widget_count: int) -> WidgetCollection:
+    widgets = [
+        Widget(
+            origin="openbb",
+            widget_id=f"widget_{i}",
+            name=f"{TOPICS[i % len(TOPICS)].title()} ({i})",
+            description=(
+                f"Shows the {TOPICS[i % len(TOPICS)]} of a company over time, "
+                "with a table of the underlying values, sourced from the "
+                "provider selected in the widget's settings."
+            ),
+            params=[
+                WidgetParam(
+                    name="symbol",
+                    type="ticker",
+                    description="The ticker of the company.",
+                    current_value="AAPL",
+                ),
+                WidgetParam(
+                    name="period",
+                    type="text",
+                    description="The reporting period.",
+                    current_value="quarter",
+                    options=["annual", "quarter"],
+                ),
+            ],
+            metadata={},
+        )
+        for i in range(widget_count)
+    ]
+    return WidgetCollection(primary=widgets[:5], secondary=widgets[5:])
+
+
+async def time_to_first_token(
+    server: MockOpenAIServer, widgets: WidgetCollection, system_prompt: str
+) -> float:
+    openbb_agent = OpenBBAgent(
+        query_request=QueryRequest(
+            messages=[{"role": "human", "content": QUESTION}], widgets=widgets
+        ),
+        system_prompt=system_prompt,
+        functions=[search_widgets],
+        chat_class=OpenRouterChat,
+        model="mock-model",
+        api_key="bench",
+        base_url=server.base_url,
+    )
+    start = time.perf_counter()
+    async for event in openbb_agent.run():
+        if event["event"] == "copilotMessageChunk":
+            elapsed = time.perf_counter() - start
+    return elapsed
+
+
+async def main(
+    max_widgets: int, max_secondary_widgets: int, latency: float, prefill_rate: float
+) -> None:
+    def prefill(body: dict) -> float:
+        return latency + estimate_tokens(json.dumps(body)) / prefill_rate
+
+    renderers = {
+        "all widgets": WidgetPromptRenderer(),
+        f"first {max_secondary_widgets}": WidgetPromptRenderer(
+            max_secondary_widgets=max_secondary_widgets
+        ),
+    }
+    sizes = [size for size in (10, 25, 50, 100, 200, 400, 800) if size <= max_widgets]
+    with MockOpenAIServer(
+        handler=lambda body: text_chunks("Up."), latency=prefill
+    ) as server:
+        # Open the connection to the server, so it isn't counted below.
+        await time_to_first_token(server, dashboard(0), "")
+        for size in sizes:
+            widgets = dashboard(size)
+            for name, renderer in renderers.items():
+                start = time.perf_counter()
+                system_prompt = renderer.render(widgets, query=QUESTION)
+                render_time = time.perf_counter() - start
+                ttft = await time_to_first_token(server, widgets, system_prompt)
+                print(
+                    f"{size:4} widgets, {name:>11}: "
+                    f"~{estimate_tokens(system_prompt):6} prompt tokens, "
+                    f"rendered in {render_time * 1000:5.2f}ms, "
+                    f"TTFT {ttft * 1000:5.0f}ms"
+                )
+    await provider_clients.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--widgets", type=int, default=400)
+    parser.add_argument("--max-secondary-widgets", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--prefill-rate", type=float, default=10_000)
+    args = parser.parse_args()
+    asyncio.run(
+        main(args.widgets, args.max_secondary_widgets, args.latency, args.prefill_rate)
+    )
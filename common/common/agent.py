@@ -1,7 +1,14 @@
+import asyncio
+import copy
+import functools
+import hashlib
+import importlib.util
 import inspect
 import json
 import os
-from asyncstdlib import tee
+from collections import OrderedDict
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+import httpx
 from magentic import (
     AsyncStreamedResponse,
     Chat,
@@ -41,16 +48,25 @@ from magentic import (
 from typing import (
     Any,
     AsyncGenerator,
+    AsyncIterator,
     Awaitable,
     Callable,
+    Generic,
     Iterable,
+    Iterator,
     Literal,
     Protocol,
+    TypedDict,
+    TypeVar,
     cast,
 )
 import re
-from openai import NOT_GIVEN, AsyncOpenAI
+import time
+import weakref
+from openai import NOT_GIVEN, AsyncOpenAI, AsyncStream, OpenAI
 from openai.types.chat import (
+    ChatCompletionChunk,
+    ChatCompletionContentPartTextParam,
     ChatCompletionMessageParam,
     ChatCompletionSystemMessageParam,
     ChatCompletionUserMessageParam,
@@ -59,13 +75,19 @@ from openai.types.chat import (
     ChatCompletionMessageToolCallParam,
     ChatCompletionToolMessageParam,
 )
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
+from openai.types.completion_usage import CompletionUsage
 from openai.types.shared_params import FunctionDefinition as OpenAiFunctionDefinition
 from magentic.chat_model.function_schema import FunctionCallFunctionSchema
 
+from .widgets import split_volatile_tail
+
 import logging
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 def sanitize_message(message: str) -> str:
     """Sanitize a message by escaping forbidden characters."""
@@ -88,9 +110,99 @@ def reasoning_step(
     )
 
 
+class FormattedResultCache:
+    """Content-addressed LRU cache of formatted tool results.
+
+    Every request re-sends the whole conversation, so without this cache the
+    `output_formatter` of every historical tool result (eg. downloading and
+    parsing a PDF) would run again on every turn.  Entries are keyed by a hash
+    of the function name, the formatter and the data payload, and evicted in
+    least-recently-used order once either limit is exceeded.
+
+    Data that refers to files by URL isn't cached: the file behind a URL can
+    change, so the formatter has to revalidate it (eg. with a conditional GET)
+    every time.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_chars: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def cacheable(
+        data: list[DataContent | DataFileReferences | ClientFunctionCallError],
+    ) -> bool:
+        """Whether the formatted result only depends on the data payload."""
+        return not any(isinstance(item, DataFileReferences) for item in data)
+
+    @staticmethod
+    def key(
+        function_name: str,
+        formatter: Callable | None,
+        data: list[DataContent | DataFileReferences | ClientFunctionCallError],
+        question: str | None = None,
+    ) -> str:
+        formatter_name = (
+            f"{formatter.__module__}.{formatter.__qualname__}" if formatter else "str"
+        )
+        digest = hashlib.sha256(f"{function_name}\0{formatter_name}\0".encode())
+        if question is not None:
+            digest.update(f"{question}\0".encode())
+        for item in data:
+            digest.update(item.model_dump_json().encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: str) -> None:
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        self._entries[key] = result
+        self._size += len(result)
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._size > self.max_chars
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "chars": self._size,
+        }
+
+
+# The cache shared by all remote functions in this process.
+formatted_result_cache = FormattedResultCache()
+
+
 class WrappedFunctionProtocol(Protocol):
     async def execute_post_processing(
-        self, data: list[DataContent | DataFileReferences | ClientFunctionCallError]
+        self,
+        data: list[DataContent | DataFileReferences | ClientFunctionCallError],
+        request: QueryRequest | None = None,
     ) -> str: ...
     def execute_callbacks(
         self,
@@ -103,10 +215,61 @@ class WrappedFunctionProtocol(Protocol):
     ) -> AsyncGenerator[FunctionCallSSE | StatusUpdateSSE, None]: ...
 
 
+class RequestBoundFunction:
+    """A function that is called with the request it is answering.
+
+    The wrapped function takes a `request` argument, which is hidden from the
+    model and passed in automatically. The wrapper is a module-level singleton
+    shared by every request, so the agent calls a bound copy of it instead
+    (see `bind`).
+    """
+
+    def __init__(self, func: Callable):
+        self.__name__ = func.__name__
+        self.__signature__ = self._mask_signature(func)
+        self.__doc__ = func.__doc__
+        self.local_function = func
+        self._request: QueryRequest | None = None
+
+    @property
+    def request(self) -> QueryRequest | None:
+        return self._request
+
+    def bind(self, request: QueryRequest) -> "RequestBoundFunction":
+        """Return a copy of this function bound to `request`.
+
+        The decorated function is a module-level singleton shared by every
+        request, so we never mutate it.  Instead each request calls a cheap,
+        bound copy of it."""
+        bound_function = copy.copy(self)
+        bound_function._request = request
+        return bound_function
+
+    def _mask_signature(self, func: Callable) -> inspect.Signature:
+        """Hide the `request` argument from the signature, since we want to
+        pass this in automatically, but not expose it to the LLM."""
+        signature = inspect.signature(func)
+        masked_params = [
+            p for p in signature.parameters.values() if p.name != "request"
+        ]
+        return signature.replace(parameters=masked_params)
+
+    async def __call__(self, *args: Any, **kwargs: Any) -> AsyncGenerator[Any, None]:
+        async for event in self.local_function(*args, request=self._request, **kwargs):
+            yield event
+
+
+def bind_request(func: Callable) -> RequestBoundFunction:
+    """Decorate a local (async generator) function that needs the request, eg.
+    to look up its widgets, but never asks the client for data."""
+    return RequestBoundFunction(func)
+
+
 def remote_function_call(
     function: Literal["get_widget_data"],
     output_formatter: Callable[..., Awaitable[str]] | None = None,
     callbacks: list[Callable[..., Awaitable[Any]]] | None = None,
+    cache_output: bool = True,
 ) -> Callable:
     if function not in ["get_widget_data"]:
         raise ValueError(
@@ -114,33 +277,19 @@ def remote_function_call(
         )
 
     def outer_wrapper(func: Callable) -> WrappedFunctionProtocol:
-        class InnerWrapper(WrappedFunctionProtocol):
+        class InnerWrapper(RequestBoundFunction, WrappedFunctionProtocol):
             def __init__(self):
-                self.__name__ = func.__name__
-                self.__signature__ = self._mask_signature(func)
-                self.__doc__ = func.__doc__
-                self.local_function = func
+                super().__init__(func)
                 self.function = function
                 self.post_process_function = output_formatter
+                # Formatters can optionally take the request, eg. to only
+                # include the parts of a document relevant to the question.
+                self._formatter_takes_request = (
+                    output_formatter is not None
+                    and "request" in inspect.signature(output_formatter).parameters
+                )
                 self.callbacks = callbacks
-                self._request = None
-
-            @property
-            def request(self) -> QueryRequest:
-                return self._request
-
-            @request.setter
-            def request(self, request: QueryRequest):
-                self._request = request
-
-            def _mask_signature(self, func: Callable):
-                """Hide the `request` argument from the signature, since we want
-                to pass this in automatically, but not expose it to the LLM."""
-                signature = inspect.signature(func)
-                masked_params = [
-                    p for p in signature.parameters.values() if p.name != "request"
-                ]
-                return signature.replace(parameters=masked_params)
+                self.cache_output = cache_output
 
             async def execute_callbacks(
                 self,
@@ -153,49 +302,85 @@ def remote_function_call(
                             async for event in callback(function_call_result, request):
                                 yield event
                         else:
-                            await callback(function_call_result, self.request)
+                            await callback(function_call_result, request)
 
             async def execute_post_processing(
                 self,
                 data: list[DataContent | DataFileReferences | ClientFunctionCallError],
+                request: QueryRequest | None = None,
             ) -> str:
+                formatter_kwargs = {}
+                question = None
+                if self._formatter_takes_request:
+                    formatter_kwargs["request"] = request
+                    # The output may depend on the question being answered.
+                    question = get_latest_question(request) if request else ""
+
+                cache_output = self.cache_output and formatted_result_cache.cacheable(
+                    data
+                )
+                if cache_output:
+                    key = formatted_result_cache.key(
+                        self.__name__, self.post_process_function, data, question
+                    )
+                    if (cached := formatted_result_cache.get(key)) is not None:
+                        return cached
+
+                result: str
                 if self.post_process_function:
-                    return await self.post_process_function(data)
-                return str(data)
+                    result = await self.post_process_function(data, **formatter_kwargs)
+                else:
+                    result = str(data)
+
+                if cache_output:
+                    formatted_result_cache.put(key, result)
+                return result
 
             async def __call__(
                 self, *args, **kwargs
             ) -> AsyncGenerator[FunctionCallSSE | StatusUpdateSSE, None]:
+                """Run the function, and request all of the data sources it
+                yields from the client at once, in a single function call."""
                 bound_args = self.__signature__.bind(*args, **kwargs).arguments
 
+                data_sources: list[DataSourceRequest] = []
+                local_result = ""
                 async for event in func(*args, request=self._request, **kwargs):
                     if isinstance(event, StatusUpdateSSE):
                         yield event
                     elif isinstance(event, DataSourceRequest):
-                        yield FunctionCallSSE(
-                            data=FunctionCallSSEData(
-                                function=self.function,
-                                input_arguments={
-                                    "data_sources": [
-                                        DataSourceRequest(
-                                            widget_uuid=event.widget_uuid,
-                                            origin=event.origin,
-                                            id=event.id,
-                                            input_args=event.input_args,
-                                        )
-                                    ]
-                                },
-                                extra_state={
-                                    "copilot_function_call_arguments": {
-                                        **bound_args,
-                                    },
-                                    "_locally_bound_function": func.__name__,
-                                },
+                        data_sources.append(
+                            DataSourceRequest(
+                                widget_uuid=event.widget_uuid,
+                                origin=event.origin,
+                                id=event.id,
+                                input_args=event.input_args,
                             )
                         )
-                        return
                     else:
-                        yield event
+                        local_result += str(event)
+
+                if not data_sources:
+                    if local_result:
+                        yield local_result
+                    return
+                # Any other output is kept until the client responds with the
+                # data, and is then prepended to it.
+                extra_state = {
+                    "copilot_function_call_arguments": {
+                        **bound_args,
+                    },
+                    "_locally_bound_function": func.__name__,
+                }
+                if local_result:
+                    extra_state["local_result"] = local_result
+                yield FunctionCallSSE(
+                    data=FunctionCallSSEData(
+                        function=self.function,
+                        input_arguments={"data_sources": data_sources},
+                        extra_state=extra_state,
+                    )
+                )
 
         return InnerWrapper()
 
@@ -214,19 +399,67 @@ def get_remote_data(
     )
 
 
+def get_latest_question(request: QueryRequest) -> str:
+    """Get the content of the latest human message in the request."""
+    for message in reversed(request.messages):
+        if isinstance(message, LlmClientMessage) and message.role == "human":
+            return str(message.content)
+    return ""
+
+
+class FunctionRegistry:
+    """The functions that can be called by the model, by name.
+
+    Built once from a list of functions (eg. at import time, for toolsets with
+    hundreds of functions), and then shared by the agent and the chat backend,
+    so that every tool call and historical tool result is dispatched in
+    constant time.
+    """
+
+    def __init__(self, functions: Iterable[Callable] = ()):
+        self._functions: dict[str, Callable] = {}
+        for function in functions:
+            self.register(function)
+
+    @classmethod
+    def of(
+        cls, functions: "Iterable[Callable] | FunctionRegistry"
+    ) -> "FunctionRegistry":
+        """Get a registry of `functions`, re-using it if it already is one."""
+        return functions if isinstance(functions, cls) else cls(functions)
+
+    def register(self, function: Callable) -> Callable:
+        """Register a function. Can also be used as a decorator."""
+        name = function.__name__
+        existing = self._functions.get(name)
+        if existing is not None and existing is not function:
+            raise ValueError(f"Another function is already registered as: {name}")
+        self._functions[name] = function
+        return function
+
+    def get(self, function_name: str) -> Callable:
+        try:
+            return self._functions[function_name]
+        except KeyError:
+            raise ValueError(f"Function not found: {function_name}") from None
+
+    def __contains__(self, function_name: object) -> bool:
+        return function_name in self._functions
+
+    def __iter__(self) -> Iterator[Callable]:
+        return iter(self._functions.values())
+
+    def __len__(self) -> int:
+        return len(self._functions)
+
+
 def get_wrapped_function(
-    function_name: str, functions: list[Any]
+    function_name: str, functions: Iterable[Any] | FunctionRegistry
 ) -> WrappedFunctionProtocol:
-    matching_local_functions = list(
-        filter(
-            lambda x: x.__name__ == function_name,
-            functions,
-        )
-    )
-    wrapped_function = matching_local_functions[0] if matching_local_functions else None
-    if not wrapped_function:
+    registry = FunctionRegistry.of(functions)
+    if function_name not in registry:
         raise ValueError(f"Local function not found: {function_name}")
-    return wrapped_function
+    return cast(WrappedFunctionProtocol, registry.get(function_name))
 
 
 async def process_messages(
@@ -262,21 +495,573 @@ async def _process_messages_openai(
     return chat_messages
 
 
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+# Tells settings that weren't passed apart from settings passed as `None`.
+_UNSET: Any = object()
+# OpenRouter models that only cache prompts up to `cache_control` breakpoints.
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+
+ClientKey = tuple[str, str | None, str | None]
+
+
+class PooledOpenaiChatModel(OpenaiChatModel):
+    """A magentic `OpenaiChatModel` that sends its requests through the given
+    `AsyncOpenAI` client (eg. a shared, pooled one) instead of its own.
+
+    magentic has no parameter for passing in a client, and its constructor
+    always creates a new pair of clients, so it isn't called: the settings it
+    would store are set here instead. A synchronous client (which the agent
+    never uses) is only created if `complete` is called.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        *,
+        async_client: AsyncOpenAI,
+        max_tokens: int | None = None,
+        seed: int | None = None,
+        temperature: float | None = None,
+    ):
+        self._model = model
+        self._api_key = async_client.api_key
+        self._api_type = "openai"
+        self._base_url = str(async_client.base_url)
+        self._max_tokens = max_tokens
+        self._seed = seed
+        self._temperature = temperature
+        self._async_client = async_client
+
+    # magentic sets this in its constructor, so it's an attribute there.
+    @functools.cached_property
+    def _client(self) -> OpenAI:  # type: ignore[override]
+        return OpenAI(api_key=self._api_key, base_url=self._base_url)
+
+
+class ProviderClientRegistry:
+    """Process-wide registry of long-lived LLM provider clients.
+
+    Clients are keyed by (provider, base_url, api key) and share a pooled,
+    keep-alive HTTP client, so that every completion of every request re-uses
+    the same connections instead of paying for a new TLS handshake.  HTTP/2 is
+    enabled when the optional `h2` package is installed.
+
+    Connections can only be closed on the event loop they were opened on, so
+    each client is closed when that loop shuts down (eg. at the end of
+    `asyncio.run`, or of a `TestClient` request), and a new one is created for
+    the next loop.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool | None = None,
+    ):
+        self._clients: dict[ClientKey, Any] = {}
+        # How to close each client (and the connection pool it was given).
+        self._closers: dict[ClientKey, Callable[[], Awaitable[None]]] = {}
+        self._chat_models: dict[ClientKey, dict[str, PooledOpenaiChatModel]] = {}
+        # The event loop each client's connection pool is bound to, and the
+        # task that closes the client when that loop shuts down.
+        self._loops: dict[ClientKey, asyncio.AbstractEventLoop | None] = {}
+        self._watchers: dict[ClientKey, asyncio.Task] = {}
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.configure(http2=http2)
+
+    def configure(
+        self,
+        max_connections: int | None = _UNSET,
+        max_keepalive_connections: int | None = _UNSET,
+        keepalive_expiry: float | None = _UNSET,
+        http2: bool | None = None,
+    ) -> None:
+        """Set the pool limits used for clients created from now on.
+
+        Limits that aren't passed are left as they are, and `None` means no
+        limit.
+        """
+        if max_connections is _UNSET:
+            max_connections = self.limits.max_connections
+        if max_keepalive_connections is _UNSET:
+            max_keepalive_connections = self.limits.max_keepalive_connections
+        if keepalive_expiry is _UNSET:
+            keepalive_expiry = self.limits.keepalive_expiry
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 is None:
+            http2 = importlib.util.find_spec("h2") is not None
+        self.http2 = http2
+
+    def _http_client_args(self) -> dict[str, Any]:
+        return {"limits": self.limits, "http2": self.http2}
+
+    def _get_or_create(
+        self,
+        key: ClientKey,
+        factory: Callable[[], tuple[Any, Callable[[], Awaitable[None]]]],
+    ) -> Any:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        # Connection pools can't outlive the event loop they were created on.
+        # Clients are normally closed as their loop shuts down, but a loop can
+        # also be closed without shutting down its tasks, and then there is
+        # nothing left to close the client's connections with.
+        bound_loop = self._loops.get(key)
+        if key in self._clients and bound_loop is not None and bound_loop.is_closed():
+            self._discard(key)
+
+        if key not in self._clients:
+            self._clients[key], self._closers[key] = factory()
+            self._loops[key] = None
+        if self._loops[key] is None and loop is not None:
+            self._loops[key] = loop
+            self._watchers[key] = loop.create_task(
+                self._close_on_shutdown(key, self._clients[key])
+            )
+        return self._clients[key]
+
+    async def _close_on_shutdown(self, key: ClientKey, client: Any) -> None:
+        """Close `client` when the loop it runs on cancels its tasks on exit."""
+        try:
+            await asyncio.Event().wait()
+        finally:
+            # Unless it has been closed (or replaced) already.
+            if self._clients.get(key) is client:
+                close = self._closers[key]
+                self._discard(key)
+                await close()
+
+    def _discard(self, key: ClientKey) -> None:
+        self._clients.pop(key, None)
+        self._closers.pop(key, None)
+        self._chat_models.pop(key, None)
+        self._loops.pop(key, None)
+        self._watchers.pop(key, None)
+
+    def openai_client(
+        self, base_url: str | None = None, api_key: str | None = None
+    ) -> AsyncOpenAI:
+        """Get the shared OpenAI-compatible client (eg. OpenAI, OpenRouter)."""
+
+        def create() -> tuple[AsyncOpenAI, Callable[[], Awaitable[None]]]:
+            client = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                http_client=httpx.AsyncClient(**self._http_client_args()),
+            )
+            return client, client.close
+
+        return self._get_or_create(("openai", base_url, api_key), create)
+
+    def gemini_client(
+        self,
+        api_key: str | None = None,
+        vertex_ai: bool = False,
+        project: str | None = None,
+        location: str | None = None,
+        base_url: str | None = None,
+    ) -> genai.Client:
+        """Get the shared Gemini client (Google AI Studio or Vertex AI)."""
+
+        def create() -> tuple[genai.Client, Callable[[], Awaitable[None]]]:
+            # `genai.Client` has no close method, so it is given a connection
+            # pool (transport) that we can close ourselves.
+            transport = httpx.AsyncHTTPTransport(**self._http_client_args())
+            http_options = genai.types.HttpOptions(
+                base_url=base_url, async_client_args={"transport": transport}
+            )
+            if vertex_ai:
+                client = genai.Client(
+                    vertexai=True,
+                    project=project,
+                    location=location,
+                    http_options=http_options,
+                )
+            else:
+                client = genai.Client(api_key=api_key, http_options=http_options)
+            return client, transport.aclose
+
+        if vertex_ai:
+            return self._get_or_create(("vertex_ai", project, location), create)
+        return self._get_or_create(("gemini", base_url, api_key), create)
+
+    def openai_chat_model(
+        self,
+        model: str,
+        base_url: str | None = None,
+        api_key: str | None = None,
+    ) -> OpenaiChatModel:
+        """Get a magentic `OpenaiChatModel` backed by the shared OpenAI client."""
+        client = self.openai_client(base_url=base_url, api_key=api_key)
+        chat_models = self._chat_models.setdefault(("openai", base_url, api_key), {})
+        if model not in chat_models:
+            chat_models[model] = PooledOpenaiChatModel(model, async_client=client)
+        return chat_models[model]
+
+    def http_client(self) -> httpx.AsyncClient:
+        """Get a shared, pooled `httpx.AsyncClient` for other requests (eg. files)."""
+
+        def create() -> tuple[httpx.AsyncClient, Callable[[], Awaitable[None]]]:
+            client = httpx.AsyncClient(
+                follow_redirects=True, **self._http_client_args()
+            )
+            return client, client.aclose
+
+        return self._get_or_create(("http", None, None), create)
+
+    async def aclose(self) -> None:
+        """Close every pooled client."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        closers = list(self._closers.values())
+        for watcher in self._watchers.values():
+            if watcher.get_loop() is loop:
+                watcher.cancel()
+        self._clients.clear()
+        self._closers.clear()
+        self._chat_models.clear()
+        self._loops.clear()
+        self._watchers.clear()
+        for close in closers:
+            await close()
+
+    @asynccontextmanager
+    async def lifespan(self, app: Any) -> AsyncIterator[None]:
+        """FastAPI lifespan hook, eg. `FastAPI(lifespan=provider_clients.lifespan)`."""
+        try:
+            yield
+        finally:
+            await self.aclose()
+
+
+# The registry shared by all chat backends in this process.
+provider_clients = ProviderClientRegistry()
+
+
+def _compile_openai_tool(function: Callable) -> ChatCompletionToolParam:
+    schema = FunctionCallFunctionSchema(function)
+    tool_definition = ChatCompletionToolParam(
+        function=OpenAiFunctionDefinition(
+            name=schema.name,
+            description=schema.description or "",
+            parameters=schema.parameters,
+            strict=True,
+        ),
+        type="function",
+    )
+    # This MUST be included to avoid errors.
+    tool_definition["function"]["parameters"]["additionalProperties"] = False
+    return tool_definition
+
+
+def _compile_gemini_function_declaration(
+    function: Callable,
+) -> genai.types.FunctionDeclaration:
+    schema = FunctionCallFunctionSchema(function)
+    return genai.types.FunctionDeclaration(
+        name=schema.name,
+        description=schema.description,
+        parameters=genai.types.Schema(**schema.parameters),
+    )
+
+
+class ToolDefinitionCache:
+    """Provider tool definitions, compiled once per function.
+
+    Building a function's schema means inspecting its signature and docstring,
+    which is the same for every completion of every request. Definitions are
+    compiled on first use, or up-front with `warm(...)`, and are dropped when
+    the function itself is garbage collected.
+    """
+
+    compilers: dict[str, Callable[[Callable], Any]] = {
+        "openai": _compile_openai_tool,
+        "gemini": _compile_gemini_function_declaration,
+    }
+
+    def __init__(self) -> None:
+        self._definitions: weakref.WeakKeyDictionary[Callable, dict[str, Any]] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def get(self, function: Callable, provider: str) -> Any:
+        definitions = self._definitions.setdefault(function, {})
+        if provider not in definitions:
+            definitions[provider] = self.compilers[provider](function)
+        return definitions[provider]
+
+    def warm(
+        self, functions: Iterable[Callable], providers: Iterable[str] | None = None
+    ) -> None:
+        """Compile the definitions of `functions`, eg. at import or app startup."""
+        for function in functions:
+            for provider in providers or self.compilers:
+                self.get(function, provider)
+
+    def clear(self) -> None:
+        self._definitions.clear()
+
+    def __len__(self) -> int:
+        return sum(len(definitions) for definitions in self._definitions.values())
+
+
+# The tool definitions shared by all chat backends in this process.
+tool_definitions = ToolDefinitionCache()
+
+
+def lifespan(
+    functions: Iterable[Callable] = (), providers: Iterable[str] | None = None
+) -> Callable[[Any], AbstractAsyncContextManager[None]]:
+    """A FastAPI lifespan hook that compiles the tool definitions of `functions`
+    at startup, and closes the provider clients at shutdown.
+
+    Only `OpenRouterChat` and `GeminiChat` read the compiled definitions, since
+    magentic's `Chat` builds its own.
+
+    eg. `FastAPI(lifespan=lifespan(FUNCTIONS, providers=["openai"]))`
+    """
+    functions = list(functions)
+    providers = list(providers) if providers is not None else None
+
+    @asynccontextmanager
+    async def app_lifespan(app: Any) -> AsyncIterator[None]:
+        tool_definitions.warm(functions, providers)
+        async with provider_clients.lifespan(app):
+            yield
+
+    return app_lifespan
+
+
+class ConvertedMessageCache(Generic[T]):
+    """The provider messages that each chat message was converted to.
+
+    Chats only ever grow, so on each completion only the messages added since
+    the previous one are converted. In particular, streamed responses are only
+    read back (and their text re-joined) once.
+    """
+
+    def __init__(self) -> None:
+        self._entries: list[tuple[AnyMessage, list[T]]] = []
+
+    async def convert(
+        self,
+        messages: list[AnyMessage],
+        convert_message: Callable[[AnyMessage], Awaitable[list[T]]],
+    ) -> list[T]:
+        converted: list[T] = []
+        for index, message in enumerate(messages):
+            if index < len(self._entries) and self._entries[index][0] is message:
+                converted.extend(self._entries[index][1])
+                continue
+            # The history was changed from here on, so start over.
+            del self._entries[index:]
+            provider_messages = await convert_message(message)
+            self._entries.append((message, provider_messages))
+            converted.extend(provider_messages)
+        return converted
+
+
+class GeminiContextCache:
+    """Gemini cached content for system prompts and tools, shared process-wide.
+
+    The system prompt (with its widgets) and the tools are the same for every
+    completion of a request, and often across requests, so they are uploaded
+    once as cached content, and later completions refer to it instead of
+    sending them again. Entries are refreshed shortly before they expire on
+    Gemini's side.
+
+    Uploads never hold up a completion: a prompt is only uploaded once it has
+    been seen twice (so one-off prompts are never uploaded), in the background,
+    and completions send the prompt as usual until its cached content is
+    ready. Gemini won't cache prompts below a minimum number of tokens (which
+    depends on the model), so smaller prompts are skipped, and a failure to
+    create the cache is remembered for `ttl` seconds instead of being retried.
+    """
+
+    def __init__(
+        self, ttl: float = 600.0, min_tokens: int = 4096, max_entries: int = 256
+    ):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        # The name of each cached content (or None, if it couldn't be
+        # created), and when to stop using it, least recently used first.
+        self._entries: OrderedDict[str, tuple[float, str | None]] = OrderedDict()
+        # The prompts that have been seen once, least recently seen first.
+        self._seen: OrderedDict[str, None] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Task[None]] = {}
+
+    @staticmethod
+    def key(
+        account: str,
+        model: str,
+        system_prompt: str,
+        tools: list[genai.types.Tool] | None,
+    ) -> str:
+        digest = hashlib.sha256()
+        for part in (account, model, system_prompt):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        for tool in tools or []:
+            digest.update(tool.model_dump_json().encode())
+        return digest.hexdigest()
+
+    def get(
+        self,
+        client: genai.Client,
+        account: str,
+        model: str,
+        system_prompt: str,
+        tools: list[genai.types.Tool] | None,
+    ) -> str | None:
+        """Get the name of the cached content for a system prompt and tools,
+        or None if it isn't cached (yet).
+
+        The cached content is created in the background, the second time the
+        prompt is seen.
+        """
+        if estimate_tokens(system_prompt) < self.min_tokens:
+            return None
+        key = self.key(account, model, system_prompt, tools)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+            del self._entries[key]
+
+        if key in self._in_flight:
+            return None
+        if key not in self._seen:
+            self._seen[key] = None
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return None
+        del self._seen[key]
+        task = asyncio.create_task(
+            self._create(client, key, model, system_prompt, tools)
+        )
+        self._in_flight[key] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return None
+
+    async def _create(
+        self,
+        client: genai.Client,
+        key: str,
+        model: str,
+        system_prompt: str,
+        tools: list[genai.types.Tool] | None,
+    ) -> None:
+        created_at = time.monotonic()
+        try:
+            cached_content = await client.aio.caches.create(
+                model=model,
+                config=genai.types.CreateCachedContentConfig(
+                    system_instruction=system_prompt,
+                    tools=tools,
+                    ttl=f"{int(self.ttl)}s",
+                ),
+            )
+        except Exception as error:
+            logger.warning(f"Unable to cache the system prompt for {model}: {error}")
+            self._put(key, created_at + self.ttl, None)
+            return
+        # Stop using it a little before it expires, so that no completion
+        # ever refers to expired content.
+        self._put(key, created_at + self.ttl * 0.9, cached_content.name)
+
+    def _put(self, key: str, expires_at: float, name: str | None) -> None:
+        self._entries[key] = (expires_at, name)
+        # Expired entries are dropped first, and then the least recently used.
+        now = time.monotonic()
+        for expired in [
+            entry_key
+            for entry_key, (entry_expires_at, _) in self._entries.items()
+            if entry_expires_at <= now
+        ]:
+            del self._entries[expired]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def wait(self) -> None:
+        """Wait for the cached contents being created (eg. in tests)."""
+        await asyncio.gather(*self._in_flight.values())
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._seen.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# The cache shared by all Gemini chats in this process.
+gemini_context_cache = GeminiContextCache()
+
+
+def _record_usage(
+    usage: list[dict[str, int | None]],
+    model: str,
+    prompt_tokens: int | None,
+    cached_prompt_tokens: int | None,
+    completion_tokens: int | None,
+) -> None:
+    """Record (and log) the token usage of a completion."""
+    usage.append(
+        {
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": cached_prompt_tokens,
+            "completion_tokens": completion_tokens,
+        }
+    )
+    logger.info(
+        f"Completion by {model} used {prompt_tokens} prompt tokens "
+        f"({cached_prompt_tokens or 0} cached) and {completion_tokens} "
+        "completion tokens"
+    )
+
+
 class GeminiChat:
     def __init__(
         self,
         messages: list[AnyMessage],
         output_types: list[Any] | None = None,  # TODO: Implement this.
-        functions: list[Callable] | None = None,
+        functions: Iterable[Callable] | FunctionRegistry | None = None,
         model: str = "gemini-2.0-flash",
         vertex_ai: bool = False,
         project: str | None = None,
         location: str | None = None,
+        api_key: str | None = None,
+        base_url: str | None = None,
+        context_cache: GeminiContextCache | None = gemini_context_cache,
     ):
         self._messages = messages
+        self._converted_messages: ConvertedMessageCache[genai.types.Content] = (
+            ConvertedMessageCache()
+        )
+        # Set to None to send the system prompt and tools on every completion.
+        self._context_cache = context_cache
+        # The token usage of each completion.
+        self.usage: list[dict[str, int | None]] = []
         self._last_message: AnyMessage | None = None
         self._output_types = output_types
-        self._functions = functions
+        self._functions = FunctionRegistry.of(functions or [])
         self._model = model
 
         if vertex_ai:
@@ -284,13 +1069,18 @@ class GeminiChat:
                 raise ValueError(
                     "project and location must be provided if vertex_ai is True"
                 )
-            self._client = genai.Client(
-                vertexai=vertex_ai,
+            self._client = provider_clients.gemini_client(
+                vertex_ai=vertex_ai,
                 project=project,
                 location=location,
             )
+            self._account = f"vertex_ai:{project}:{location}"
         else:
-            self._client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+            api_key = api_key or os.environ["GEMINI_API_KEY"]
+            self._client = provider_clients.gemini_client(
+                api_key=api_key, base_url=base_url
+            )
+            self._account = f"gemini:{base_url}:{api_key}"
 
     def _get_system_prompt(self, messages: list[AnyMessage]) -> str:
         return next(m for m in messages if isinstance(m, SystemMessage)).content
@@ -298,129 +1088,150 @@ class GeminiChat:
     async def _convert_messages(
         self, messages: list[AnyMessage]
     ) -> list[genai.types.Content]:
+        return await self._converted_messages.convert(messages, self._convert_message)
+
+    async def _convert_message(self, message: AnyMessage) -> list[genai.types.Content]:
         contents: list[genai.types.Content] = []
-        for message in messages:
-            if isinstance(message, UserMessage):
+        if isinstance(message, UserMessage):
+            contents.append(
+                genai.types.Content(
+                    role="user", parts=[genai.types.Part(text=message.content)]
+                )
+            )
+        elif isinstance(message, AssistantMessage):
+            if isinstance(message.content, str):
                 contents.append(
                     genai.types.Content(
-                        role="user", parts=[genai.types.Part(text=message.content)]
+                        role="model", parts=[genai.types.Part(text=message.content)]
                     )
                 )
-            elif isinstance(message, AssistantMessage):
-                if isinstance(message.content, str):
-                    contents.append(
-                        genai.types.Content(
-                            role="model", parts=[genai.types.Part(text=message.content)]
-                        )
-                    )
-                elif isinstance(message.content, AsyncStreamedResponse):
-                    async for item in message.content:
-                        if isinstance(item, FunctionCall):
-                            contents.append(
-                                genai.types.Content(
-                                    role="model",
-                                    parts=[
-                                        genai.types.Part(
-                                            function_call=genai.types.FunctionCall(
-                                                name=item.function.__name__,
-                                                args=item.arguments,
-                                            )
-                                        )
-                                    ],
-                                )
-                            )
-
-                elif isinstance(message.content, FunctionCall):
-                    contents.append(
-                        genai.types.Content(
-                            role="model",
-                            parts=[
-                                genai.types.Part(
-                                    function_call=genai.types.FunctionCall(
-                                        name=message.content.function.__name__,
-                                        args=message.content.arguments,
-                                    )
-                                )
-                            ],
-                        )
-                    )
-                elif isinstance(message.content, ParallelFunctionCall):
-                    for function_call in message.content:
+            elif isinstance(message.content, AsyncStreamedResponse):
+                async for item in message.content:
+                    if isinstance(item, FunctionCall):
                         contents.append(
                             genai.types.Content(
                                 role="model",
                                 parts=[
                                     genai.types.Part(
                                         function_call=genai.types.FunctionCall(
-                                            name=function_call.function.__name__,
-                                            args=function_call.arguments,
+                                            name=item.function.__name__,
+                                            args=item.arguments,
                                         )
                                     )
                                 ],
                             )
                         )
-            elif isinstance(message, FunctionResultMessage):
+
+            elif isinstance(message.content, FunctionCall):
                 contents.append(
                     genai.types.Content(
-                        role="user",
+                        role="model",
                         parts=[
                             genai.types.Part(
-                                function_response=genai.types.FunctionResponse(
-                                    name=message.function_call.function.__name__,
-                                    response={"output": message.content},
+                                function_call=genai.types.FunctionCall(
+                                    name=message.content.function.__name__,
+                                    args=message.content.arguments,
                                 )
                             )
                         ],
                     )
                 )
+            elif isinstance(message.content, ParallelFunctionCall):
+                for function_call in message.content:
+                    contents.append(
+                        genai.types.Content(
+                            role="model",
+                            parts=[
+                                genai.types.Part(
+                                    function_call=genai.types.FunctionCall(
+                                        name=function_call.function.__name__,
+                                        args=function_call.arguments,
+                                    )
+                                )
+                            ],
+                        )
+                    )
+        elif isinstance(message, FunctionResultMessage):
+            contents.append(
+                genai.types.Content(
+                    role="user",
+                    parts=[
+                        genai.types.Part(
+                            function_response=genai.types.FunctionResponse(
+                                name=message.function_call.function.__name__,
+                                response={"output": message.content},
+                            )
+                        )
+                    ],
+                )
+            )
         return contents
 
     def _get_function(self, function_name: str) -> Callable:
-        for function in self._functions if self._functions else []:
-            if function.__name__ == function_name:
-                return function
-        raise ValueError(f"Function not found: {function_name}")
+        return self._functions.get(function_name)
 
     def add_message(self, message: AnyMessage) -> "GeminiChat":
         self._messages.append(message)
         return self
 
     def _prepare_tools(
-        self, functions: list[Callable] | None
+        self, functions: Iterable[Callable] | None
     ) -> list[genai.types.Tool] | None:
-        from magentic.chat_model.function_schema import FunctionCallFunctionSchema
-
         if not functions:
             return None
-        function_declarations: list[genai.types.FunctionDeclaration] = []
-        for function in functions:
-            schema = FunctionCallFunctionSchema(function)
-            function_declarations.append(
-                genai.types.FunctionDeclaration(
-                    name=schema.name,
-                    description=schema.description,
-                    parameters=genai.types.Schema(**schema.parameters),
-                )
-            )
+        function_declarations = [
+            tool_definitions.get(function, provider="gemini") for function in functions
+        ]
         return [genai.types.Tool(function_declarations=function_declarations)]
 
+    def _prepare_config(self) -> genai.types.GenerateContentConfig:
+        system_prompt = self._get_system_prompt(self._messages)
+        tools = self._prepare_tools(self._functions)
+        automatic_function_calling = genai.types.AutomaticFunctionCallingConfig(
+            disable=True
+        )
+        if self._context_cache is not None and (
+            cached_content := self._context_cache.get(
+                self._client, self._account, self._model, system_prompt, tools
+            )
+        ):
+            # The system prompt and tools are part of the cached content, and
+            # can't be sent again.
+            return genai.types.GenerateContentConfig(
+                cached_content=cached_content,
+                automatic_function_calling=automatic_function_calling,
+            )
+        return genai.types.GenerateContentConfig(
+            system_instruction=system_prompt,
+            tools=tools,  # type: ignore[arg-type]
+            automatic_function_calling=automatic_function_calling,
+        )
+
+    def _record_usage(self, event: genai.types.GenerateContentResponse) -> None:
+        # Only the last event of the stream has the final token counts.
+        if not (event.candidates and event.candidates[0].finish_reason):
+            return
+        if usage := event.usage_metadata:
+            _record_usage(
+                self.usage,
+                model=self._model,
+                prompt_tokens=usage.prompt_token_count,
+                cached_prompt_tokens=usage.cached_content_token_count,
+                completion_tokens=usage.candidates_token_count,
+            )
+
     async def asubmit(self) -> "GeminiChat":
         stream = await self._client.aio.models.generate_content_stream(
             model=self._model,
             contents=await self._convert_messages(self._messages),  # type: ignore[arg-type]
-            config=genai.types.GenerateContentConfig(
-                system_instruction=self._get_system_prompt(self._messages),
-                tools=self._prepare_tools(self._functions),  # type: ignore[arg-type]
-                automatic_function_calling=genai.types.AutomaticFunctionCallingConfig(
-                    disable=True
-                ),
-            ),
+            config=self._prepare_config(),
         )
 
         async def async_streamed_response() -> (
             AsyncGenerator[FunctionCall | AsyncStreamedStr, None]
         ):
             async for event in stream:
+                self._record_usage(event)
                 if function_calls := event.function_calls:
                     for function_call in function_calls:
                         yield FunctionCall(
@@ -433,6 +1244,7 @@ class GeminiChat:
                         # Need to field the first chunk (it's not in the stream)
                         yield text
                         async for event in stream:
+                            self._record_usage(event)
                             if event.text:
                                 yield event.text
                             if (
@@ -459,27 +1271,210 @@ class GeminiChat:
         )
         return self
 
+    @property
+    def messages(self) -> list[AnyMessage]:
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages: list[AnyMessage]) -> None:
+        self._messages = list(messages)
+
     @property
     def last_message(self) -> AnyMessage:
         return self._messages[-1]
 
 
+class CompletionStreamDemultiplexer:
+    """Route the chunks of a streamed chat completion to their consumers.
+
+    The stream is read once, and each chunk is dispatched as it arrives:
+
+    - reasoning deltas are reported as reasoning steps,
+    - content deltas are forwarded to a single `AsyncStreamedStr`, which reads
+      from the same stream while it is being consumed,
+    - tool-call deltas are accumulated per index, and yielded as a
+      `FunctionCall` (or a `ParallelFunctionCall`) once the model is done.
+
+    No chunk is held onto after it has been dispatched.
+    """
+
+    def __init__(
+        self,
+        stream: AsyncStream[ChatCompletionChunk],
+        get_function: Callable[[str], Callable],
+        show_reasoning: bool = True,
+        on_usage: Callable[[CompletionUsage], None] | None = None,
+    ):
+        self._stream = stream
+        # Called with the token usage of the completion, if it was asked for
+        # (it comes in a final chunk, with no choices).
+        self._on_usage = on_usage
+        self._chunks = stream.__aiter__()
+        self._get_function = get_function
+        self._show_reasoning = show_reasoning
+        self._reasoning = ""
+        # Tool calls are streamed as fragments, which are tagged with the
+        # index of the (possibly parallel) tool call they belong to.
+        self._tool_calls: dict[int, dict[str, str]] = {}
+        self._finish_reason: str | None = None
+
+    async def __aiter__(
+        self,
+    ) -> AsyncIterator[
+        FunctionCall | ParallelFunctionCall | AsyncStreamedStr | StatusUpdateSSE
+    ]:
+        async for chunk in self._chunks:
+            if not chunk.choices:
+                self._handle_usage(chunk)
+                continue
+            delta = chunk.choices[0].delta
+            if self._show_reasoning and getattr(delta, "reasoning", None):
+                if not self._reasoning:
+                    yield reasoning_step(
+                        event_type="INFO",
+                        message="Model is reasoning...",
+                    )
+                self._reasoning += delta.reasoning  # type: ignore[attr-defined]
+            elif delta.content:
+                if self._show_reasoning and self._reasoning:
+                    yield reasoning_step(
+                        event_type="INFO",
+                        message="Reasoning complete",
+                        details={"Reasoning": self._reasoning},
+                    )
+                    self._reasoning = ""
+                text = AsyncStreamedStr(self._text(delta.content))
+                yield text
+                # The text reads ahead in the stream, so let it finish (its
+                # chunks are kept by the `AsyncStreamedStr`) before carrying on.
+                async for _ in text:
+                    pass
+            elif delta.tool_calls:
+                self._add_tool_call_deltas(delta.tool_calls)
+
+            await self._handle_finish_reason(chunk.choices[0].finish_reason)
+            if self._finish_reason == "tool_calls":
+                break
+
+        if self._finish_reason == "tool_calls" and self._tool_calls:
+            function_calls = [
+                FunctionCall(
+                    self._get_function(tool_call["name"]),
+                    **(json.loads(tool_call["arguments"] or "{}") or {}),
+                )
+                for _, tool_call in sorted(self._tool_calls.items())
+            ]
+            if len(function_calls) == 1:
+                yield function_calls[0]
+            else:
+                yield ParallelFunctionCall(function_calls)
+
+    async def _text(self, first_delta: str) -> AsyncGenerator[str, None]:
+        yield first_delta
+        async for chunk in self._chunks:
+            if not chunk.choices:
+                self._handle_usage(chunk)
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                yield delta.content
+            elif delta.tool_calls:
+                self._add_tool_call_deltas(delta.tool_calls)
+            await self._handle_finish_reason(chunk.choices[0].finish_reason)
+            if self._finish_reason == "tool_calls":
+                return
+
+    def _add_tool_call_deltas(self, tool_call_deltas: list[ChoiceDeltaToolCall]):
+        for tool_call_delta in tool_call_deltas:
+            tool_call = self._tool_calls.setdefault(
+                tool_call_delta.index, {"name": "", "arguments": ""}
+            )
+            if function := tool_call_delta.function:
+                if function.name and not tool_call["name"]:
+                    tool_call["name"] = function.name
+                if function.arguments:
+                    tool_call["arguments"] += function.arguments
+
+    async def _handle_finish_reason(self, finish_reason: str | None) -> None:
+        if finish_reason is None:
+            return
+        self._finish_reason = finish_reason
+        if finish_reason == "tool_calls":
+            # Nothing useful follows the tool calls (except for the usage, if
+            # it was asked for), so hand the connection back to the shared
+            # pool straight away.
+            if self._on_usage:
+                async for chunk in self._chunks:
+                    self._handle_usage(chunk)
+            else:
+                await self._stream.close()
+
+    def _handle_usage(self, chunk: ChatCompletionChunk) -> None:
+        if chunk.usage and self._on_usage:
+            self._on_usage(chunk.usage)
+
+
+class CacheControl(TypedDict):
+    type: Literal["ephemeral"]
+
+
+class CachedTextPart(ChatCompletionContentPartTextParam, total=False):
+    """A text content part that ends a prompt prefix to cache (OpenRouter
+    passes `cache_control` on to the providers that need it)."""
+
+    cache_control: CacheControl
+
+
+def _mark_cached(
+    content: str | Iterable[ChatCompletionContentPartTextParam],
+) -> list[ChatCompletionContentPartTextParam]:
+    """The text parts of `content`, with a cache breakpoint after the last one."""
+    parts = (
+        [ChatCompletionContentPartTextParam(type="text", text=content)]
+        if isinstance(content, str)
+        else list(content)
+    )
+    if not parts:
+        return parts
+    *head, last = parts
+    return [
+        *head,
+        CachedTextPart(
+            type="text", text=last["text"], cache_control={"type": "ephemeral"}
+        ),
+    ]
+
+
 class OpenRouterChat:
     def __init__(
         self,
         messages: list[AnyMessage],
         output_types: list[Any] | None = None,  # TODO: Implement this.
-        functions: list[Callable] | None = None,
+        functions: Iterable[Callable] | FunctionRegistry | None = None,
         model: str = "gemini-2.0-flash",
         api_key: str | None = None,
         show_reasoning: bool = True,
+        base_url: str = OPENROUTER_BASE_URL,
+        cache_control: bool | None = None,
     ):
         self._messages = messages
+        self._converted_messages: ConvertedMessageCache[ChatCompletionMessageParam] = (
+            ConvertedMessageCache()
+        )
         self._model = model
-        self._functions = functions
+        self._functions = FunctionRegistry.of(functions or [])
         self._output_types = output_types
         self._api_key = api_key or os.environ["OPENROUTER_API_KEY"]
+        self._base_url = base_url
         self._show_reasoning = show_reasoning
+        # Whether to mark prompt cache breakpoints. Some providers (eg. OpenAI
+        # and DeepSeek) cache prompts automatically, but others (eg. Anthropic
+        # and Gemini) only cache up to explicit breakpoints.
+        if cache_control is None:
+            cache_control = model.startswith(CACHE_CONTROL_MODEL_PREFIXES)
+        self._cache_control = cache_control
+        # The token usage of each completion.
+        self.usage: list[dict[str, int | None]] = []
 
     def add_message(self, message: AnyMessage) -> "OpenRouterChat":
         self._messages.append(message)
@@ -490,201 +1485,506 @@ class OpenRouterChat:
         return system_message.content if system_message else ""
 
     async def _convert_messages(self) -> list[ChatCompletionMessageParam]:
+        return await self._converted_messages.convert(
+            self._messages, self._convert_message
+        )
+
+    @staticmethod
+    def _add_cache_breakpoints(
+        messages: list[ChatCompletionMessageParam],
+    ) -> list[ChatCompletionMessageParam]:
+        """Mark the system prompt (up to its volatile tail), and the last tool
+        result, as the ends of prompt prefixes to cache.
+
+        The system prompt (with its widgets) is the same for every completion,
+        and every tool result is sent again on each completion after it. The
+        converted messages are shared between completions, so the marked
+        messages are new ones, rather than modified copies.
+        """
+        roles = [message["role"] for message in messages]
+        breakpoints = set()
+        if "system" in roles:
+            breakpoints.add(roles.index("system"))
+        if "tool" in roles:
+            breakpoints.add(len(roles) - 1 - roles[::-1].index("tool"))
+
+        marked_messages = list(messages)
+        for index in breakpoints:
+            message = messages[index]
+            if message["role"] == "system":
+                content = message["content"]
+                tail: list[ChatCompletionContentPartTextParam] = []
+                if isinstance(content, str):
+                    # The breakpoint goes before the parts of the widgets
+                    # prompt that change from turn to turn.
+                    content, volatile_tail = split_volatile_tail(content)
+                    if volatile_tail:
+                        tail.append(
+                            ChatCompletionContentPartTextParam(
+                                type="text", text=volatile_tail
+                            )
+                        )
+                marked_messages[index] = ChatCompletionSystemMessageParam(
+                    role="system", content=[*_mark_cached(content), *tail]
+                )
+            elif message["role"] == "tool":
+                marked_messages[index] = ChatCompletionToolMessageParam(
+                    role="tool",
+                    tool_call_id=message["tool_call_id"],
+                    content=_mark_cached(message["content"]),
+                )
+        return marked_messages
+
+    async def _convert_message(
+        self, message: AnyMessage
+    ) -> list[ChatCompletionMessageParam]:
         converted_messages: list[ChatCompletionMessageParam] = []
-        for message in self._messages:
-            if isinstance(message, SystemMessage):
+        if isinstance(message, SystemMessage):
+            converted_messages.append(
+                ChatCompletionSystemMessageParam(role="system", content=message.content)
+            )
+        elif isinstance(message, UserMessage):
+            converted_messages.append(
+                ChatCompletionUserMessageParam(role="user", content=message.content)
+            )
+        elif isinstance(message, AssistantMessage):
+            if isinstance(message.content, str):
                 converted_messages.append(
-                    ChatCompletionSystemMessageParam(
-                        role="system", content=message.content
+                    ChatCompletionAssistantMessageParam(
+                        role="assistant", content=message.content
                     )
                 )
-            elif isinstance(message, UserMessage):
-                converted_messages.append(
-                    ChatCompletionUserMessageParam(role="user", content=message.content)
-                )
-            elif isinstance(message, AssistantMessage):
-                if isinstance(message.content, AsyncStreamedResponse):
-                    async for item in message.content:
-                        if isinstance(item, FunctionCall):
-                            converted_messages.append(
-                                ChatCompletionAssistantMessageParam(
-                                    role="assistant",
-                                    tool_calls=[
-                                        ChatCompletionMessageToolCallParam(
-                                            id=item._unique_id,
-                                            type="function",
-                                            function={
-                                                "name": item.function.__name__,
-                                                "arguments": str(item.arguments),
-                                            },
-                                        )
-                                    ],
-                                )
+            elif isinstance(message.content, AsyncStreamedResponse):
+                async for item in message.content:
+                    if isinstance(item, (FunctionCall, ParallelFunctionCall)):
+                        converted_messages.append(self._convert_function_calls(item))
+                    if isinstance(item, AsyncStreamedStr):
+                        content = ""
+                        async for chunk in item:
+                            content += chunk
+                        converted_messages.append(
+                            ChatCompletionAssistantMessageParam(
+                                role="assistant", content=content
                             )
-                        if isinstance(item, AsyncStreamedStr):
-                            content = ""
-                            async for chunk in item:
-                                content += chunk
-                            converted_messages.append(
-                                ChatCompletionAssistantMessageParam(
-                                    role="assistant", content=content
-                                )
-                            )
-            elif isinstance(message, FunctionResultMessage):
-                converted_messages.append(
-                    ChatCompletionToolMessageParam(
-                        role="tool",
-                        tool_call_id=message.function_call._unique_id,
-                        content=message.content,
-                    )
+                        )
+            elif isinstance(message.content, (FunctionCall, ParallelFunctionCall)):
+                converted_messages.append(self._convert_function_calls(message.content))
+        elif isinstance(message, FunctionResultMessage):
+            converted_messages.append(
+                ChatCompletionToolMessageParam(
+                    role="tool",
+                    tool_call_id=message.function_call._unique_id,
+                    content=message.content,
                 )
+            )
         return converted_messages
 
+    @staticmethod
+    def _convert_function_calls(
+        function_calls: FunctionCall | ParallelFunctionCall,
+    ) -> ChatCompletionAssistantMessageParam:
+        """Convert one or more function calls into a single assistant message."""
+        if isinstance(function_calls, FunctionCall):
+            function_calls = ParallelFunctionCall([function_calls])
+        return ChatCompletionAssistantMessageParam(
+            role="assistant",
+            tool_calls=[
+                ChatCompletionMessageToolCallParam(
+                    id=function_call._unique_id,
+                    type="function",
+                    function={
+                        "name": function_call.function.__name__,
+                        "arguments": json.dumps(function_call.arguments),
+                    },
+                )
+                for function_call in function_calls
+            ],
+        )
+
     def _prepare_tools(
-        self, functions: list[Callable] | None
+        self, functions: Iterable[Callable] | None
     ) -> Iterable[ChatCompletionToolParam] | None:
         if not functions:
             return None
-        function_declarations: list[ChatCompletionToolParam] = []
-        for function in functions:
-            schema = FunctionCallFunctionSchema(function)
-            tool_definition = ChatCompletionToolParam(
-                function=OpenAiFunctionDefinition(
-                    name=schema.name,
-                    description=schema.description or "",
-                    parameters=schema.parameters,
-                    strict=True,
-                ),
-                type="function",
-            )
-            # This MUST be included to avoid errors.
-            tool_definition["function"]["parameters"]["additionalProperties"] = False
-
-            function_declarations.append(tool_definition)
-        return function_declarations
+        return [
+            tool_definitions.get(function, provider="openai") for function in functions
+        ]
 
     def _get_function(self, function_name: str) -> Callable:
-        for function in self._functions if self._functions else []:
-            if function.__name__ == function_name:
-                return function
-        raise ValueError(f"Function not found: {function_name}")
+        return self._functions.get(function_name)
+
+    def _record_usage(self, usage: CompletionUsage) -> None:
+        details = usage.prompt_tokens_details
+        _record_usage(
+            self.usage,
+            model=self._model,
+            prompt_tokens=usage.prompt_tokens,
+            cached_prompt_tokens=details.cached_tokens if details else None,
+            completion_tokens=usage.completion_tokens,
+        )
 
     async def asubmit(self) -> "OpenRouterChat":
-        client = AsyncOpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=os.environ["OPENROUTER_API_KEY"],
+        client = provider_clients.openai_client(
+            base_url=self._base_url, api_key=self._api_key
         )
 
+        messages = await self._convert_messages()
+        if self._cache_control:
+            messages = self._add_cache_breakpoints(messages)
         stream = await client.chat.completions.create(
             model=self._model,
-            messages=await self._convert_messages(),
+            messages=messages,
             tools=self._prepare_tools(self._functions) or NOT_GIVEN,
             stream=True,
+            stream_options={"include_usage": True},
         )
 
-        async def async_streamed_response() -> (
-            AsyncGenerator[FunctionCall | AsyncStreamedStr | StatusUpdateSSE, None]
-        ):
-            previous, current = tee(stream, n=2)
-            reasoning = ""
-            function_arguments = ""
-            function_name = None
-            async for chunk in previous:
-                if (
-                    self._show_reasoning
-                    and hasattr(chunk.choices[0].delta, "reasoning")
-                    and chunk.choices[0].delta.reasoning
-                ):
-                    if not reasoning:
-                        yield reasoning_step(
-                            event_type="INFO",
-                            message="Model is reasoning...",
-                        )
-                    reasoning += chunk.choices[0].delta.reasoning
-                elif chunk.choices[0].delta.content:
-                    if self._show_reasoning:
-                        if reasoning:
-                            yield reasoning_step(
-                                event_type="INFO",
-                                message="Reasoning complete",
-                                details={"Reasoning": reasoning},
-                            )
-                            reasoning = ""
-
-                    async def async_streamed_str() -> AsyncGenerator[str, None]:
-                        async for chunk in current:
-                            if delta := chunk.choices[0].delta:
-                                if delta.content:
-                                    yield delta.content
-
-                    yield AsyncStreamedStr(async_streamed_str())
-                elif chunk.choices[0].delta.tool_calls:
-                    if function := chunk.choices[0].delta.tool_calls[0].function:
-                        if not function_name:
-                            function_name = function.name
-                        if function.arguments:
-                            function_arguments += function.arguments
-
-                if chunk.choices[0].finish_reason == "tool_calls":
-                    yield FunctionCall(
-                        function=self._get_function(function_name or ""),
-                        **(json.loads(function_arguments) or {}),
-                    )
-                    function_name = None
-                    function_arguments = ""
-
-        self.add_message(
-            AssistantMessage(content=AsyncStreamedResponse(async_streamed_response()))  # type: ignore
+        demultiplexer = CompletionStreamDemultiplexer(
+            stream,
+            get_function=self._get_function,
+            show_reasoning=self._show_reasoning,
+            on_usage=self._record_usage,
         )
+        self.add_message(AssistantMessage(content=AsyncStreamedResponse(demultiplexer)))  # type: ignore
         return self
 
+    @property
+    def messages(self) -> list[AnyMessage]:
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages: list[AnyMessage]) -> None:
+        self._messages = list(messages)
+
     @property
     def last_message(self) -> AnyMessage:
         return self._messages[-1]
 
 
+def estimate_tokens(text: str) -> int:
+    """A fast, local estimate of the number of tokens in `text`.
+
+    About 4 characters per token for English prose (and fewer for numbers and
+    JSON, which the budget's headroom absorbs).
+    """
+    return (len(text) + 3) // 4
+
+
+def _estimate_content_tokens(content: Any) -> int:
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    if isinstance(content, FunctionCall):
+        content = ParallelFunctionCall([content])
+    if isinstance(content, ParallelFunctionCall):
+        return sum(
+            estimate_tokens(function_call.function.__name__)
+            + estimate_tokens(json.dumps(function_call.arguments, default=str))
+            for function_call in content
+        )
+    # Streamed responses keep what has been read of them, so that they can be
+    # read again. By the time a conversation is compacted, its earlier responses
+    # have been read in full.
+    if isinstance(content, AsyncStreamedResponse):
+        return sum(
+            _estimate_content_tokens(item) for item in content._stream._cached_items
+        )
+    if isinstance(content, AsyncStreamedStr):
+        return estimate_tokens("".join(content._chunks._cached_items))
+    return estimate_tokens(str(content))
+
+
+class ConversationBudgeter:
+    """Keeps the conversation sent to a model within a token budget.
+
+    Every request re-sends the whole conversation, including every historical
+    widget dump, so long sessions get slower and costlier with every turn, and
+    eventually overflow the context window.  Once a conversation is over its
+    model's budget, the results of tool calls made before the last
+    `keep_recent_turns` turns are replaced, oldest first, by a short excerpt
+    that tells the model how to fetch the full result again.  If that isn't
+    enough, the oldest turns are dropped altogether.  Recent turns are always
+    kept verbatim.
+
+    Budgets are set per model (by model name prefix), with `default_budget`
+    for the rest.  Excerpts are cached by content, since the same historical
+    results are compacted again on every request.
+    """
+
+    def __init__(
+        self,
+        budgets: dict[str, int] | None = None,
+        default_budget: int = 96_000,
+        keep_recent_turns: int = 2,
+        excerpt_chars: int = 500,
+        max_entries: int = 1024,
+    ):
+        self.budgets: dict[str, int] = dict(budgets or {})
+        self.default_budget = default_budget
+        self.keep_recent_turns = keep_recent_turns
+        self.excerpt_chars = excerpt_chars
+        self.max_entries = max_entries
+        self._excerpts: OrderedDict[str, str] = OrderedDict()
+
+    def set_budget(self, model_prefix: str, tokens: int) -> None:
+        """Set the budget of every model whose name starts with `model_prefix`."""
+        self.budgets[model_prefix] = tokens
+
+    def budget_for(self, model: str) -> int:
+        """The budget of the most specific prefix of `model` (or the default)."""
+        prefixes = [prefix for prefix in self.budgets if model.startswith(prefix)]
+        if not prefixes:
+            return self.default_budget
+        return self.budgets[max(prefixes, key=len)]
+
+    @staticmethod
+    def estimate_message_tokens(message: AnyMessage) -> int:
+        return _estimate_content_tokens(message.content)
+
+    def _compact_result(self, message: FunctionResultMessage) -> FunctionResultMessage:
+        function_name = message.function_call.function.__name__
+        # Results that aren't text (eg. raw widget data) are sent as their str.
+        content = str(message.content)
+        key = hashlib.sha256(f"{function_name}\0{content}".encode()).hexdigest()
+        excerpt = self._excerpts.get(key)
+        if excerpt is not None:
+            self._excerpts.move_to_end(key)
+        else:
+            head = content[: self.excerpt_chars]
+            # Cut at a line break, if there's one, to not leave half a row.
+            if len(content) > self.excerpt_chars and "\n" in head:
+                head = head[: head.rindex("\n")]
+            excerpt = (
+                f"[This result of `{function_name}` was compacted, to keep the "
+                f"conversation short. It was about {estimate_tokens(content)} "
+                "tokens long, and began with:]\n"
+                f"{head}\n"
+                f"[... Call `{function_name}` again with the same arguments to "
+                "fetch the full result, if it is needed.]"
+            )
+            self._excerpts[key] = excerpt
+            while len(self._excerpts) > self.max_entries:
+                self._excerpts.popitem(last=False)
+        return FunctionResultMessage(
+            content=excerpt, function_call=message.function_call
+        )
+
+    def compact(self, messages: list[AnyMessage], model: str) -> list[AnyMessage]:
+        """Compact `messages` to fit `model`'s budget (if they don't already)."""
+        budget = self.budget_for(model)
+        sizes = [self.estimate_message_tokens(message) for message in messages]
+        total = original_total = sum(sizes)
+        if total <= budget:
+            return messages
+
+        # The recent turns (from the user message that starts them on) are
+        # kept verbatim.
+        turn_starts = [
+            index
+            for index, message in enumerate(messages)
+            if isinstance(message, UserMessage)
+        ]
+        recent_turns = turn_starts[-self.keep_recent_turns :]
+        recent_start = (
+            recent_turns[0]
+            if recent_turns and self.keep_recent_turns
+            else len(messages)
+        )
+
+        compacted = list(messages)
+        for index in range(recent_start):
+            if total <= budget:
+                break
+            message = compacted[index]
+            if not isinstance(message, FunctionResultMessage):
+                continue
+            compacted_message = self._compact_result(message)
+            size = self.estimate_message_tokens(compacted_message)
+            if size < sizes[index]:
+                compacted[index] = compacted_message
+                total -= sizes[index] - size
+                sizes[index] = size
+
+        # Still over budget, so drop the oldest turns (keeping any leading
+        # system prompt). Tool calls and their results always belong to the
+        # same turn, so they are dropped together.
+        older_turns = [start for start in turn_starts if start < recent_start]
+        dropped = 0
+        for start, end in zip(older_turns, [*older_turns[1:], recent_start]):
+            if total <= budget:
+                break
+            total -= sum(sizes[start:end])
+            dropped += end - start
+        if dropped:
+            first = older_turns[0]
+            compacted = compacted[:first] + compacted[first + dropped :]
+
+        logger.info(
+            f"Compacted the conversation to about {total} tokens "
+            f"(from {original_total}, "
+            f"with a budget of {budget} for {model}), dropping {dropped} messages"
+        )
+        return compacted
+
+
+# The budgeter shared by all agents in this process. Budgets leave room for the
+# completion (and for the estimate being off) within each context window.
+conversation_budgeter = ConversationBudgeter(
+    budgets={
+        "gpt-4o": 96_000,
+        "gpt-4.1": 800_000,
+        "gemini": 800_000,
+        "google/gemini": 800_000,
+        "anthropic/": 160_000,
+        "meta-llama/llama-4-maverick": 800_000,
+    }
+)
+
+
 class OpenBBAgent:
     def __init__(
         self,
         query_request: QueryRequest,
         system_prompt: str,
-        functions: list[Callable] | None = None,
+        functions: Iterable[Callable] | FunctionRegistry | None = None,
         chat_class: type[Chat] | type[GeminiChat] | type[OpenRouterChat] | None = None,
         model: str | None = None,
+        max_concurrent_post_processing: int = 8,
+        prefetch_widget_data: str | None = None,
+        conversation_budgeter: ConversationBudgeter | None = conversation_budgeter,
         **kwargs: Any,
     ):
         self.request = query_request
         self.widgets = query_request.widgets
         self.system_prompt = system_prompt
-        self.functions = functions
+        self.functions = FunctionRegistry.of(functions or [])
         self.chat_class = chat_class or Chat
+        self.max_concurrent_post_processing = max_concurrent_post_processing
+        # The name of a remote function (eg. "get_widget_data") to call with
+        # the `widget_uuid` of each primary widget whose data isn't in the
+        # conversation yet, before the first completion. This saves the
+        # completion that would otherwise be spent deciding to fetch it.
+        self.prefetch_widget_data = prefetch_widget_data
+        # Keeps the conversation within the model's token budget (set to None
+        # to always send the whole conversation).
+        self.conversation_budgeter = conversation_budgeter
+        # Time spent post-processing each tool result, in message order.
+        self.post_processing_timings: list[dict[str, Any]] = []
         self._model: str | OpenaiChatModel | None = model
         self._chat: Chat | GeminiChat | OpenRouterChat | None = None
         self._citations: CitationCollection | None = None
         self._messages: list[AnyMessage] = []
         self._kwargs = kwargs
 
-        if isinstance(self.chat_class, GeminiChat):
+        if issubclass(self.chat_class, GeminiChat):
             self._model = self._model or "gemini-2.0-flash"
-        elif isinstance(self.chat_class, Chat):
-            self._model = OpenaiChatModel(model=self._model or "gpt-4o")
+        elif issubclass(self.chat_class, Chat):
+            self._model = provider_clients.openai_chat_model(
+                model=self._model or "gpt-4o"
+            )
+
+    @property
+    def _model_name(self) -> str:
+        if isinstance(self._model, OpenaiChatModel):
+            return self._model.model
+        return self._model or ""
+
+    @property
+    def usage(self) -> list[dict[str, int | None]]:
+        """The token usage of each completion so far, including how many of
+        the prompt tokens were read from the provider's cache (if reported)."""
+        if isinstance(self._chat, (GeminiChat, OpenRouterChat)):
+            return self._chat.usage
+        if isinstance(self._chat, Chat):
+            # magentic only reports the input and output tokens.
+            return [
+                {
+                    "prompt_tokens": usage.input_tokens,
+                    "cached_prompt_tokens": None,
+                    "completion_tokens": usage.output_tokens,
+                }
+                for message in self._chat.messages
+                if isinstance(message, AssistantMessage) and (usage := message.usage)
+            ]
+        return []
 
     async def run(self, max_completions: int = 10) -> AsyncGenerator[dict, None]:
         self._messages = await self._handle_request()
         self._citations = await self._handle_callbacks()
 
-        self._chat = self.chat_class(
-            messages=self._messages,
+        self._chat = self._new_chat(self._messages)
+        if prefetch := self._get_prefetch_function_call():
+            async for event in self._handle_parallel_function_call(prefetch):
+                yield event.model_dump()
+                if isinstance(event, FunctionCallSSE):
+                    return
+
+        async for event in self._execute(max_completions=max_completions):
+            yield event.model_dump()
+
+        if self._citations.citations:
+            yield CitationCollectionSSE(data=self._citations).model_dump()
+
+    def _new_chat(
+        self, messages: list[AnyMessage]
+    ) -> Chat | GeminiChat | OpenRouterChat:
+        return self.chat_class(
+            messages=messages,
             output_types=[AsyncStreamedResponse],
             functions=self.functions if self.functions else None,
             model=self._model,  # type: ignore[arg-type]
             **self._kwargs,
         )
-        async for event in self._execute(max_completions=max_completions):
-            yield event.model_dump()
 
-        if self._citations.citations:
-            yield CitationCollectionSSE(data=self._citations).model_dump()
+    def _compact_chat(self) -> None:
+        """Keep the conversation within the model's token budget, including
+        the tool results added since the previous completion."""
+        if not self.conversation_budgeter:
+            return
+        chat = cast(Chat | GeminiChat | OpenRouterChat, self._chat)
+        # magentic types its messages as the base Message class.
+        messages = cast(list[AnyMessage], list(chat.messages))
+        compacted = self.conversation_budgeter.compact(messages, model=self._model_name)
+        if compacted is messages:
+            return
+        if isinstance(chat, (GeminiChat, OpenRouterChat)):
+            # Replaced in place, to keep the chat's usage and converted messages.
+            chat.messages = compacted
+        else:
+            # magentic chats are immutable.
+            self._chat = self._new_chat(compacted)
+
+    def _get_prefetch_function_call(self) -> ParallelFunctionCall | None:
+        """Get the calls that fetch the data of the primary widgets that isn't
+        in the conversation yet, if prefetching is enabled."""
+        if (
+            not self.prefetch_widget_data
+            or not self.widgets
+            or not self.widgets.primary
+            or not isinstance(self.request.messages[-1], LlmClientMessage)
+            or self.request.messages[-1].role != "human"
+        ):
+            return None
+
+        fetched_widget_uuids = set()
+        for message in self.request.messages:
+            if isinstance(message, LlmClientFunctionCallResultMessage):
+                for data_source in message.input_arguments.get("data_sources", []):
+                    if isinstance(data_source, dict):
+                        fetched_widget_uuids.add(data_source.get("widget_uuid"))
+                    else:
+                        fetched_widget_uuids.add(data_source.widget_uuid)
+        function = self.functions.get(self.prefetch_widget_data)
+        function_calls = [
+            FunctionCall(function, widget_uuid=str(widget.uuid))
+            for widget in self.widgets.primary
+            if str(widget.uuid) not in fetched_widget_uuids
+        ]
+        if not function_calls:
+            return None
+        self._chat = cast(Chat | GeminiChat, self._chat)
+        parallel_function_call = ParallelFunctionCall(function_calls)
+        self._chat = self._chat.add_message(AssistantMessage(parallel_function_call))
+        return parallel_function_call
 
     async def _handle_callbacks(self) -> CitationCollection:
         if not self.functions:
@@ -703,8 +2003,30 @@ class OpenBBAgent:
                     citations.append(event)
         return CitationCollection(citations=citations)
 
+    async def _post_process(
+        self,
+        wrapped_function: WrappedFunctionProtocol,
+        function_call: FunctionCall,
+        message: LlmClientFunctionCallResultMessage,
+        semaphore: asyncio.Semaphore,
+    ) -> tuple[FunctionResultMessage, float]:
+        async with semaphore:
+            start = time.perf_counter()
+            content = await wrapped_function.execute_post_processing(
+                message.data, request=self.request
+            )
+            if local_result := (message.extra_state or {}).get("local_result"):
+                content = f"{local_result}\n\n{content}"
+            elapsed = time.perf_counter() - start
+        result = FunctionResultMessage(content=content, function_call=function_call)
+        return result, elapsed
+
     async def _handle_request(self) -> list[AnyMessage]:
         chat_messages: list[AnyMessage] = [SystemMessage(self.system_prompt)]
+        # Tool results are post-processed concurrently (eg. downloading PDFs),
+        # and slotted back into their position in the conversation afterwards.
+        semaphore = asyncio.Semaphore(self.max_concurrent_post_processing)
+        post_processing: dict[int, Awaitable[tuple[FunctionResultMessage, float]]] = {}
         for message in self.request.messages:
             match message:
                 case LlmClientMessage(role="human"):
@@ -719,6 +2041,11 @@ class OpenBBAgent:
                 case LlmClientFunctionCallResultMessage(role="tool"):
                     if not self.functions:
                         continue
+                    if "batched_function_calls" in message.extra_state:
+                        self._handle_batched_result(
+                            message, chat_messages, post_processing, semaphore
+                        )
+                        continue
                     wrapped_function = get_wrapped_function(
                         function_name=message.extra_state.get(
                             "_locally_bound_function", ""
@@ -734,18 +2061,86 @@ class OpenBBAgent:
                     )
                     chat_messages.append(AssistantMessage(function_call))
 
-                    chat_messages.append(
-                        FunctionResultMessage(
-                            content=await wrapped_function.execute_post_processing(
-                                message.data
-                            ),
-                            function_call=function_call,
-                        )
+                    post_processing[len(chat_messages)] = self._post_process(
+                        wrapped_function, function_call, message, semaphore
                     )
+                    # Placeholder for the function result message.
+                    chat_messages.append(None)  # type: ignore[arg-type]
                 case _:
                     raise ValueError(f"Unsupported message type: {message}")
+
+        results = await asyncio.gather(*post_processing.values())
+        self.post_processing_timings = []
+        for index, (result, elapsed) in zip(post_processing, results):
+            chat_messages[index] = result
+            self.post_processing_timings.append(
+                {
+                    "message_index": index,
+                    "function": result.function_call.function.__name__,
+                    "seconds": elapsed,
+                }
+            )
+        if self.post_processing_timings:
+            logger.info(f"Post-processed tool results: {self.post_processing_timings}")
         return chat_messages
 
+    def _handle_batched_result(
+        self,
+        message: LlmClientFunctionCallResultMessage,
+        chat_messages: list[AnyMessage],
+        post_processing: dict[int, Awaitable[tuple[FunctionResultMessage, float]]],
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        """Rebuild a batch of parallel function calls from the client's result.
+
+        The data of the batch is split back up between the remote calls, in
+        the order their data sources were requested in.
+        """
+        assert self.functions
+        function_calls: list[FunctionCall] = []
+        results: list[tuple[WrappedFunctionProtocol, FunctionCall, Any]] = []
+        offset = 0
+        for batched_function_call in message.extra_state["batched_function_calls"]:
+            wrapped_function = get_wrapped_function(
+                function_name=batched_function_call["_locally_bound_function"],
+                functions=self.functions,
+            )
+            function_call = FunctionCall(
+                wrapped_function,
+                **batched_function_call["copilot_function_call_arguments"],
+            )
+            function_calls.append(function_call)
+            if "result" in batched_function_call:
+                results.append(
+                    (wrapped_function, function_call, batched_function_call["result"])
+                )
+            else:
+                count = batched_function_call["data_source_count"]
+                data = message.data[offset : offset + count]
+                offset += count
+                results.append(
+                    (
+                        wrapped_function,
+                        function_call,
+                        message.model_copy(
+                            update={"data": data, "extra_state": batched_function_call}
+                        ),
+                    )
+                )
+
+        chat_messages.append(AssistantMessage(ParallelFunctionCall(function_calls)))
+        for wrapped_function, function_call, result in results:
+            if isinstance(result, str):
+                chat_messages.append(
+                    FunctionResultMessage(content=result, function_call=function_call)
+                )
+            else:
+                post_processing[len(chat_messages)] = self._post_process(
+                    wrapped_function, function_call, result, semaphore
+                )
+                # Placeholder for the function result message.
+                chat_messages.append(None)  # type: ignore[arg-type]
+
     async def _handle_text_stream(
         self, stream: AsyncStreamedStr
     ) -> AsyncGenerator[MessageChunkSSE, None]:
@@ -762,14 +2157,18 @@ class OpenBBAgent:
         if not isinstance(self._chat.last_message, AssistantMessage):
             raise ValueError("Last message is not an assistant message")
 
-        # We sneak in the request as extra state.
-        function_call.function.request = self.request
+        # Remote (and `bind_request`) functions get a copy that is bound to
+        # this request, so that concurrent requests never see each other's
+        # widgets.
+        function = function_call.function
+        if hasattr(function, "bind"):
+            function = function.bind(self.request)
 
         # Execute the function.
         logger.info(
             f"Executing function: {function_call.function.__name__} with arguments: {function_call.arguments}"
         )
-        async for event in function_call():
+        async for event in function(**function_call.arguments):
             # Yield reasoning steps.
             if isinstance(event, StatusUpdateSSE):
                 yield event
@@ -787,6 +2186,98 @@ class OpenBBAgent:
             )
         )
 
+    async def _run_function_call(
+        self, function_call: FunctionCall
+    ) -> tuple[list[StatusUpdateSSE], str | FunctionCallSSE]:
+        """Run a function call to completion, collecting its reasoning steps.
+
+        The result is either the function's output, or the SSE that asks the
+        client to execute (part of) the function.
+        """
+        function = function_call.function
+        if hasattr(function, "bind"):
+            function = function.bind(self.request)
+
+        logger.info(
+            f"Executing function: {function_call.function.__name__} with arguments: {function_call.arguments}"
+        )
+        status_updates: list[StatusUpdateSSE] = []
+        function_call_result = ""
+        async for event in function(**function_call.arguments):
+            if isinstance(event, StatusUpdateSSE):
+                status_updates.append(event)
+            elif isinstance(event, FunctionCallSSE):
+                return status_updates, event
+            else:
+                function_call_result += str(event)
+        return status_updates, function_call_result
+
+    async def _handle_parallel_function_call(
+        self, parallel_function_call: ParallelFunctionCall
+    ) -> AsyncGenerator[FunctionCallSSE | StatusUpdateSSE, None]:
+        self._chat = cast(Chat | GeminiChat, self._chat)
+        function_calls = list(parallel_function_call)
+        # Every call is run concurrently. Local functions run to completion,
+        # while remote functions stop at the data they need from the client.
+        outcomes = await asyncio.gather(
+            *(
+                self._run_function_call(function_call)
+                for function_call in function_calls
+            )
+        )
+        for status_updates, _ in outcomes:
+            for status_update in status_updates:
+                yield status_update
+
+        remote_calls = [
+            (function_call, result)
+            for function_call, (_, result) in zip(function_calls, outcomes)
+            if isinstance(result, FunctionCallSSE)
+        ]
+        if not remote_calls:
+            for function_call, (_, result) in zip(function_calls, outcomes):
+                self._chat = self._chat.add_message(
+                    FunctionResultMessage(
+                        content=cast(str, result), function_call=function_call
+                    )
+                )
+            return
+
+        # All the widget data is requested from the client in one go. The
+        # results of the local calls are carried along in the extra state, so
+        # that the whole batch can be rebuilt when the client responds.
+        data_sources: list[Any] = []
+        batched_function_calls: list[dict[str, Any]] = []
+        for function_call, (_, result) in zip(function_calls, outcomes):
+            if isinstance(result, FunctionCallSSE):
+                remote_data_sources = result.data.input_arguments["data_sources"]
+                data_sources.extend(remote_data_sources)
+                batched_function_calls.append(
+                    {
+                        **result.data.extra_state,
+                        "data_source_count": len(remote_data_sources),
+                    }
+                )
+            else:
+                batched_function_calls.append(
+                    {
+                        "copilot_function_call_arguments": function_call.arguments,
+                        "_locally_bound_function": function_call.function.__name__,
+                        "result": result,
+                    }
+                )
+        first_remote_call = remote_calls[0][1]
+        yield FunctionCallSSE(
+            data=FunctionCallSSEData(
+                function=first_remote_call.data.function,
+                input_arguments={"data_sources": data_sources},
+                extra_state={
+                    **first_remote_call.data.extra_state,
+                    "batched_function_calls": batched_function_calls,
+                },
+            )
+        )
+
     async def _execute(
         self, max_completions: int
     ) -> AsyncGenerator[MessageChunkSSE | FunctionCallSSE | StatusUpdateSSE, None]:
@@ -794,6 +2285,7 @@ class OpenBBAgent:
         # We set a limit to avoid infinite loops.
         while completion_count < max_completions:
             completion_count += 1
+            self._compact_chat()
             # TODO: Use a protocol for this.
             self._chat = await cast(Chat | GeminiChat, self._chat).asubmit()
             # Handle a streamed text response.
@@ -812,3 +2304,8 @@ class OpenBBAgent:
                             yield event
                             if isinstance(event, FunctionCallSSE):
                                 return
+                    elif isinstance(item, ParallelFunctionCall):
+                        async for event in self._handle_parallel_function_call(item):
+                            yield event
+                            if isinstance(event, FunctionCallSSE):
+                                return
@@ -7,6 +7,8 @@ from openbb_ai.models import (
     SourceInfo,
 )
 
+from .widgets import get_widget_index
+
 import logging
 
 
@@ -20,19 +22,10 @@ async def cite_widget(
         DataSourceRequest(**data_source)
         for data_source in function_call_result.input_arguments.get("data_sources", [])
     ]
-    all_widgets = (
-        request.widgets.primary + request.widgets.secondary if request.widgets else []
-    )
+    widget_index = get_widget_index(request)
 
     for data_source_request in data_source_requests:
-        widget = next(
-            (
-                w
-                for w in all_widgets
-                if str(w.uuid) == str(data_source_request.widget_uuid)
-            ),
-            None,
-        )
+        widget = widget_index.get(data_source_request.widget_uuid)
         if not widget:
             logger.warning(
                 f"Widget not found while trying to create citation: {data_source_request.widget_uuid}"
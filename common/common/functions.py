@@ -0,0 +1,68 @@
+from typing import Any, AsyncGenerator
+
+from openbb_ai.models import QueryRequest, StatusUpdateSSE
+
+from .agent import bind_request, reasoning_step
+from .widgets import get_widget_index, render_widget, render_widget_parameters
+
+
+@bind_request
+async def search_widgets(
+    query: str,
+    request: QueryRequest,  # Must be included as an argument
+) -> AsyncGenerator[str | StatusUpdateSSE, None]:
+    """Search all of the widgets on the dashboard by keywords (eg. "revenue" or
+    "AAPL news"), including the ones that are not listed in the system prompt.
+    Returns the UUIDs of the best matches, which can be used to retrieve their
+    data."""
+    widgets = get_widget_index(request).search(query, limit=5)
+    yield reasoning_step(
+        event_type="INFO",
+        message=f"Found {len(widgets)} widgets matching: {query}",
+        details={"widgets": ", ".join(widget.name for widget in widgets)},
+    )
+    if not widgets:
+        yield f"No widgets match: {query}"
+        return
+    for widget in widgets:
+        yield render_widget(widget)
+        yield render_widget_parameters(widget)
+
+
+def _render_option(option: Any) -> str:
+    # Options are either plain values, or `{"label": ..., "value": ...}`.
+    if isinstance(option, dict) and "value" in option:
+        label = option.get("label")
+        if label is not None and str(label) != str(option["value"]):
+            return f"{option['value']} ({label})"
+        return str(option["value"])
+    return str(option)
+
+
+@bind_request
+async def get_widget_param_options(
+    widget_uuid: str,
+    param_name: str,
+    request: QueryRequest,  # Must be included as an argument
+) -> AsyncGenerator[str | StatusUpdateSSE, None]:
+    """List every option of a widget parameter (the system prompt only lists
+    the first few), to choose a new value for the parameter."""
+    widget = get_widget_index(request).get(widget_uuid)
+    if not widget:
+        yield f"Unable to find a widget with UUID: {widget_uuid}"
+        return
+    param = next((param for param in widget.params if param.name == param_name), None)
+    if not param:
+        names = ", ".join(param.name for param in widget.params)
+        yield f"{widget.name} has no parameter {param_name} (it has: {names})"
+        return
+    if not param.options:
+        yield f"{param_name} of {widget.name} can take any value of type {param.type}"
+        return
+
+    yield reasoning_step(
+        event_type="INFO",
+        message=f"Listing the options of {param_name} for widget: {widget.name}",
+    )
+    yield f"Options of {param_name} (currently {param.current_value}):\n"
+    yield "".join(f"- {_render_option(option)}\n" for option in param.options)
@@ -0,0 +1,70 @@
+import math
+import re
+from collections import Counter
+from typing import Iterable
+
+# Words are runs of letters and digits, so that eg. "income_statement" matches
+# a search for "income".
+_WORD = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: str) -> list[str]:
+    return _WORD.findall(text.lower())
+
+
+class Bm25Index:
+    """An in-memory Okapi BM25 index over a list of documents.
+
+    Documents are referred to by their position in the list. Only the postings
+    of the query's terms are scored, so searching a big index for a few words
+    is cheap.
+    """
+
+    def __init__(self, documents: Iterable[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # The (document position, term frequency) of every document a term is in.
+        self._postings: dict[str, list[tuple[int, int]]] = {}
+        self._lengths: list[int] = []
+        for position, document in enumerate(documents):
+            term_frequencies = Counter(tokenize(document))
+            self._lengths.append(sum(term_frequencies.values()))
+            for term, frequency in term_frequencies.items():
+                self._postings.setdefault(term, []).append((position, frequency))
+        self._average_length = (
+            sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        )
+
+    def scores(self, query: str) -> dict[int, float]:
+        """The score of every document that matches any of the words of `query`."""
+        scores: dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (len(self) - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for position, frequency in postings:
+                length_norm = (
+                    1 - self.b + self.b * self._lengths[position] / self._average_length
+                )
+                scores[position] = scores.get(position, 0.0) + idf * (
+                    frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+                )
+        return scores
+
+    def rank(self, query: str, limit: int) -> list[int]:
+        """The positions of the `limit` documents most relevant to `query`,
+        best first (and in document order, for equal scores).
+
+        Documents that don't match any of the words of the query are never
+        returned.
+        """
+        scores = self.scores(query)
+        return sorted(scores, key=lambda position: (-scores[position], position))[
+            :limit
+        ]
+
+    def __len__(self) -> int:
+        return len(self._lengths)
@@ -1,5 +1,8 @@
 from ast import literal_eval
+import asyncio
 import json
+import threading
+from typing import Any, Callable
 from pydantic import BaseModel
 
 
@@ -184,3 +187,337 @@ def capture_stream_response(event_stream: str) -> tuple[str, str]:
             data_dict_ = literal_eval(data_payload)
             captured_stream += data_dict_["delta"]
     return event_name, captured_stream
+
+
+def completion_chunk(
+    delta: dict[str, Any],
+    finish_reason: str | None = None,
+    model: str = "mock-model",
+) -> dict[str, Any]:
+    """Build an OpenAI-compatible `chat.completion.chunk` payload."""
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def text_chunks(text: str, chunk_size: int = 4) -> list[dict[str, Any]]:
+    """Split `text` into streamed content chunks, ending with `stop`."""
+    chunks = [
+        completion_chunk({"role": "assistant", "content": text[i : i + chunk_size]})
+        for i in range(0, len(text), chunk_size)
+    ]
+    chunks.append(completion_chunk({}, finish_reason="stop"))
+    return chunks
+
+
+def usage_chunk(
+    prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0
+) -> dict[str, Any]:
+    """Build the final, choice-less chunk that reports the token usage."""
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "mock-model",
+        "choices": [],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        },
+    }
+
+
+def gemini_text_chunks(
+    text: str,
+    chunk_size: int = 4,
+    prompt_tokens: int = 0,
+    cached_tokens: int = 0,
+) -> list[dict[str, Any]]:
+    """Split `text` into streamed Gemini responses, ending with `STOP` and the
+    token usage."""
+    chunks: list[dict[str, Any]] = [
+        {
+            "candidates": [
+                {
+                    "content": {
+                        "role": "model",
+                        "parts": [{"text": text[i : i + chunk_size]}],
+                    }
+                }
+            ]
+        }
+        for i in range(0, len(text), chunk_size)
+    ]
+    chunks[-1]["candidates"][0]["finishReason"] = "STOP"
+    chunks[-1]["usageMetadata"] = {
+        "promptTokenCount": prompt_tokens,
+        "cachedContentTokenCount": cached_tokens,
+        "candidatesTokenCount": len(chunks),
+    }
+    return chunks
+
+
+def _collapse_chunks(chunks: list[dict[str, Any]]) -> dict[str, Any]:
+    """Fold streamed chunks into a non-streaming `chat.completion` payload."""
+    content = ""
+    tool_calls: dict[int, dict[str, Any]] = {}
+    finish_reason = None
+    for chunk in chunks:
+        if not chunk["choices"]:
+            continue
+        choice = chunk["choices"][0]
+        delta = choice["delta"]
+        content += delta.get("content") or ""
+        for tool_call in delta.get("tool_calls") or []:
+            accumulated = tool_calls.setdefault(
+                tool_call["index"],
+                {
+                    "id": "",
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""},
+                },
+            )
+            accumulated["id"] = tool_call.get("id") or accumulated["id"]
+            function = tool_call.get("function") or {}
+            accumulated["function"]["name"] += function.get("name") or ""
+            accumulated["function"]["arguments"] += function.get("arguments") or ""
+        finish_reason = choice.get("finish_reason") or finish_reason
+
+    message: dict[str, Any] = {"role": "assistant", "content": content or None}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": 0,
+        "model": chunks[0]["model"] if chunks else "mock-model",
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+    }
+
+
+class MockOpenAIServer:
+    """A minimal, local OpenAI-compatible chat completions server.
+
+    Runs on its own event loop in a background thread, speaks HTTP/1.1 with
+    keep-alive, and records every request and every TCP connection it accepts,
+    so tests and benchmarks can assert on payloads and connection re-use
+    without network access.
+
+    `handler` receives the parsed JSON request body and returns the list of
+    chunks to stream back (see `completion_chunk` and `text_chunks`).
+    Non-streaming requests get the chunks folded into a single completion.
+
+    `latency` is the delay before the first chunk (or a function of the
+    request body that returns it, eg. to model prefill time), and
+    `chunk_latency` the delay between chunks (ie. generation time), which
+    non-streaming requests wait for in full before getting their response.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict[str, Any]], list[dict[str, Any]]] | None = None,
+        latency: float | Callable[[dict[str, Any]], float] = 0.0,
+        chunk_latency: float = 0.0,
+    ):
+        self.handler = handler or (lambda body: text_chunks("Hello from the mock."))
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.connections = 0
+        self.requests: list[dict[str, Any]] = []
+        self.headers: list[dict[str, str]] = []
+        self.paths: list[str] = []
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._server: asyncio.AbstractServer | None = None
+        self._thread: threading.Thread | None = None
+        self.port: int | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (
+                    asyncio.IncompleteReadError,
+                    asyncio.CancelledError,
+                    ConnectionError,
+                ):
+                    return
+                request_line, *header_lines = head.decode().split("\r\n")
+                path = request_line.split(" ")[1]
+                headers = {
+                    name.strip().lower(): value.strip()
+                    for name, _, value in (
+                        line.partition(":") for line in header_lines if line
+                    )
+                }
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                payload = json.loads(body) if body else {}
+                self.requests.append(payload)
+                self.headers.append(headers)
+                self.paths.append(path)
+
+                await self._respond(writer, path, payload)
+        except (asyncio.CancelledError, ConnectionError):
+            # The server is shutting down, or the client went away mid-stream.
+            return
+        finally:
+            writer.close()
+
+    async def _respond(
+        self, writer: asyncio.StreamWriter, path: str, payload: dict[str, Any]
+    ) -> None:
+        latency = self.latency(payload) if callable(self.latency) else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+        chunks = self.handler(payload)
+        if payload.get("stream") and self.chunk_latency:
+            await self._write_chunked(writer, chunks)
+            return
+        if self.chunk_latency:
+            await asyncio.sleep(self.chunk_latency * len(chunks))
+        if payload.get("stream"):
+            content_type = "text/event-stream"
+            response_body = "".join(
+                f"data: {json.dumps(chunk)}\n\n" for chunk in chunks
+            )
+            response_body += "data: [DONE]\n\n"
+        else:
+            content_type = "application/json"
+            response_body = json.dumps(_collapse_chunks(chunks))
+
+        await self._write_response(writer, content_type, response_body)
+
+    async def _write_response(
+        self, writer: asyncio.StreamWriter, content_type: str, response_body: str
+    ) -> None:
+        encoded = response_body.encode()
+        writer.write(
+            (
+                "HTTP/1.1 200 OK\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(encoded)}\r\n"
+                "Connection: keep-alive\r\n\r\n"
+            ).encode()
+            + encoded
+        )
+        await writer.drain()
+
+    async def _write_chunked(
+        self, writer: asyncio.StreamWriter, chunks: list[dict[str, Any]]
+    ) -> None:
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+        )
+        events = [f"data: {json.dumps(chunk)}\n\n" for chunk in chunks]
+        for index, event in enumerate([*events, "data: [DONE]\n\n"]):
+            if index:
+                await asyncio.sleep(self.chunk_latency)
+            encoded = event.encode()
+            writer.write(b"%x\r\n%s\r\n" % (len(encoded), encoded))
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def start(self) -> "MockOpenAIServer":
+        started = threading.Event()
+
+        async def serve() -> None:
+            self._server = await asyncio.start_server(
+                self._handle_connection, "127.0.0.1", 0
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(serve(), self._loop)
+        started.wait()
+        return self
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+
+        async def shutdown() -> None:
+            if self._server:
+                self._server.close()
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self) -> "MockOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+
+class MockGeminiServer(MockOpenAIServer):
+    """A minimal, local stand-in for the Gemini API.
+
+    Streams generated content, and creates cached content. `handler` receives
+    the parsed JSON request body of each `streamGenerateContent` request, and
+    returns the list of responses to stream back (see `gemini_text_chunks`).
+    Created cached contents are kept in `cached_contents`, by name.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict[str, Any]], list[dict[str, Any]]] | None = None,
+        latency: float | Callable[[dict[str, Any]], float] = 0.0,
+    ):
+        super().__init__(
+            handler=handler
+            or (lambda body: gemini_text_chunks("Hello from the mock.")),
+            latency=latency,
+        )
+        self.cached_contents: dict[str, dict[str, Any]] = {}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _respond(
+        self, writer: asyncio.StreamWriter, path: str, payload: dict[str, Any]
+    ) -> None:
+        if path.partition("?")[0].endswith("/cachedContents"):
+            name = f"cachedContents/mock-{len(self.cached_contents)}"
+            self.cached_contents[name] = payload
+            await self._write_response(
+                writer,
+                "application/json",
+                json.dumps({"name": name, "model": payload.get("model")}),
+            )
+            return
+
+        latency = self.latency(payload) if callable(self.latency) else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+        response_body = "".join(
+            f"data: {json.dumps(chunk)}\r\n\r\n" for chunk in self.handler(payload)
+        )
+        await self._write_response(writer, "text/event-stream", response_body)
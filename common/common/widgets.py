@@ -0,0 +1,326 @@
+import weakref
+from typing import Any, Callable, Iterator
+from uuid import UUID
+
+from openbb_ai.models import QueryRequest, Widget, WidgetCollection, WidgetParam
+
+from .retrieval import Bm25Index
+
+
+def _searchable_text(widget: Widget) -> str:
+    parts = [widget.name, widget.description, widget.widget_id]
+    for param in widget.params:
+        parts.extend([param.name, param.description])
+    return " ".join(parts)
+
+
+class WidgetIndex:
+    """The primary and secondary widgets of a request, indexed by UUID and by
+    (origin, widget_id).
+
+    If the same widget appears more than once, the first one wins (primary
+    widgets come before secondary widgets).
+    """
+
+    def __init__(self, widget_collection: WidgetCollection | None = None):
+        self.primary: list[Widget] = (
+            list(widget_collection.primary) if widget_collection else []
+        )
+        self.secondary: list[Widget] = (
+            list(widget_collection.secondary) if widget_collection else []
+        )
+        self._by_uuid: dict[str, Widget] = {}
+        self._by_id: dict[tuple[str, str], Widget] = {}
+        for widget in self:
+            self._by_uuid.setdefault(str(widget.uuid), widget)
+            self._by_id.setdefault((widget.origin, widget.widget_id), widget)
+        self._widgets: list[Widget] = []
+        self._search_index: Bm25Index | None = None
+
+    def get(self, widget_uuid: str | UUID) -> Widget | None:
+        return self._by_uuid.get(str(widget_uuid))
+
+    def get_by_id(self, origin: str, widget_id: str) -> Widget | None:
+        return self._by_id.get((origin, widget_id))
+
+    def search(self, query: str, limit: int = 5) -> list[Widget]:
+        """The `limit` widgets most relevant to `query`, best first.
+
+        The search index (BM25, over the widgets' names, descriptions and
+        parameters) is built on the first search.
+        """
+        if self._search_index is None:
+            self._widgets = list(self)
+            self._search_index = Bm25Index(map(_searchable_text, self._widgets))
+        return [
+            self._widgets[position]
+            for position in self._search_index.rank(query, limit=limit)
+        ]
+
+    def __contains__(self, widget_uuid: object) -> bool:
+        return str(widget_uuid) in self._by_uuid
+
+    def __iter__(self) -> Iterator[Widget]:
+        yield from self.primary
+        yield from self.secondary
+
+    def __len__(self) -> int:
+        return len(self.primary) + len(self.secondary)
+
+
+# Indexes of the widget collections of in-flight requests, by object id. Each
+# entry is dropped as soon as its widget collection is garbage collected.
+_widget_indexes: dict[int, tuple[weakref.ref, WidgetIndex]] = {}
+
+
+def get_widget_index(
+    source: QueryRequest | WidgetCollection | None,
+) -> WidgetIndex:
+    """Get the (cached) widget index of a request or widget collection.
+
+    The index is built the first time it is asked for, and then shared by
+    everything that handles the same request (eg. the remote functions, the
+    citation callbacks and the prompt renderer).
+    """
+    widget_collection = source.widgets if isinstance(source, QueryRequest) else source
+    if widget_collection is None:
+        return WidgetIndex()
+
+    key = id(widget_collection)
+    entry = _widget_indexes.get(key)
+    if entry is not None and entry[0]() is widget_collection:
+        return entry[1]
+
+    widget_index = WidgetIndex(widget_collection)
+    _widget_indexes[key] = (
+        weakref.ref(widget_collection, lambda _: _widget_indexes.pop(key, None)),
+        widget_index,
+    )
+    return widget_index
+
+
+WIDGETS_HEADING = "# Available Widgets\n\n"
+# `primary` widgets are widgets that the user has manually selected and added
+# to the custom agent on OpenBB Workspace.
+PRIMARY_WIDGETS_HEADING = "## Primary Widgets (prioritize using these widgets when answering the user's query):\n\n"
+# `secondary` widgets are widgets that are on the currently-active dashboard,
+# but have not been added to the custom agent explicitly by the user.
+SECONDARY_WIDGETS_HEADING = "\n## Secondary Widgets (use these widgets if the user's query is not answered by the primary widgets):\n\n"
+PARAMETERS_HEADING = "\n## Current Widget Parameters\n\n"
+OMITTED_WIDGETS_NOTE = (
+    "\n{count} more secondary widgets are on the dashboard, but are not listed "
+    "here. The ones most relevant to the latest question may be listed below, "
+    "and `search_widgets` finds the others.\n"
+)
+RELEVANT_WIDGETS_HEADING = (
+    "\n## More Secondary Widgets (relevant to the latest question):\n\n"
+)
+# The widgets relevant to the latest question, and the current values of the
+# parameters, change from turn to turn, so they are rendered last.
+VOLATILE_HEADINGS = (RELEVANT_WIDGETS_HEADING, PARAMETERS_HEADING)
+
+
+def split_volatile_tail(prompt: str) -> tuple[str, str]:
+    """Split a prompt into the part that stays the same from turn to turn,
+    and the part from the first volatile heading on (eg. to only mark the
+    former as a prefix to cache)."""
+    starts = [
+        start for heading in VOLATILE_HEADINGS if (start := prompt.find(heading)) > 0
+    ]
+    if not starts:
+        return prompt, ""
+    return prompt[: min(starts)], prompt[min(starts) :]
+
+
+def render_widget(widget: Widget) -> str:
+    """Render the parts of a widget that don't change from turn to turn."""
+    parameters = ", ".join(param.name for param in widget.params)
+    return (
+        f"uuid: {widget.uuid} <-- use this to retrieve the data for the widget\n"
+        f"name: {widget.name}\n"
+        f"description: {widget.description}\n"
+        f"parameters: {parameters}\n"
+        "-------\n"
+    )
+
+
+def _option_value(option: Any) -> Any:
+    # Options are either plain values, or `{"label": ..., "value": ...}`.
+    if isinstance(option, dict) and "value" in option:
+        return option["value"]
+    return option
+
+
+def render_param_options(param: WidgetParam, max_options: int = 5) -> str:
+    """Summarize the options of a parameter, eg. as a range of numbers, or
+    as its first few options and a count of the rest."""
+    if not param.options:
+        return ""
+    values = [_option_value(option) for option in param.options]
+    if len(values) <= max_options:
+        return ", ".join(map(str, values))
+    if all(
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+        for value in values
+    ):
+        return f"{min(values)} to {max(values)}, {len(values)} values"
+    first = ", ".join(map(str, values[:max_options]))
+    return (
+        f"{first} and {len(values) - max_options} more, listed by "
+        "`get_widget_param_options`"
+    )
+
+
+def render_widget_with_param_options(widget: Widget, max_options: int = 5) -> str:
+    """Like `render_widget`, but also summarizes the options of each parameter,
+    so that the model can choose new values for them."""
+    parameters = "".join(
+        f"  {param.name} (options: {options})\n"
+        if (options := render_param_options(param, max_options))
+        else f"  {param.name}\n"
+        for param in widget.params
+    )
+    return (
+        f"uuid: {widget.uuid} <-- use this to retrieve the data for the widget\n"
+        f"name: {widget.name}\n"
+        f"description: {widget.description}\n"
+        f"parameters:\n{parameters}"
+        "-------\n"
+    )
+
+
+def render_widget_parameters(widget: Widget) -> str:
+    """Render the current values of a widget's parameters."""
+    if not widget.params:
+        return ""
+    values = "".join(
+        f"  {param.name}={param.current_value}\n" for param in widget.params
+    )
+    return f"uuid: {widget.uuid}\n{values}"
+
+
+def _widget_order(widget: Widget) -> tuple[str, str, UUID]:
+    return (widget.origin, widget.widget_id, widget.uuid)
+
+
+class WidgetPromptRenderer:
+    """Renders the widgets of a request into a system prompt.
+
+    To keep the prompt prefix byte-identical across turns (and therefore
+    cacheable by the provider), widgets are emitted in a deterministic order,
+    and the current values of their parameters, which change the most often,
+    are rendered last, after every widget.  The prompt is assembled from its
+    fragments with a single join.
+
+    On big dashboards, `max_secondary_widgets` bounds the size of the prompt:
+    only the first few secondary widgets (in the same deterministic order) are
+    listed, whatever the question, and the model is told to use
+    `search_widgets` to find the others.  Given the latest question, up to
+    `max_relevant_widgets` of the others, ranked by BM25, are listed after the
+    stable part of the prompt, with the parameters.
+    """
+
+    def __init__(
+        self,
+        render_widget: Callable[[Widget], str] = render_widget,
+        render_widget_parameters: Callable[[Widget], str] = render_widget_parameters,
+        primary_heading: str = PRIMARY_WIDGETS_HEADING,
+        secondary_heading: str = SECONDARY_WIDGETS_HEADING,
+        max_secondary_widgets: int | None = None,
+        max_relevant_widgets: int = 5,
+    ):
+        self.render_widget = render_widget
+        self.max_secondary_widgets = max_secondary_widgets
+        self.max_relevant_widgets = max_relevant_widgets
+        self.primary_heading = primary_heading
+        self.secondary_heading = secondary_heading
+        self.render_widget_parameters = render_widget_parameters
+        self._templates: dict[str, tuple[str, str]] = {}
+
+    def render_parts(
+        self, widget_collection: WidgetCollection | None, query: str | None = None
+    ) -> list[str]:
+        """Render the widgets section of the prompt, as a list of fragments."""
+        primary = sorted(
+            widget_collection.primary if widget_collection else [], key=_widget_order
+        )
+        secondary, omitted = self._select_secondary_widgets(widget_collection)
+        parts = [WIDGETS_HEADING, self.primary_heading]
+        parts.extend(self.render_widget(widget) for widget in primary)
+        parts.append(self.secondary_heading)
+        parts.extend(self.render_widget(widget) for widget in secondary)
+        if omitted:
+            parts.append(OMITTED_WIDGETS_NOTE.format(count=omitted))
+
+        relevant = (
+            self._select_relevant_widgets(widget_collection, secondary, query)
+            if omitted and query
+            else []
+        )
+        if relevant:
+            parts.append(RELEVANT_WIDGETS_HEADING)
+            parts.extend(self.render_widget(widget) for widget in relevant)
+
+        parameters = [
+            rendered
+            for widget in primary + secondary + relevant
+            if (rendered := self.render_widget_parameters(widget))
+        ]
+        if parameters:
+            parts.append(PARAMETERS_HEADING)
+            parts.extend(parameters)
+        return parts
+
+    def _select_secondary_widgets(
+        self, widget_collection: WidgetCollection | None
+    ) -> tuple[list[Widget], int]:
+        """Select the secondary widgets to list, and count the ones left out.
+
+        The selection doesn't depend on the question, so that the prompt stays
+        the same from turn to turn (and cacheable). Past
+        `max_secondary_widgets`, the rest can be found with `search_widgets`.
+        """
+        secondary = sorted(
+            widget_collection.secondary if widget_collection else [],
+            key=_widget_order,
+        )
+        limit = self.max_secondary_widgets
+        if limit is None or len(secondary) <= limit:
+            return secondary, 0
+        return secondary[:limit], len(secondary) - limit
+
+    def _select_relevant_widgets(
+        self,
+        widget_collection: WidgetCollection | None,
+        listed: list[Widget],
+        query: str,
+    ) -> list[Widget]:
+        """The secondary widgets left out of the list that are most relevant
+        to `query`, best first."""
+        widget_index = get_widget_index(widget_collection)
+        left_out = {widget.uuid for widget in widget_index.secondary} - {
+            widget.uuid for widget in listed
+        }
+        relevant = [
+            widget
+            for widget in widget_index.search(query, limit=len(widget_index))
+            if widget.uuid in left_out
+        ]
+        return relevant[: self.max_relevant_widgets]
+
+    def render(
+        self,
+        widget_collection: WidgetCollection | None,
+        template: str = "{widgets_prompt}",
+        query: str | None = None,
+    ) -> str:
+        """Render `template`, substituting the widgets for `{widgets_prompt}`."""
+        if template not in self._templates:
+            # The template is a format string, so unescape its braces.
+            prefix, _, suffix = (
+                part.replace("{{", "{").replace("}}", "}")
+                for part in template.partition("{widgets_prompt}")
+            )
+            self._templates[template] = (prefix, suffix)
+        prefix, suffix = self._templates[template]
+        return "".join([prefix, *self.render_parts(widget_collection, query), suffix])
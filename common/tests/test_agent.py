@@ -0,0 +1,1365 @@
+import asyncio
+import json
+import re
+import uuid
+
+import httpx
+import openai
+import pytest
+from common import agent
+from magentic import (
+    AssistantMessage,
+    Chat,
+    AsyncStreamedResponse,
+    AsyncStreamedStr,
+    FunctionCall,
+    FunctionResultMessage,
+    ParallelFunctionCall,
+    SystemMessage,
+    UserMessage,
+)
+from openbb_ai.models import (
+    DataContent,
+    DataFileReferences,
+    QueryRequest,
+    StatusUpdateSSE,
+    Widget,
+)
+
+from common.agent import (
+    ConversationBudgeter,
+    FormattedResultCache,
+    FunctionRegistry,
+    GeminiChat,
+    GeminiContextCache,
+    OpenBBAgent,
+    OpenRouterChat,
+    ProviderClientRegistry,
+    bind_request,
+    formatted_result_cache,
+    get_latest_question,
+    get_remote_data,
+    get_wrapped_function,
+    provider_clients,
+    remote_function_call,
+    tool_definitions,
+)
+from common.widgets import PARAMETERS_HEADING, RELEVANT_WIDGETS_HEADING
+from common.testing import (
+    MockGeminiServer,
+    MockOpenAIServer,
+    completion_chunk,
+    gemini_text_chunks,
+    text_chunks,
+    usage_chunk,
+)
+
+
+@remote_function_call(function="get_widget_data")
+async def get_widget_data(widget_uuid: str, request: QueryRequest):
+    """Retrieve data for a widget by specifying the widget UUID."""
+    # Give other requests the chance to run in-between.
+    await asyncio.sleep(0)
+    widget = next(w for w in request.widgets.primary if str(w.uuid) == widget_uuid)
+    yield get_remote_data(widget=widget, input_arguments={"symbol": widget.name})
+
+
+def _tool_call_chunks(function_name: str, arguments: dict) -> list[dict]:
+    return [
+        completion_chunk(
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        "index": 0,
+                        "id": f"call_{uuid.uuid4().hex}",
+                        "type": "function",
+                        "function": {
+                            "name": function_name,
+                            "arguments": json.dumps(arguments),
+                        },
+                    }
+                ],
+            }
+        ),
+        completion_chunk({}, finish_reason="tool_calls"),
+    ]
+
+
+def _parallel_tool_call_chunks(tool_calls: list[tuple[str, dict]]) -> list[dict]:
+    """Stream several tool calls, with their fragments interleaved."""
+    chunks = [
+        completion_chunk(
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {
+                        "index": index,
+                        "id": f"call_{uuid.uuid4().hex}",
+                        "type": "function",
+                        "function": {"name": function_name, "arguments": ""},
+                    }
+                    for index, (function_name, _) in enumerate(tool_calls)
+                ],
+            }
+        )
+    ]
+    for half in (0, 1):
+        for index, (_, arguments) in enumerate(tool_calls):
+            serialized = json.dumps(arguments)
+            middle = len(serialized) // 2
+            part = serialized[:middle] if half == 0 else serialized[middle:]
+            chunks.append(
+                completion_chunk(
+                    {"tool_calls": [{"index": index, "function": {"arguments": part}}]}
+                )
+            )
+    chunks.append(completion_chunk({}, finish_reason="tool_calls"))
+    return chunks
+
+
+def _request_widget_data(body: dict) -> list[dict]:
+    """Ask for the data of the widget listed in the system prompt."""
+    widget_uuid = re.search(r"widget: (\S+)", body["messages"][0]["content"])
+    return _tool_call_chunks("get_widget_data", {"widget_uuid": widget_uuid.group(1)})
+
+
+@pytest.fixture
+def mock_server():
+    with MockOpenAIServer() as server:
+        yield server
+
+
+async def _collect_text(chat: OpenRouterChat) -> str:
+    text = ""
+    async for item in chat.last_message.content:
+        if isinstance(item, AsyncStreamedStr):
+            async for chunk in item:
+                text += chunk
+    return text
+
+
+@pytest.mark.asyncio
+async def test_provider_client_registry_reuses_clients():
+    registry = ProviderClientRegistry(max_connections=10, http2=False)
+
+    client = registry.openai_client(base_url="http://localhost/v1", api_key="a")
+    assert registry.openai_client(base_url="http://localhost/v1", api_key="a") is client
+    assert (
+        registry.openai_client(base_url="http://localhost/v1", api_key="b")
+        is not client
+    )
+    assert registry.limits.max_connections == 10
+
+    await registry.aclose()
+    assert (
+        registry.openai_client(base_url="http://localhost/v1", api_key="a")
+        is not client
+    )
+    await registry.aclose()
+
+
+def test_provider_client_registry_keeps_explicit_limits():
+    registry = ProviderClientRegistry(max_connections=10, http2=False)
+    registry.configure(max_keepalive_connections=0, keepalive_expiry=None)
+
+    assert registry.limits.max_connections == 10
+    assert registry.limits.max_keepalive_connections == 0
+    assert registry.limits.keepalive_expiry is None
+
+
+def test_provider_clients_are_closed_with_their_event_loop(mock_server):
+    registry = ProviderClientRegistry(http2=False)
+
+    async def fetch() -> httpx.AsyncClient:
+        client = registry.http_client()
+        response = await client.get(mock_server.base_url + "/models")
+        assert response.status_code == 200
+        return client
+
+    # Each `asyncio.run` (eg. each `TestClient` request) is a new event loop.
+    first = asyncio.run(fetch())
+    assert first.is_closed
+    second = asyncio.run(fetch())
+    assert second is not first
+    assert second.is_closed
+    assert mock_server.connections == 2
+
+
+@pytest.mark.asyncio
+async def test_magentic_chat_model_uses_the_pooled_client(monkeypatch, mock_server):
+    # Any client magentic creates itself (as opposed to the shared one).
+    created = []
+    for name in ("OpenAI", "AsyncOpenAI"):
+        client_class = getattr(openai, name)
+
+        def create(*args, client_class=client_class, **kwargs):
+            created.append(client_class)
+            return client_class(*args, **kwargs)
+
+        monkeypatch.setattr(openai, name, create)
+
+    for _ in range(3):
+        model = provider_clients.openai_chat_model(
+            "mock-model", base_url=mock_server.base_url, api_key="test"
+        )
+        chat = Chat(messages=[UserMessage("Hi")], model=model)
+        chat = await chat.asubmit()
+        assert chat.last_message.content == "Hello from the mock."
+
+    assert model.api_key == "test"
+    assert model.base_url.startswith(mock_server.base_url)
+    assert created == []
+    assert len(mock_server.requests) == 3
+    assert mock_server.connections == 1
+    await provider_clients.aclose()
+
+
+@pytest.mark.asyncio
+async def test_open_router_chat_reuses_connections(mock_server):
+    messages = [SystemMessage("You are a mock."), UserMessage("Hi")]
+    for _ in range(5):
+        chat = OpenRouterChat(
+            messages=list(messages),
+            model="mock-model",
+            api_key="test",
+            base_url=mock_server.base_url,
+        )
+        await chat.asubmit()
+        assert await _collect_text(chat) == "Hello from the mock."
+
+    assert len(mock_server.requests) == 5
+    assert mock_server.connections == 1
+    await provider_clients.aclose()
+
+
+@pytest.mark.asyncio
+async def test_open_router_chat_routes_each_chunk_once():
+    def handler(body: dict) -> list[dict]:
+        reasoning = [
+            completion_chunk({"role": "assistant", "reasoning": "Let me think. "})
+            for _ in range(3)
+        ]
+        return reasoning + text_chunks("Hello from the mock.")
+
+    with MockOpenAIServer(handler=handler) as mock_server:
+        chat = OpenRouterChat(
+            messages=[SystemMessage("You are a mock."), UserMessage("Hi")],
+            model="mock-model",
+            api_key="test",
+            base_url=mock_server.base_url,
+        )
+        await chat.asubmit()
+        items = [item async for item in chat.last_message.content]
+    await provider_clients.aclose()
+
+    assert [type(item) for item in items] == [
+        StatusUpdateSSE,
+        StatusUpdateSSE,
+        AsyncStreamedStr,
+    ]
+    assert items[1].data.details == [{"Reasoning": "Let me think. " * 3}]
+    assert await items[2].to_string() == "Hello from the mock."
+    # The answer is converted back into a single assistant message.
+    converted = await chat._convert_messages()
+    assert converted[2:] == [{"role": "assistant", "content": "Hello from the mock."}]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_do_not_share_widgets():
+    def make_request(i: int) -> QueryRequest:
+        return QueryRequest(
+            messages=[{"role": "human", "content": "Get the widget data."}],
+            widgets={
+                "primary": [
+                    Widget(
+                        origin="openbb",
+                        widget_id=f"widget_{i}",
+                        name=f"TICKER{i}",
+                        description="A widget.",
+                        params=[],
+                        metadata={},
+                    )
+                ]
+            },
+        )
+
+    async def run(request: QueryRequest) -> list[dict]:
+        openbb_agent = OpenBBAgent(
+            query_request=request,
+            system_prompt=f"widget: {request.widgets.primary[0].uuid}",
+            functions=[get_widget_data],
+            chat_class=OpenRouterChat,
+            model="mock-model",
+            api_key="test",
+            base_url=mock_server.base_url,
+        )
+        return [event async for event in openbb_agent.run()]
+
+    with MockOpenAIServer(handler=_request_widget_data) as mock_server:
+        requests = [make_request(i) for i in range(200)]
+        results = await asyncio.gather(*(run(request) for request in requests))
+
+    for request, events in zip(requests, results):
+        widget = request.widgets.primary[0]
+        function_calls = [e for e in events if e["event"] == "copilotFunctionCall"]
+        assert len(function_calls) == 1
+        data_sources = json.loads(function_calls[0]["data"])["input_arguments"][
+            "data_sources"
+        ]
+        assert data_sources == [
+            {
+                "widget_uuid": str(widget.uuid),
+                "origin": "openbb",
+                "id": widget.widget_id,
+                "input_args": {"symbol": widget.name},
+            }
+        ]
+
+    # The shared, module-level function is never bound to a request.
+    assert get_widget_data.request is None
+    await provider_clients.aclose()
+
+
+def test_formatted_result_cache_evicts_least_recently_used():
+    cache = FormattedResultCache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    assert cache.stats == {
+        "hits": 3,
+        "misses": 1,
+        "evictions": 1,
+        "entries": 2,
+        "chars": 2,
+    }
+
+    cache = FormattedResultCache(max_chars=5)
+    cache.put("a", "123")
+    cache.put("b", "456")
+    assert cache.get("a") is None
+    assert cache.stats["chars"] == 3
+
+
+@pytest.mark.asyncio
+async def test_historical_tool_results_are_formatted_once(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    formatted = []
+
+    async def count_formatting(data: list[DataContent]) -> str:
+        formatted.append(data)
+        return "formatted data"
+
+    @remote_function_call(function="get_widget_data", output_formatter=count_formatting)
+    async def get_widget_data(widget_uuid: str, request: QueryRequest):
+        """Retrieve data for a widget by specifying the widget UUID."""
+        yield "unused"
+
+    def tool_result(content: str) -> dict:
+        return {
+            "role": "tool",
+            "function": "get_widget_data",
+            "data": [{"items": [{"content": content}]}],
+            "extra_state": {
+                "copilot_function_call_arguments": {"widget_uuid": "1234"},
+                "_locally_bound_function": "get_widget_data",
+            },
+        }
+
+    messages = [
+        {"role": "human", "content": "Get the widget data."},
+        tool_result("first"),
+    ]
+    formatted_result_cache.clear()
+    for turn in range(3):
+        request = QueryRequest(messages=messages)
+        openbb_agent = OpenBBAgent(
+            query_request=request, system_prompt="", functions=[get_widget_data]
+        )
+        await openbb_agent._handle_request()
+        messages = [
+            *messages,
+            {"role": "ai", "content": "Some answer."},
+            {"role": "human", "content": "And again."},
+            tool_result(f"turn {turn}"),
+        ]
+
+    # Only new tool results are formatted on every turn.
+    assert len(formatted) == 3
+    assert formatted_result_cache.stats["hits"] == 3
+
+
+@pytest.mark.asyncio
+async def test_formatters_can_take_the_request():
+    questions = []
+
+    async def format_for_question(data: list[DataContent], request) -> str:
+        questions.append(get_latest_question(request))
+        return f"data for: {questions[-1]}"
+
+    @remote_function_call(
+        function="get_widget_data", output_formatter=format_for_question
+    )
+    async def get_widget_data(widget_uuid: str, request: QueryRequest):
+        """Retrieve data for a widget by specifying the widget UUID."""
+        yield "unused"
+
+    data = [DataContent(items=[{"content": "data"}])]
+    formatted_result_cache.clear()
+    for question in ("First?", "Second?", "First?"):
+        request = QueryRequest(messages=[{"role": "human", "content": question}])
+        result = await get_widget_data.execute_post_processing(data, request=request)
+        assert result == f"data for: {question}"
+
+    # Results are cached per question.
+    assert questions == ["First?", "Second?"]
+
+
+@pytest.mark.asyncio
+async def test_file_references_are_formatted_every_time():
+    formatted = []
+
+    async def count_formatting(data: list[DataFileReferences]) -> str:
+        formatted.append(data)
+        return f"formatted {len(formatted)}"
+
+    @remote_function_call(function="get_widget_data", output_formatter=count_formatting)
+    async def get_widget_data(widget_uuid: str, request: QueryRequest):
+        """Retrieve data for a widget by specifying the widget UUID."""
+        yield "unused"
+
+    # The file behind the URL may have changed, so it has to be revalidated.
+    data = [
+        DataFileReferences(
+            items=[
+                {
+                    "url": "https://example.com/report.pdf",
+                    "data_format": {"data_type": "pdf", "filename": "report.pdf"},
+                }
+            ]
+        )
+    ]
+    formatted_result_cache.clear()
+    assert await get_widget_data.execute_post_processing(data) == "formatted 1"
+    assert await get_widget_data.execute_post_processing(data) == "formatted 2"
+    assert formatted_result_cache.stats["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_tool_results_are_post_processed_concurrently(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    running = 0
+    max_running = 0
+
+    async def slow_formatting(data: list[DataContent]) -> str:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return data[0].items[0].content
+
+    @remote_function_call(
+        function="get_widget_data", output_formatter=slow_formatting, cache_output=False
+    )
+    async def get_widget_data(widget_uuid: str, request: QueryRequest):
+        """Retrieve data for a widget by specifying the widget UUID."""
+        yield "unused"
+
+    messages = []
+    for i in range(6):
+        messages.append({"role": "human", "content": f"question {i}"})
+        messages.append(
+            {
+                "role": "tool",
+                "function": "get_widget_data",
+                "data": [{"items": [{"content": f"data {i}"}]}],
+                "extra_state": {
+                    "copilot_function_call_arguments": {"widget_uuid": str(i)},
+                    "_locally_bound_function": "get_widget_data",
+                },
+            }
+        )
+
+    openbb_agent = OpenBBAgent(
+        query_request=QueryRequest(messages=messages),
+        system_prompt="",
+        functions=[get_widget_data],
+        max_concurrent_post_processing=3,
+    )
+    chat_messages = await openbb_agent._handle_request()
+
+    assert max_running == 3
+    assert [
+        m.content for m in chat_messages if isinstance(m, FunctionResultMessage)
+    ] == [f"data {i}" for i in range(6)]
+    assert [t["message_index"] for t in openbb_agent.post_processing_timings] == [
+        3,
+        6,
+        9,
+        12,
+        15,
+        18,
+    ]
+    assert all(t["seconds"] >= 0.05 for t in openbb_agent.post_processing_timings)
+
+
+@pytest.mark.asyncio
+async def test_parallel_tool_calls_are_run_concurrently_and_batched():
+    widgets = [
+        Widget(
+            origin="openbb",
+            widget_id=f"widget_{i}",
+            name=f"TICKER{i}",
+            description="A widget.",
+            params=[],
+            metadata={},
+        )
+        for i in range(2)
+    ]
+    running = 0
+    max_running = 0
+
+    async def get_exchange_rate(currency: str):
+        """Get the exchange rate of a currency against the US dollar."""
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        yield f"{currency}: 1.1"
+
+    def handler(body: dict) -> list[dict]:
+        return _parallel_tool_call_chunks(
+            [
+                ("get_exchange_rate", {"currency": "EUR"}),
+                ("get_widget_data", {"widget_uuid": str(widgets[0].uuid)}),
+                ("get_exchange_rate", {"currency": "GBP"}),
+                ("get_widget_data", {"widget_uuid": str(widgets[1].uuid)}),
+            ]
+        )
+
+    messages = [{"role": "human", "content": "Compare the widgets."}]
+    with MockOpenAIServer(handler=handler) as mock_server:
+        openbb_agent = OpenBBAgent(
+            query_request=QueryRequest(messages=messages, widgets={"primary": widgets}),
+            system_prompt="",
+            functions=[get_exchange_rate, get_widget_data],
+            chat_class=OpenRouterChat,
+            model="mock-model",
+            api_key="test",
+            base_url=mock_server.base_url,
+        )
+        events = [event async for event in openbb_agent.run()]
+    await provider_clients.aclose()
+
+    # One completion fans out to all four calls, and the local calls overlap.
+    assert len(mock_server.requests) == 1
+    assert max_running == 2
+    function_calls = [e for e in events if e["event"] == "copilotFunctionCall"]
+    assert len(function_calls) == 1
+    function_call = json.loads(function_calls[0]["data"])
+    data_sources = function_call["input_arguments"]["data_sources"]
+    assert [d["id"] for d in data_sources] == ["widget_0", "widget_1"]
+
+    # The client responds with the data of both widgets, in one message.
+    messages.append(
+        {
+            "role": "tool",
+            "function": "get_widget_data",
+            "data": [{"items": [{"content": f"data {i}"}]} for i in range(2)],
+            "extra_state": function_call["extra_state"],
+        }
+    )
+    openbb_agent = OpenBBAgent(
+        query_request=QueryRequest(messages=messages, widgets={"primary": widgets}),
+        system_prompt="",
+        functions=[get_exchange_rate, get_widget_data],
+        chat_class=OpenRouterChat,
+        api_key="test",
+    )
+    chat_messages = await openbb_agent._handle_request()
+
+    assert isinstance(chat_messages[2], AssistantMessage)
+    assert isinstance(chat_messages[2].content, ParallelFunctionCall)
+    results = chat_messages[3:]
+    assert [m.content for m in results[::2]] == ["EUR: 1.1", "GBP: 1.1"]
+    assert "data 0" in results[1].content and "data 1" not in results[1].content
+    assert "data 1" in results[3].content and "data 0" not in results[3].content
+    assert [m.function_call for m in results] == list(chat_messages[2].content)
+
+    chat = OpenRouterChat(messages=chat_messages, api_key="test")
+    converted = await chat._convert_messages()
+    tool_calls = converted[2]["tool_calls"]
+    assert [t["function"]["name"] for t in tool_calls] == [
+        "get_exchange_rate",
+        "get_widget_data",
+        "get_exchange_rate",
+        "get_widget_data",
+    ]
+    assert [t["id"] for t in tool_calls] == [m["tool_call_id"] for m in converted[3:]]
+
+
+class CountingStreamedResponse(AsyncStreamedResponse):
+    reads = 0
+
+    async def __aiter__(self):
+        CountingStreamedResponse.reads += 1
+        async for item in super().__aiter__():
+            yield item
+
+
+def get_weather(city: str) -> str:
+    """Get the weather in a city."""
+    return "Sunny"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chat_class", [OpenRouterChat, GeminiChat])
+async def test_streamed_responses_are_converted_once(monkeypatch, chat_class):
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test")
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    CountingStreamedResponse.reads = 0
+
+    async def streamed_function_call():
+        yield FunctionCall(get_weather, city="London")
+
+    messages = [SystemMessage("You are a mock."), UserMessage("Weather?")]
+    chat = chat_class(messages=messages, functions=[get_weather])
+
+    async def convert_messages() -> list:
+        if isinstance(chat, GeminiChat):
+            return await chat._convert_messages(messages)
+        return await chat._convert_messages()
+
+    first_conversion = await convert_messages()
+    for turn in range(10):
+        function_call = FunctionCall(get_weather, city="London")
+        chat.add_message(
+            AssistantMessage(CountingStreamedResponse(streamed_function_call()))
+        )
+        chat.add_message(FunctionResultMessage("Sunny", function_call))
+        converted = await convert_messages()
+        # Every streamed response is read back once, when it is first converted.
+        assert CountingStreamedResponse.reads == turn + 1
+        assert len(converted) == len(first_conversion) + 2 * (turn + 1)
+
+    # Changing the history re-converts from the first changed message onwards.
+    messages[1] = UserMessage("Weather in London?")
+    await convert_messages()
+    assert CountingStreamedResponse.reads == 20
+
+
+def test_tool_definitions_are_compiled_once(monkeypatch):
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test")
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    compiled = []
+    schema = agent.FunctionCallFunctionSchema
+
+    def counting_schema(function):
+        compiled.append(function)
+        return schema(function)
+
+    monkeypatch.setattr(agent, "FunctionCallFunctionSchema", counting_schema)
+    tool_definitions.clear()
+    tool_definitions.warm([get_weather, get_widget_data])
+    assert len(compiled) == len(tool_definitions) == 4
+
+    for _ in range(3):
+        openai_tools = OpenRouterChat(messages=[])._prepare_tools([get_weather])
+        gemini_tools = GeminiChat(messages=[])._prepare_tools([get_weather])
+    assert len(compiled) == 4
+    assert openai_tools[0] is tool_definitions.get(get_weather, provider="openai")
+    assert openai_tools[0]["function"]["parameters"]["additionalProperties"] is False
+    assert gemini_tools[0].function_declarations[0].name == "get_weather"
+
+
+@pytest.mark.asyncio
+async def test_tool_definitions_are_compiled_at_startup(monkeypatch, mock_server):
+    compiled = []
+    schema = agent.FunctionCallFunctionSchema
+
+    def counting_schema(function):
+        compiled.append(function)
+        return schema(function)
+
+    monkeypatch.setattr(agent, "FunctionCallFunctionSchema", counting_schema)
+    tool_definitions.clear()
+    async with agent.lifespan([get_weather, get_widget_data])(app=None):
+        assert len(compiled) == len(tool_definitions) == 4
+
+        openbb_agent = OpenBBAgent(
+            query_request=QueryRequest(
+                messages=[{"role": "human", "content": "Weather?"}]
+            ),
+            system_prompt="You are a helpful assistant.",
+            functions=[get_weather, get_widget_data],
+            chat_class=OpenRouterChat,
+            model="mock-model",
+            api_key="test",
+            base_url=mock_server.base_url,
+        )
+        _ = [event async for event in openbb_agent.run()]
+
+    # The first request re-used the definitions compiled at startup.
+    assert len(mock_server.requests) == 1
+    assert len(mock_server.requests[0]["tools"]) == 2
+    assert len(compiled) == 4
+
+
+def test_function_registry_is_shared_by_the_agent_and_chat(monkeypatch):
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test")
+
+    def make_function(i: int):
+        async def function():
+            yield str(i)
+
+        function.__name__ = f"function_{i}"
+        return function
+
+    registry = FunctionRegistry(make_function(i) for i in range(500))
+    registry.register(get_widget_data)
+    assert len(registry) == 501
+    assert registry.get("function_321").__name__ == "function_321"
+    assert get_wrapped_function("get_widget_data", registry) is get_widget_data
+    with pytest.raises(ValueError, match="Local function not found"):
+        get_wrapped_function("missing", registry)
+    with pytest.raises(ValueError, match="already registered"):
+        registry.register(make_function(1))
+
+    openbb_agent = OpenBBAgent(
+        query_request=QueryRequest(messages=[{"role": "human", "content": "Hi"}]),
+        system_prompt="",
+        functions=registry,
+        chat_class=OpenRouterChat,
+    )
+    assert openbb_agent.functions is registry
+    chat = openbb_agent.chat_class(
+        messages=[], functions=openbb_agent.functions, api_key="test"
+    )
+    assert chat._get_function("function_7") is registry.get("function_7")
+
+
+@bind_request
+async def count_widgets(origin: str, request: QueryRequest):
+    """Count the widgets from an origin."""
+    widgets = request.widgets.primary if request.widgets else []
+    yield str(sum(widget.origin == origin for widget in widgets))
+
+
+@pytest.mark.asyncio
+async def test_local_functions_can_be_bound_to_the_request():
+    widgets = [
+        Widget(
+            origin=origin,
+            widget_id=f"widget_{i}",
+            name=f"Widget {i}",
+            description="A widget.",
+            params=[],
+            metadata={},
+        )
+        for i, origin in enumerate(["openbb", "custom", "openbb"])
+    ]
+
+    def handler(body: dict) -> list[dict]:
+        if body["messages"][-1]["role"] == "tool":
+            return text_chunks("Two.")
+        return _tool_call_chunks("count_widgets", {"origin": "openbb"})
+
+    with MockOpenAIServer(handler=handler) as mock_server:
+        openbb_agent = OpenBBAgent(
+            query_request=QueryRequest(
+                messages=[{"role": "human", "content": "How many?"}],
+                widgets={"primary": widgets},
+            ),
+            system_prompt="",
+            functions=[count_widgets],
+            chat_class=OpenRouterChat,
+            model="mock-model",
+            api_key="test",
+            base_url=mock_server.base_url,
+        )
+        events = [event async for event in openbb_agent.run()]
+    await provider_clients.aclose()
+
+    # The request is hidden from the model, and passed in by the agent.
+    (tool,) = mock_server.requests[0]["tools"]
+    assert list(tool["function"]["parameters"]["properties"]) == ["origin"]
+    assert count_widgets.request is None
+    assert not [e for e in events if e["event"] == "copilotFunctionCall"]
+    assert len(mock_server.requests) == 2
+    assert mock_server.requests[1]["messages"][-1]["content"] == "2"
+
+
+@remote_function_call(function="get_widget_data")
+async def get_widgets_data(widget_uuids: list[str], request: QueryRequest):
+    """Retrieve data for several widgets by specifying their UUIDs."""
+    widgets = {str(w.uuid): w for w in request.widgets.primary}
+    for widget_uuid in widget_uuids:
+        if widget_uuid not in widgets:
+            yield f"Widget {widget_uuid} is not on the dashboard."
+            continue
+        widget = widgets[widget_uuid]
+        yield get_remote_data(widget=widget, input_arguments={"symbol": widget.name})
+
+
+@pytest.mark.asyncio
+async def test_remote_functions_can_request_several_data_sources_at_once():
+    widgets = [
+        Widget(
+            origin="openbb",
+            widget_id=f"widget_{i}",
+            name=f"TICKER{i}",
+            description="A widget.",
+            params=[],
+            metadata={},
+        )
+        for i in range(3)
+    ]
+    widget_uuids = [
+        str(widgets[0].uuid),
+        "missing",
+        *(str(w.uuid) for w in widgets[1:]),
+    ]
+
+    def handler(body: dict) -> list[dict]:
+        return _tool_call_chunks("get_widgets_data", {"widget_uuids": widget_uuids})
+
+    messages = [{"role": "human", "content": "Compare the widgets."}]
+    with MockOpenAIServer(handler=handler) as mock_server:
+        openbb_agent = OpenBBAgent(
+            query_request=QueryRequest(messages=messages, widgets={"primary": widgets}),
+            system_prompt="",
+            functions=[get_widgets_data],
+            chat_class=OpenRouterChat,
+            model="mock-model",
+            api_key="test",
+            base_url=mock_server.base_url,
+        )
+        events = [event async for event in openbb_agent.run()]
+    await provider_clients.aclose()
+
+    function_calls = [e for e in events if e["event"] == "copilotFunctionCall"]
+    assert len(function_calls) == 1
+    function_call = json.loads(function_calls[0]["data"])
+    data_sources = function_call["input_arguments"]["data_sources"]
+    assert [d["id"] for d in data_sources] == ["widget_0", "widget_1", "widget_2"]
+
+    messages.append(
+        {
+            "role": "tool",
+            "function": "get_widget_data",
+            "data": [{"items": [{"content": f"data {i}"}]} for i in range(3)],
+            "extra_state": function_call["extra_state"],
+        }
+    )
+    openbb_agent = OpenBBAgent(
+        query_request=QueryRequest(messages=messages, widgets={"primary": widgets}),
+        system_prompt="",
+        functions=[get_widgets_data],
+        chat_class=OpenRouterChat,
+        api_key="test",
+    )
+    chat_messages = await openbb_agent._handle_request()
+    result = chat_messages[-1].content
+    assert result.startswith("Widget missing is not on the dashboard.")
+    assert all(f"data {i}" in result for i in range(3))
+
+
+@pytest.mark.asyncio
+async def test_primary_widget_data_can_be_prefetched(mock_server):
+    widgets = [
+        Widget(
+            origin="openbb",
+            widget_id=f"widget_{i}",
+            name=f"TICKER{i}",
+            description="A widget.",
+            params=[],
+            metadata={},
+        )
+        for i in range(2)
+    ]
+    messages = [{"role": "human", "content": "Compare the widgets."}]
+
+    async def run() -> list[dict]:
+        openbb_agent = OpenBBAgent(
+            query_request=QueryRequest(messages=messages, widgets={"primary": widgets}),
+            system_prompt="",
+            functions=[get_widget_data],
+            chat_class=OpenRouterChat,
+            model="mock-model",
+            api_key="test",
+            base_url=mock_server.base_url,
+            prefetch_widget_data="get_widget_data",
+        )
+        return [event async for event in openbb_agent.run()]
+
+    # The data is requested straight away, without a completion.
+    events = await run()
+    assert len(mock_server.requests) == 0
+    assert [e["event"] for e in events] == ["copilotFunctionCall"]
+    function_call = json.loads(events[-1]["data"])
+    data_sources = function_call["input_arguments"]["data_sources"]
+    assert [d["id"] for d in data_sources] == ["widget_0", "widget_1"]
+
+    # Once the client responds, the question is answered in one completion.
+    messages.append(
+        {
+            "role": "tool",
+            "function": "get_widget_data",
+            "input_arguments": function_call["input_arguments"],
+            "data": [{"items": [{"content": f"data {i}"}]} for i in range(2)],
+            "extra_state": function_call["extra_state"],
+        }
+    )
+    events = await run()
+    assert len(mock_server.requests) == 1
+    assert (
+        "".join(
+            json.loads(e["data"])["delta"]
+            for e in events
+            if e["event"] == "copilotMessageChunk"
+        )
+        == "Hello from the mock."
+    )
+    sent_messages = mock_server.requests[0]["messages"]
+    assert [m["role"] for m in sent_messages] == [
+        "system",
+        "user",
+        "assistant",
+        "tool",
+        "tool",
+    ]
+
+    # The data is in the conversation now, so it isn't fetched again.
+    messages.append({"role": "ai", "content": "Hello from the mock."})
+    messages.append({"role": "human", "content": "And now?"})
+    events = await run()
+    assert len(mock_server.requests) == 2
+    assert not [e for e in events if e["event"] == "copilotFunctionCall"]
+    await provider_clients.aclose()
+
+
+@remote_function_call(function="get_widget_data")
+async def get_archived_widget_data(widget_uuid: str, request: QueryRequest):
+    yield f"Widget {widget_uuid} is archived."
+
+
+@pytest.mark.asyncio
+async def test_prefetched_calls_are_kept_in_a_magentic_chat(monkeypatch, mock_server):
+    monkeypatch.setenv("OPENAI_BASE_URL", mock_server.base_url)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    widgets = [
+        Widget(
+            origin="openbb",
+            widget_id=f"widget_{i}",
+            name=f"TICKER{i}",
+            description="A widget.",
+            params=[],
+            metadata={},
+        )
+        for i in range(2)
+    ]
+    openbb_agent = OpenBBAgent(
+        query_request=QueryRequest(
+            messages=[{"role": "human", "content": "Compare the widgets."}],
+            widgets={"primary": widgets},
+        ),
+        system_prompt="",
+        functions=[get_archived_widget_data],
+        chat_class=Chat,
+        model="mock-model",
+        prefetch_widget_data="get_archived_widget_data",
+    )
+    events = [event async for event in openbb_agent.run()]
+    await provider_clients.aclose()
+
+    # No data was needed from the client, so the prefetched calls (and their
+    # results) are answered straight away.
+    assert not [e for e in events if e["event"] == "copilotFunctionCall"]
+    assert len(mock_server.requests) == 1
+    sent_messages = mock_server.requests[0]["messages"]
+    assert [m["role"] for m in sent_messages] == [
+        "system",
+        "user",
+        "assistant",
+        "tool",
+        "tool",
+    ]
+    assert len(sent_messages[2]["tool_calls"]) == 2
+    assert sent_messages[3]["content"] == f"Widget {widgets[0].uuid} is archived."
+
+
+@pytest.mark.asyncio
+async def test_open_router_chat_marks_cache_breakpoints_and_reports_cached_tokens():
+    async def get_exchange_rate(currency: str):
+        """Get the exchange rate of a currency against the US dollar."""
+        yield f"{currency}: 1.1"
+
+    def handler(body: dict) -> list[dict]:
+        if body["messages"][-1]["role"] == "user":
+            return [
+                *_tool_call_chunks("get_exchange_rate", {"currency": "EUR"}),
+                usage_chunk(2000, 10),
+            ]
+        return [*text_chunks("1.1"), usage_chunk(2020, 5, 1900)]
+
+    with MockOpenAIServer(handler=handler) as mock_server:
+        for model in ["anthropic/claude-sonnet-4", "openai/gpt-4o"]:
+            openbb_agent = OpenBBAgent(
+                query_request=QueryRequest(
+                    messages=[{"role": "human", "content": "EUR?"}]
+                ),
+                system_prompt="You are a helpful assistant.",
+                functions=[get_exchange_rate],
+                chat_class=OpenRouterChat,
+                model=model,
+                api_key="test",
+                base_url=mock_server.base_url,
+            )
+            _ = [event async for event in openbb_agent.run()]
+            assert openbb_agent.usage == [
+                {
+                    "prompt_tokens": 2000,
+                    "cached_prompt_tokens": 0,
+                    "completion_tokens": 10,
+                },
+                {
+                    "prompt_tokens": 2020,
+                    "cached_prompt_tokens": 1900,
+                    "completion_tokens": 5,
+                },
+            ]
+    await provider_clients.aclose()
+
+    ephemeral = {"type": "ephemeral"}
+    anthropic_requests, openai_requests = (
+        mock_server.requests[:2],
+        mock_server.requests[2:],
+    )
+    assert all(
+        r["stream_options"] == {"include_usage": True} for r in mock_server.requests
+    )
+    # The system prompt, and (once there is one) the last tool result.
+    first, second = (request["messages"] for request in anthropic_requests)
+    assert first[0]["content"][-1]["cache_control"] == ephemeral
+    assert [
+        index
+        for index, message in enumerate(second)
+        if isinstance(message.get("content"), list)
+        and message["content"][-1].get("cache_control") == ephemeral
+    ] == [0, 3]
+    assert second[3]["role"] == "tool"
+    assert second[3]["content"][-1]["text"] == "EUR: 1.1"
+    # Providers that cache prompts automatically get plain messages.
+    assert all(
+        isinstance(message.get("content"), (str, type(None)))
+        for request in openai_requests
+        for message in request["messages"]
+    )
+
+
+def test_open_router_chat_marks_the_breakpoint_before_the_volatile_tail():
+    stable = "You are a helpful assistant.\n\n# Available Widgets\n\n"
+    tail = RELEVANT_WIDGETS_HEADING + "name: Yields\n" + PARAMETERS_HEADING
+    messages = [{"role": "system", "content": stable + tail}]
+
+    marked = OpenRouterChat._add_cache_breakpoints(messages)
+
+    assert marked[0]["content"] == [
+        {"type": "text", "text": stable, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": tail},
+    ]
+    # The converted messages, which are shared between completions, are kept.
+    assert messages == [{"role": "system", "content": stable + tail}]
+
+
+@pytest.mark.asyncio
+async def test_gemini_chat_caches_the_system_prompt_and_tools():
+    system_prompt = "You are a helpful assistant.\n" + "widget\n" * 3000
+
+    def handler(body: dict) -> list[dict]:
+        cached_tokens = 5000 if "cachedContent" in body else 0
+        return gemini_text_chunks(
+            "Hello.", prompt_tokens=5300, cached_tokens=cached_tokens
+        )
+
+    async def complete(prompt: str) -> GeminiChat:
+        chat = GeminiChat(
+            messages=[SystemMessage(prompt), UserMessage("Hi")],
+            functions=[get_weather],
+            api_key="test",
+            base_url=mock_server.base_url,
+            context_cache=context_cache,
+        )
+        await chat.asubmit()
+        async for item in chat.last_message.content:
+            if isinstance(item, AsyncStreamedStr):
+                await item.to_string()
+        return chat
+
+    context_cache = GeminiContextCache()
+    # Over 4096 characters, but under Gemini's minimum of 4096 tokens.
+    mid_size_prompt = "You are a helpful assistant.\n" + "widget\n" * 1000
+    with MockGeminiServer(handler=handler) as mock_server:
+        for _ in range(3):
+            await complete(mid_size_prompt)
+        # Uploaded in the background the second time the prompt is seen, and
+        # used once it is ready.
+        await complete(system_prompt)
+        await complete(system_prompt)
+        await context_cache.wait()
+        chats = await asyncio.gather(*(complete(system_prompt) for _ in range(3)))
+    await provider_clients.aclose()
+
+    assert len(mock_server.cached_contents) == 1
+    (cached_content,) = mock_server.cached_contents.values()
+    assert cached_content["systemInstruction"]["parts"][0]["text"] == system_prompt
+    assert (
+        cached_content["tools"][0]["functionDeclarations"][0]["name"] == "get_weather"
+    )
+    completions = [request for request in mock_server.requests if "contents" in request]
+    assert [request.get("cachedContent") for request in completions] == [None] * 5 + [
+        "cachedContents/mock-0"
+    ] * 3
+    assert all("systemInstruction" in request for request in completions[:5])
+    assert all("systemInstruction" not in request for request in completions[5:])
+    assert [chat.usage[0]["cached_prompt_tokens"] for chat in chats] == [5000] * 3
+
+
+@pytest.mark.asyncio
+async def test_gemini_context_cache_is_bounded(monkeypatch):
+    # Move the clock forward, without stopping it (the event loop uses it too).
+    monotonic = agent.time.monotonic
+    offset = 0.0
+    monkeypatch.setattr(agent.time, "monotonic", lambda: monotonic() + offset)
+    prompts = [f"Prompt {i}.\n" + "widget\n" * 3000 for i in range(4)]
+    context_cache = GeminiContextCache(ttl=100, max_entries=2)
+    with MockGeminiServer() as mock_server:
+        client = provider_clients.gemini_client(
+            api_key="test", base_url=mock_server.base_url
+        )
+
+        def get(prompt: str) -> str | None:
+            return context_cache.get(client, "test", "mock-model", prompt, None)
+
+        for prompt in prompts[:3]:
+            assert get(prompt) is None
+            assert get(prompt) is None
+            await context_cache.wait()
+        # Only the most recently used entries are kept.
+        assert len(context_cache) == 2
+        assert get(prompts[0]) is None
+        assert get(prompts[1]) is not None
+
+        # Expired entries are dropped as soon as anything else is cached.
+        offset += 95
+        assert get(prompts[3]) is None
+        assert get(prompts[3]) is None
+        await context_cache.wait()
+    await provider_clients.aclose()
+    assert len(context_cache) == 1
+    assert len(mock_server.cached_contents) == 4
+
+
+def _analyst_session(turns: int, rows: int) -> list:
+    """A conversation where every turn fetches (and answers about) a widget."""
+    messages: list = [SystemMessage("You are a helpful assistant.")]
+    for turn in range(turns):
+        function_call = FunctionCall(get_weather, city=f"City {turn}")
+        messages += [
+            UserMessage(f"What is the weather in City {turn}?"),
+            AssistantMessage(function_call),
+            FunctionResultMessage(
+                "\n".join(f"{turn},{row},sunny" for row in range(rows)),
+                function_call=function_call,
+            ),
+            AssistantMessage(f"It is sunny in City {turn}."),
+        ]
+    return messages
+
+
+def test_conversation_budgeter_compacts_old_tool_results():
+    budgeter = ConversationBudgeter(budgets={"big": 100_000, "small": 2_000})
+    messages = _analyst_session(turns=5, rows=200)
+
+    assert budgeter.compact(messages, model="big-model") is messages
+
+    compacted = budgeter.compact(messages, model="small-model")
+    assert sum(map(budgeter.estimate_message_tokens, compacted)) <= 2_000
+    assert len(compacted) == len(messages)
+    # The last two turns are verbatim, the older tool results are excerpts that
+    # say how to fetch them again, with their original tool calls.
+    assert compacted[-8:] == messages[-8:]
+    for original, result in zip(messages[3:-8:4], compacted[3:-8:4]):
+        assert result.function_call is original.function_call
+        assert result.content.startswith("[This result of `get_weather`")
+        assert "Call `get_weather` again" in result.content
+        assert len(result.content) < 800
+
+    # The excerpts are cached.
+    assert [m.content for m in budgeter.compact(messages, model="small-model")] == [
+        m.content for m in compacted
+    ]
+
+
+def test_conversation_budgeter_drops_the_oldest_turns_if_needed():
+    budgeter = ConversationBudgeter(default_budget=1_500, excerpt_chars=5_000)
+    messages = _analyst_session(turns=4, rows=200)
+
+    compacted = budgeter.compact(messages, model="any-model")
+
+    assert sum(map(budgeter.estimate_message_tokens, compacted)) <= 1_500
+    assert compacted[0] is messages[0]
+    assert compacted[-8:] == messages[-8:]
+    assert [m.content for m in compacted if isinstance(m, UserMessage)] == [
+        "What is the weather in City 2?",
+        "What is the weather in City 3?",
+    ]
+
+
+def test_conversation_budgeter_uses_the_most_specific_budget():
+    budgeter = ConversationBudgeter(
+        budgets={"gpt-4": 10_000, "gpt-4o": 20_000}, default_budget=5_000
+    )
+    budgeter.set_budget("gpt-4o-mini", 30_000)
+    assert budgeter.budget_for("gpt-4-turbo") == 10_000
+    assert budgeter.budget_for("gpt-4o-2024-08-06") == 20_000
+    assert budgeter.budget_for("gpt-4o-mini") == 30_000
+    assert budgeter.budget_for("o3") == 5_000
+
+
+@pytest.mark.asyncio
+async def test_conversation_budgeter_estimates_streamed_responses_by_their_text():
+    async def stream():
+        yield "It is sunny "
+        yield "in London. " * 100
+
+    async def response_items():
+        yield AsyncStreamedStr(stream())
+        yield FunctionCall(get_weather, city="Paris")
+
+    response = AsyncStreamedResponse(response_items())
+    # Read it, as the chat does when it is streamed to the client.
+    async for item in response:
+        if isinstance(item, AsyncStreamedStr):
+            text = await item.to_string()
+
+    tokens = ConversationBudgeter.estimate_message_tokens(AssistantMessage(response))
+    assert tokens == (
+        agent.estimate_tokens(text)
+        + agent.estimate_tokens("get_weather")
+        + agent.estimate_tokens(json.dumps({"city": "Paris"}))
+    )
+
+
+def _widget_data_session(turns: int) -> tuple[Widget, str, list[dict]]:
+    """A conversation where every turn fetches (and answers about) the same
+    widget's data dump."""
+    widget = Widget(
+        origin="openbb",
+        widget_id="prices",
+        name="Prices",
+        description="Daily prices.",
+        params=[],
+        metadata={},
+    )
+    dump = "\n".join(f"2024-01-{day:02},{100 + day}" for day in range(1, 29)) * 50
+    messages: list[dict] = []
+    for turn in range(turns):
+        messages += [
+            {"role": "human", "content": f"Question {turn}?"},
+            {
+                "role": "tool",
+                "function": "get_widget_data",
+                "input_arguments": {"data_sources": []},
+                "data": [{"items": [{"content": dump}]}],
+                "extra_state": {
+                    "copilot_function_call_arguments": {
+                        "widget_uuid": str(widget.uuid)
+                    },
+                    "_locally_bound_function": "get_widget_data",
+                },
+            },
+            {"role": "ai", "content": f"Answer {turn}."},
+        ]
+    messages.append({"role": "human", "content": "And now?"})
+
+    return widget, dump, messages
+
+
+@pytest.mark.asyncio
+async def test_old_widget_data_is_compacted_before_it_is_sent(mock_server):
+    widget, dump, messages = _widget_data_session(turns=3)
+    openbb_agent = OpenBBAgent(
+        query_request=QueryRequest(messages=messages, widgets={"primary": [widget]}),
+        system_prompt="You are a helpful assistant.",
+        functions=[get_widget_data],
+        chat_class=OpenRouterChat,
+        model="mock-model",
+        api_key="test",
+        base_url=mock_server.base_url,
+        conversation_budgeter=ConversationBudgeter(default_budget=13_000),
+    )
+    _ = [event async for event in openbb_agent.run()]
+    await provider_clients.aclose()
+
+    tool_results = [
+        message["content"]
+        for message in mock_server.requests[0]["messages"]
+        if message["role"] == "tool"
+    ]
+    assert len(tool_results) == 3
+    assert tool_results[0].startswith("[This result of `get_widget_data`")
+    assert len(tool_results[1]) == len(tool_results[2]) > len(dump)
+
+
+async def get_report():
+    """Get the quarterly report."""
+    yield "The quarter was sunny. " * 1000
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chat_class", [OpenRouterChat, Chat])
+async def test_conversation_is_compacted_before_each_completion(
+    monkeypatch, mock_server, chat_class
+):
+    monkeypatch.setenv("OPENAI_BASE_URL", mock_server.base_url)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    widget, dump, messages = _widget_data_session(turns=3)
+
+    def handler(body: dict) -> list[dict]:
+        if body["messages"][-1]["role"] == "tool":
+            return text_chunks("Sunny.")
+        return _tool_call_chunks("get_report", {})
+
+    mock_server.handler = handler
+    kwargs = {"api_key": "test", "base_url": mock_server.base_url}
+    openbb_agent = OpenBBAgent(
+        query_request=QueryRequest(messages=messages, widgets={"primary": [widget]}),
+        system_prompt="You are a helpful assistant.",
+        functions=[get_widget_data, get_report],
+        chat_class=chat_class,
+        model="mock-model",
+        conversation_budgeter=ConversationBudgeter(default_budget=20_000),
+        **(kwargs if chat_class is OpenRouterChat else {}),
+    )
+    _ = [event async for event in openbb_agent.run()]
+    await provider_clients.aclose()
+
+    def tool_results(request: dict) -> list[str]:
+        return [m["content"] for m in request["messages"] if m["role"] == "tool"]
+
+    # The conversation fits the budget at first, but the report pushes it over,
+    # so the oldest widget data is compacted before the next completion.
+    first, second = mock_server.requests
+    assert len(tool_results(first)) == 3
+    assert all(len(result) > len(dump) for result in tool_results(first))
+    assert tool_results(second)[0].startswith("[This result of `get_widget_data`")
+    assert tool_results(second)[1:3] == tool_results(first)[1:3]
+    assert tool_results(second)[3] == "The quarter was sunny. " * 1000
@@ -0,0 +1,264 @@
+import gc
+
+import pytest
+
+from openbb_ai.models import (
+    QueryRequest,
+    StatusUpdateSSE,
+    Widget,
+    WidgetCollection,
+    WidgetParam,
+)
+
+from common.functions import get_widget_param_options, search_widgets
+from common.widgets import (
+    PARAMETERS_HEADING,
+    RELEVANT_WIDGETS_HEADING,
+    WidgetIndex,
+    WidgetPromptRenderer,
+    _widget_indexes,
+    get_widget_index,
+    render_param_options,
+    render_widget_with_param_options,
+    split_volatile_tail,
+)
+
+
+def _widget(i: int, origin: str = "openbb") -> Widget:
+    return Widget(
+        origin=origin,
+        widget_id=f"widget_{i}",
+        name=f"Widget {i}",
+        description="A widget.",
+        params=[],
+        metadata={},
+    )
+
+
+def test_widget_index_looks_widgets_up_by_uuid_and_id():
+    primary = [_widget(i) for i in range(300)]
+    secondary = [_widget(i, origin="custom") for i in range(300)]
+    request = QueryRequest(
+        messages=[{"role": "human", "content": "Hi"}],
+        widgets={"primary": primary, "secondary": secondary},
+    )
+
+    widget_index = get_widget_index(request)
+    assert len(widget_index) == 600
+    assert widget_index.get(str(primary[123].uuid)) is request.widgets.primary[123]
+    assert widget_index.get(secondary[5].uuid).origin == "custom"
+    assert widget_index.get_by_id("custom", "widget_7").name == "Widget 7"
+    assert widget_index.get("missing") is None
+    assert str(primary[0].uuid) in widget_index
+    assert list(widget_index)[300].origin == "custom"
+
+
+def test_widget_index_is_built_once_per_request():
+    request = QueryRequest(
+        messages=[{"role": "human", "content": "Hi"}],
+        widgets={"primary": [_widget(0)]},
+    )
+    widget_index = get_widget_index(request)
+    assert get_widget_index(request) is widget_index
+    assert get_widget_index(request.widgets) is widget_index
+    assert get_widget_index(None).get("anything") is None
+    assert isinstance(get_widget_index(None), WidgetIndex)
+
+    # The cached index goes away with the request.
+    key = id(request.widgets)
+    del request, widget_index
+    gc.collect()
+    assert key not in _widget_indexes
+
+
+def test_widget_prompt_renderer_keeps_the_prefix_stable_across_turns():
+    def with_value(widget: Widget, value: str) -> Widget:
+        param = WidgetParam(
+            name="symbol", type="text", description="The ticker.", current_value=value
+        )
+        return widget.model_copy(update={"params": [param]})
+
+    renderer = WidgetPromptRenderer()
+    template = "You are a helpful assistant.\n\n{widgets_prompt}\n"
+    primary = [with_value(_widget(i), "AAPL") for i in range(3)]
+    secondary = [with_value(_widget(0, origin="custom"), "AAPL")]
+    first_prompt = renderer.render(
+        WidgetCollection(primary=primary, secondary=secondary), template
+    )
+    # On the next turn, the widgets are listed in another order, and the user
+    # has changed one of their parameters.
+    second_prompt = renderer.render(
+        WidgetCollection(
+            primary=[primary[2], with_value(primary[0], "MSFT"), primary[1]],
+            secondary=secondary,
+        ),
+        template,
+    )
+
+    assert first_prompt.startswith("You are a helpful assistant.\n\n# Available")
+    assert first_prompt.index("Widget 0") < first_prompt.index("Widget 1")
+    # Everything up to the current values of the parameters is byte-identical.
+    prefix = first_prompt[: first_prompt.index(PARAMETERS_HEADING)]
+    assert second_prompt.startswith(prefix + PARAMETERS_HEADING)
+    assert "symbol=MSFT" not in first_prompt
+    assert "symbol=MSFT" in second_prompt
+
+
+def _described_widget(i: int, name: str, description: str) -> Widget:
+    return _widget(i).model_copy(update={"name": name, "description": description})
+
+
+def test_widget_index_searches_widgets_by_relevance():
+    request = QueryRequest(
+        messages=[{"role": "human", "content": "Hi"}],
+        widgets={
+            "primary": [_described_widget(0, "Revenue", "Quarterly revenue.")],
+            "secondary": [
+                _described_widget(1, "News", "Latest company news."),
+                _described_widget(2, "Earnings", "Earnings per share and revenue."),
+                _described_widget(3, "Price", "Historical share price."),
+            ],
+        },
+    )
+    widget_index = get_widget_index(request)
+
+    names = [widget.name for widget in widget_index.search("revenue per share")]
+    assert names == ["Earnings", "Revenue", "Price"]
+    assert [widget.name for widget in widget_index.search("revenue", limit=1)] == [
+        "Revenue"
+    ]
+    assert widget_index.search("weather") == []
+
+
+def test_widget_prompt_renderer_lists_the_same_secondary_widgets_every_turn():
+    secondary = [
+        _described_widget(i, f"Widget {i}", "Some metric.") for i in range(1, 50)
+    ]
+    secondary[41] = _described_widget(42, "Dividends", "Dividend history.")
+    primary = [_widget(0)]
+    widget_collection = WidgetCollection(primary=primary, secondary=secondary)
+    renderer = WidgetPromptRenderer(max_secondary_widgets=5)
+
+    prompt = renderer.render(widget_collection)
+
+    # The first widgets in a stable order are listed, whatever the question (or
+    # the order of the widgets on the dashboard), so the prompt can be cached.
+    assert prompt == renderer.render(
+        WidgetCollection(primary=primary, secondary=secondary[::-1])
+    )
+    assert "name: Widget 0\n" in prompt
+    assert "name: Widget 13\n" in prompt
+    assert "name: Widget 14\n" not in prompt
+    assert prompt.count("-------\n") == 6
+    assert "44 more secondary widgets" in prompt
+    # The others can be found by searching.
+    assert "name: Dividends\n" not in prompt
+    assert [
+        widget.name
+        for widget in get_widget_index(widget_collection).search("dividends", limit=1)
+    ] == ["Dividends"]
+
+
+def test_widget_prompt_renderer_lists_relevant_widgets_after_the_stable_part():
+    secondary = [
+        _described_widget(i, f"Widget {i}", "Some metric.") for i in range(1, 50)
+    ]
+    secondary[41] = _described_widget(42, "Dividends", "Dividend history.")
+    secondary[42] = _described_widget(43, "Yields", "Dividend yield.")
+    # Already listed, so not listed again.
+    secondary[0] = _described_widget(1, "Payouts", "Dividend payouts.")
+    widget_collection = WidgetCollection(primary=[_widget(0)], secondary=secondary)
+    renderer = WidgetPromptRenderer(max_secondary_widgets=5, max_relevant_widgets=1)
+
+    stable_prompt = renderer.render(widget_collection)
+    prompt = renderer.render(widget_collection, query="dividend yield")
+
+    # The stable part is the same as without a question, and the most relevant
+    # of the widgets left out comes after it.
+    stable, tail = split_volatile_tail(prompt)
+    assert stable == split_volatile_tail(stable_prompt)[0]
+    assert tail.startswith(RELEVANT_WIDGETS_HEADING)
+    assert "name: Yields\n" in tail
+    assert "name: Dividends\n" not in prompt
+    assert prompt.count("name: Payouts\n") == 1
+    # Nothing is added if every widget is listed, or nothing matches.
+    assert renderer.render(widget_collection, query="weather") == stable_prompt
+    assert WidgetPromptRenderer().render(
+        widget_collection, query="dividend yield"
+    ) == WidgetPromptRenderer().render(widget_collection)
+
+
+@pytest.mark.asyncio
+async def test_search_widgets_finds_widgets_missing_from_the_prompt():
+    request = QueryRequest(
+        messages=[{"role": "human", "content": "Hi"}],
+        widgets={
+            "secondary": [
+                _described_widget(1, "News", "Latest company news."),
+                _described_widget(2, "Dividends", "Dividend history."),
+            ]
+        },
+    )
+    result = ""
+    async for event in search_widgets.bind(request)(query="dividend history"):
+        if not isinstance(event, StatusUpdateSSE):
+            result += event
+    assert f"uuid: {request.widgets.secondary[1].uuid}" in result
+    assert "News" not in result
+
+
+def test_render_param_options_summarizes_long_option_lists():
+    def param(options: list) -> WidgetParam:
+        return WidgetParam(
+            name="country", type="text", description="Country.", options=options
+        )
+
+    countries = [
+        {"label": name.title(), "value": name}
+        for name in ["france", "germany", "italy", "japan", "spain", "uk", "us"]
+    ]
+    assert render_param_options(param([])) == ""
+    assert render_param_options(param(["annual", "quarter"])) == "annual, quarter"
+    assert render_param_options(param(list(range(1, 31)))) == "1 to 30, 30 values"
+    assert render_param_options(param(countries), max_options=3) == (
+        "france, germany, italy and 4 more, listed by `get_widget_param_options`"
+    )
+
+    widget = _widget(0).model_copy(update={"params": [param(countries)]})
+    assert "  country (options: france, " in render_widget_with_param_options(widget)
+
+
+@pytest.mark.asyncio
+async def test_get_widget_param_options_lists_every_option():
+    options = [{"label": f"Country {i}", "value": f"c{i}"} for i in range(50)]
+    widget = _widget(0).model_copy(
+        update={
+            "params": [
+                WidgetParam(
+                    name="country",
+                    type="text",
+                    description="Country.",
+                    current_value="c0",
+                    options=options,
+                )
+            ]
+        }
+    )
+    request = QueryRequest(
+        messages=[{"role": "human", "content": "Hi"}], widgets={"primary": [widget]}
+    )
+
+    async def call(**kwargs) -> str:
+        result = ""
+        async for event in get_widget_param_options.bind(request)(**kwargs):
+            if not isinstance(event, StatusUpdateSSE):
+                result += event
+        return result
+
+    result = await call(widget_uuid=str(widget.uuid), param_name="country")
+    assert "- c49 (Country 49)\n" in result
+    assert result.count("\n- ") == 50
+    assert "has no parameter" in await call(
+        widget_uuid=str(widget.uuid), param_name="symbol"
+    )
+    assert "Unable to find" in await call(widget_uuid="missing", param_name="country")